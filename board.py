@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from pieces import *
 from enum import Enum, auto
 
@@ -14,6 +16,66 @@ class CheckState(Enum):
     Check = auto()
     Checkmate = auto()
 
+
+class GameState(Enum):
+    NotStarted = auto()
+    InProgress = auto()
+    Ended = auto()
+
+
+# compact position: one byte per square (row after row), a byte of flags and the en passant column + 1
+POSITION_SIZE = 66
+FLAGS_INDEX = 64
+EN_PASSANT_INDEX = 65
+PIECE_CODES = {Pawn: 1, Knight: 2, Bishop: 3, Rook: 4, Queen: 5, King: 6}
+PIECE_TYPES = {code: piece_type for piece_type, code in PIECE_CODES.items()}
+BLACK_PIECE = 8
+BLACK_TO_MOVE = 1
+# castling is still possible with the rook standing on that square
+CASTLING_FLAGS = {(7, 0): 2, (7, 7): 4, (0, 0): 8, (0, 7): 16}
+
+
+def piece_code(piece: Piece) -> int:
+    if isinstance(piece, EmptyPiece):
+        return 0
+    return PIECE_CODES[type(piece)] | (BLACK_PIECE if piece.color == Color.Black else 0)
+
+
+def piece_from_code(code: int) -> Piece:
+    if not code:
+        return EmptyPiece()
+    return PIECE_TYPES[code & ~BLACK_PIECE](Color.Black if code & BLACK_PIECE else Color.White)
+
+
+# row 0 is the eighth rank and the columns go from the h file to the a file
+FILES = 'hgfedcba'
+PIECE_LETTERS = {Pawn: 'P', Knight: 'N', Bishop: 'B', Rook: 'R', Queen: 'Q', King: 'K'}
+LETTER_PIECES = {letter: piece_type for piece_type, letter in PIECE_LETTERS.items()}
+PROMOTIONS = (Queen, Rook, Bishop, Knight)
+CASTLING_LETTERS = {(7, 0): 'K', (7, 7): 'Q', (0, 0): 'k', (0, 7): 'q'}
+CHECK_SUFFIXES = {CheckState.NoCheck: '', CheckState.Check: '+', CheckState.Checkmate: '#'}
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+LEGAL_MOVE_CACHE_SIZE = 256  # positions
+ORTHOGONAL_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DIAGONAL_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+SLIDER_DIRECTIONS = {Rook: ORTHOGONAL_DIRECTIONS, Bishop: DIAGONAL_DIRECTIONS, Queen: ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS}
+
+
+def is_aligned(a: tuple[int, int], b: tuple[int, int]) -> bool:
+    # on the same row, column or diagonal
+    return a[0] == b[0] or a[1] == b[1] or abs(a[0] - b[0]) == abs(a[1] - b[1])
+
+
+def square_name(square: tuple[int, int]) -> str:
+    return FILES[square[1]] + str(8 - square[0])
+
+
+def square_from_name(name: str) -> tuple[int, int]:
+    if len(name) != 2 or name[0] not in FILES or name[1] not in '12345678':
+        raise ValueError(f'Invalid square: {name}')
+    return 8 - int(name[1]), FILES.index(name[0])
+
+
 class ChessBoard:
     SIZE = 8
 
@@ -31,8 +93,15 @@ class ChessBoard:
             [Rook(Color.White), Knight(Color.White), Bishop(Color.White), self.white_king, Queen(Color.White), Bishop(Color.White), Knight(Color.White), Rook(Color.White)]
         ]
         self.winner: Color | None = None
-        self.moves: list[str] = []
+        self.moves: list[str] = []  # in SAN
         self._turn: Color = Color.White
+        self.en_passant: tuple[int, int] | None = None  # square passed by a pawn which has just made a double move
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        # how many pieces of each color attack every square; kept up to date by set_square
+        self._attacks: dict[Color, list[list[int]]] = {}
+        self._king_squares: dict[Color, tuple[int, int]] = {}
+        self.rebuild_attacks()
 
     @property
     def board(self):
@@ -42,50 +111,153 @@ class ChessBoard:
     def turn(self):
         return self._turn
 
-    def move(self, old_pos: tuple[int, int], new_pos: tuple[int, int]) -> tuple[MoveType, CheckState]:
+    def move(self, old_pos: tuple[int, int], new_pos: tuple[int, int], promotion: type[Piece] | None = None,
+             legal: bool = False) -> tuple[MoveType, CheckState]:
+        """
+        Pawns reaching the last rank are promoted to promotion, a queen by default.
+        legal skips the legality check for moves already known to be legal (e.g. from LegalMoveCache).
+        """
         if not is_inside_board(new_pos):
             return MoveType.InvalidMove, CheckState.NoCheck
         old_pos_piece = self._board[old_pos[0]][old_pos[1]]
         new_pos_piece = self._board[new_pos[0]][new_pos[1]]
-        if old_pos_piece.color == self._turn and self.validate_move_legality(old_pos, new_pos):
-            move_type = self.perform_move(old_pos, new_pos)
+        if old_pos_piece.color == self._turn and (legal or self.validate_move_legality(old_pos, new_pos)):
+            san = self.san(old_pos, new_pos, promotion)
+            move_type = self.perform_move(old_pos, new_pos, promotion)
             enemy_king = self.white_king if old_pos_piece.color == Color.Black else self.black_king
             check_state = self.get_check_state(enemy_king)  # self.find_king(enemy_king)
             if check_state == CheckState.Checkmate:
                 self.winner = Color.White if enemy_king.color == Color.Black else Color.Black
+            self.moves.append(san + CHECK_SUFFIXES[check_state])
+            if self._turn == Color.Black:
+                self.fullmove_number += 1
             self._turn = Color.Black if self._turn == Color.White else Color.White  # another person's turn
             return move_type, check_state
         else:
             return MoveType.InvalidMove, CheckState.NoCheck
 
-    def perform_move(self, old, new) -> MoveType:
+    def perform_move(self, old, new, promotion: type[Piece] | None = None) -> MoveType:
         """
         Special moves (something else happens, apart from making move, flag change etc.):
         king - castling
-        pawn - first (double) move
+        pawn - first (double) move, en passant, promotion
         """
         old_pos_piece = self._board[old[0]][old[1]]
+        move_type = MoveType.Move if isinstance(self._board[new[0]][new[1]], EmptyPiece) else MoveType.Take
+        en_passant = None
+        pawn_move = isinstance(old_pos_piece, Pawn)
 
-        if isinstance(old_pos_piece, Pawn):
+        if pawn_move:
             # pawn made its first move
             old_pos_piece.was_moved = True
-        elif isinstance(old_pos_piece, King) and new in old_pos_piece.castling_moves().keys():
+            if self.is_en_passant(old, new):
+                self.set_square((old[0], new[1]), EmptyPiece())
+                move_type = MoveType.Take
+            elif abs(new[0] - old[0]) == 2:
+                en_passant = ((old[0] + new[0]) // 2, old[1])
+            if new[0] in (0, self.SIZE - 1):
+                old_pos_piece = (promotion or Queen)(old_pos_piece.color)
+        elif isinstance(old_pos_piece, Rook):
+            # rook which has moved cannot castle anymore
+            old_pos_piece.can_castle = False
+        elif isinstance(old_pos_piece, King) and old_pos_piece.can_castle and new in old_pos_piece.castling_moves().keys():
             # king makes castling - rook has to move
             rook_positions = old_pos_piece.castling_moves()[new]
             rook_old_pos, rook_new_pos = rook_positions[0], rook_positions[1]
             rook = self._board[rook_old_pos[0]][rook_old_pos[1]]
-            self._board[rook_old_pos[0]][rook_old_pos[1]] = EmptyPiece()
-            self._board[rook_new_pos[0]][rook_new_pos[1]] = rook
-            old_pos_piece.can_castle = False
+            self.set_square(rook_old_pos, EmptyPiece())
+            self.set_square(rook_new_pos, rook)
             rook.can_castle = False
             move_type = MoveType.Castle
+        if isinstance(old_pos_piece, King):
+            old_pos_piece.can_castle = False
 
-        move_type = MoveType.Move if isinstance(self._board[new[0]][new[1]], EmptyPiece) else MoveType.Take
-        self._board[new[0]][new[1]] = old_pos_piece
-        self._board[old[0]][old[1]] = EmptyPiece()
+        self.en_passant = en_passant
+        self.halfmove_clock = 0 if pawn_move or move_type == MoveType.Take else self.halfmove_clock + 1
+        self.set_square(new, old_pos_piece)
+        self.set_square(old, EmptyPiece())
 
         return move_type
 
+    def set_square(self, square: tuple[int, int], piece: Piece) -> None:
+        """
+        Every change of the board goes through here, so the attack maps stay up to date: attacks of the removed
+        piece are taken away, those of the placed one added, and rays of sliders passing through the square
+        are cut or extended when the square gets occupied or empty.
+        """
+        i, j = square
+        removed = self._board[i][j]
+        if not isinstance(removed, EmptyPiece):
+            self.add_attacks(removed, i, j, -1)
+        if isinstance(removed, EmptyPiece) != isinstance(piece, EmptyPiece):
+            self.update_rays_through(i, j, 1 if isinstance(piece, EmptyPiece) else -1)
+        self._board[i][j] = piece
+        if not isinstance(piece, EmptyPiece):
+            self.add_attacks(piece, i, j, 1)
+            if isinstance(piece, King):
+                self._king_squares[piece.color] = square
+
+    def attacked_squares(self, piece: Piece, i: int, j: int) -> list[tuple[int, int]]:
+        match piece:
+            case Pawn():
+                return piece.possible_takes(i, j)
+            case Knight() | King():
+                return piece.possible_moves(i, j)
+            case EmptyPiece():
+                return []
+        squares = []
+        for di, dj in SLIDER_DIRECTIONS[type(piece)]:
+            ni, nj = i + di, j + dj
+            while 0 <= ni < self.SIZE and 0 <= nj < self.SIZE:
+                squares.append((ni, nj))
+                if not isinstance(self._board[ni][nj], EmptyPiece):
+                    break
+                ni, nj = ni + di, nj + dj
+        return squares
+
+    def add_attacks(self, piece: Piece, i: int, j: int, delta: int) -> None:
+        counts = self._attacks[piece.color]
+        for ai, aj in self.attacked_squares(piece, i, j):
+            counts[ai][aj] += delta
+
+    def update_rays_through(self, i: int, j: int, delta: int) -> None:
+        # delta is 1 when the square gets empty (rays through it go further) and -1 when it gets occupied
+        for di, dj in ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS:
+            ni, nj = i + di, j + dj
+            while 0 <= ni < self.SIZE and 0 <= nj < self.SIZE and isinstance(self._board[ni][nj], EmptyPiece):
+                ni, nj = ni + di, nj + dj
+            if not (0 <= ni < self.SIZE and 0 <= nj < self.SIZE):
+                continue
+            slider = self._board[ni][nj]
+            if (di, dj) not in SLIDER_DIRECTIONS.get(type(slider), ()):
+                continue
+            # the slider looks at the square from the opposite direction - its ray continues behind the square
+            counts = self._attacks[slider.color]
+            ni, nj = i - di, j - dj
+            while 0 <= ni < self.SIZE and 0 <= nj < self.SIZE:
+                counts[ni][nj] += delta
+                if not isinstance(self._board[ni][nj], EmptyPiece):
+                    break
+                ni, nj = ni - di, nj - dj
+
+    def rebuild_attacks(self) -> None:
+        self._attacks = {color: [[0] * self.SIZE for _ in range(self.SIZE)] for color in (Color.White, Color.Black)}
+        for i, line in enumerate(self._board):
+            for j, piece in enumerate(line):
+                if not isinstance(piece, EmptyPiece):
+                    self.add_attacks(piece, i, j, 1)
+                    if isinstance(piece, King):
+                        self._king_squares[piece.color] = (i, j)
+
+    def is_attacked(self, square: tuple[int, int], by: Color) -> bool:
+        return self._attacks[by][square[0]][square[1]] > 0
+
+    def is_en_passant(self, old: tuple[int, int], new: tuple[int, int]) -> bool:
+        piece = self._board[old[0]][old[1]]
+        taken = self._board[old[0]][new[1]]
+        return (isinstance(piece, Pawn) and new == self.en_passant and old[1] != new[1] and
+                isinstance(taken, Pawn) and taken.color != piece.color)
+
     def validate_move_legality(self, old: tuple[int, int], new: tuple[int, int]) -> bool:
         piece = self._board[old[0]][old[1]]
         new_pos_piece = self._board[new[0]][new[1]]
@@ -95,10 +267,10 @@ class ChessBoard:
         if isinstance(piece, Pawn):
             # here whole pawn logic is handled, because its moves are different tha the rest of the pieces
             if ((not piece.was_moved and new == piece.first_move(*old) and isinstance(new_pos_piece, EmptyPiece) and isinstance(self._board[old[0]+(1 if piece.color == Color.Black else -1)][old[1]], EmptyPiece)) or # TODO +1 albo -1 dla self._board[old[0]+1][old[1]]
-            (new in piece.possible_takes(*old) and not isinstance(new_pos_piece, EmptyPiece) and new_pos_piece != piece.color) or
+            (new in piece.possible_takes(*old) and not isinstance(new_pos_piece, EmptyPiece) and new_pos_piece.color != piece.color) or
+            (new in piece.possible_takes(*old) and self.is_en_passant(old, new)) or
             (new in piece.possible_moves(*old) and isinstance(new_pos_piece, EmptyPiece))):
                 return not self.move_causes_selfcheck(old, new)
-            # TODO add en_passant
             else:
                 return False
         elif new in piece.possible_moves(*old):
@@ -112,7 +284,9 @@ class ChessBoard:
             rook = self._board[rook_pos[0][0]][rook_pos[0][1]] if rook_pos else None
             rook = rook if isinstance(rook, Rook) else None
             if rook and rook.can_castle and piece.can_castle and self.free_path_between(old, rook_pos[0]) and self.get_check_state(piece, verify_checkmate=False) == CheckState.NoCheck:
-                return not self.move_causes_selfcheck(old, new)
+                # the king cannot pass through an attacked square either
+                passed = (old[0], (old[1] + new[1]) // 2)
+                return not self.move_causes_selfcheck(old, passed) and not self.move_causes_selfcheck(old, new)
             return False
 
     def free_path_between(self, old: tuple[int, int], new: tuple[int, int]):
@@ -132,62 +306,288 @@ class ChessBoard:
 
     def move_causes_selfcheck(self, old: tuple[int, int], new: tuple[int, int]) -> bool:
         piece = self._board[old[0]][old[1]]
-        new_pos_piece = self._board[new[0]][new[1]]
-        self._board[new[0]][new[1]] = piece
-        self._board[old[0]][old[1]] = EmptyPiece()
         king = self.white_king if piece.color == Color.White else self.black_king
-        selfcheck = False
-        if self.get_check_state(king, verify_checkmate=False) != CheckState.NoCheck:  # self.find_king(king)
-            selfcheck = True
-        self._board[new[0]][new[1]] = new_pos_piece
-        self._board[old[0]][old[1]] = piece
+        enemy = Color.Black if piece.color == Color.White else Color.White
+        king_pos = self.find_king(king)
+        en_passant = self.is_en_passant(old, new)
+        in_check = self.is_attacked(king_pos, enemy)
+        if not in_check:
+            # no ray goes through the king, so the attack maps are exact for its moves
+            if piece is king:
+                return self.is_attacked(new, enemy)
+            # a piece which is not in line with its king cannot uncover it
+            if not en_passant and not is_aligned(king_pos, old):
+                return False
+        new_pos_piece = self._board[new[0]][new[1]]
+        taken_pawn = self._board[old[0]][new[1]]
+        if en_passant:
+            self.set_square((old[0], new[1]), EmptyPiece())
+        self.set_square(new, piece)
+        self.set_square(old, EmptyPiece())
+        selfcheck = self.is_attacked(new if piece is king else king_pos, enemy)
+        self.set_square(old, piece)
+        self.set_square(new, new_pos_piece)
+        if en_passant:
+            self.set_square((old[0], new[1]), taken_pawn)
         return selfcheck
 
     def get_check_state(self, king: King, verify_checkmate=True) -> CheckState:
-        king_pos = self.find_king(king)
-        #king = self._board[king_pos[0]][king_pos[1]]
-        for i, line in enumerate(self._board):
-            for j, piece in enumerate(line):
-                if piece.color != king.color:
-                    if ((isinstance(piece, Knight) and king_pos in piece.possible_moves(i, j)) or
-                    (not isinstance(piece, Pawn) and king_pos in filter(lambda new: self.free_path_between((i, j), new), piece.possible_moves(i, j))) or
-                    (isinstance(piece, Pawn) and king_pos in piece.possible_takes(i, j))):
-                        if verify_checkmate and self.is_checkmate(king):
-                            return CheckState.Checkmate
-                        return CheckState.Check
+        if self.is_attacked(self.find_king(king), Color.Black if king.color == Color.White else Color.White):
+            if verify_checkmate and self.is_checkmate(king):
+                return CheckState.Checkmate
+            return CheckState.Check
         return CheckState.NoCheck
 
     def is_checkmate(self, king: King) -> bool:
-        #king = self._board[king_pos[0]][king_pos[1]]
-        #possible_moves = king.possible_moves(king_pos[0], king_pos[1])
+        # legal moves never leave the own king in check, so any of them defends the king
         for i, line in enumerate(self._board):
             for j, piece in enumerate(line):
                 if piece.color != king.color:
-                    # we check only if other pieces including king can defend king from checkmate
                     continue
-                possible_moves = piece.possible_moves(i, j)
-                if isinstance(piece, Pawn):
-                    possible_moves.extend(piece.possible_takes(i, j))
-                for move_i, move_j in possible_moves:
-                    if self.validate_move_legality((i, j), (move_i, move_j)):  # isinstance(self._board[move_i][move_j], EmptyPiece):
-                        new_pos_piece = self._board[move_i][move_j]
-                        self._board[i][j] = EmptyPiece()
-                        self._board[move_i][move_j] = piece
-                        if self.get_check_state(king, verify_checkmate=False) == CheckState.NoCheck:
-                            self._board[i][j] = piece
-                            self._board[move_i][move_j] = new_pos_piece
-                            return False
-                        self._board[i][j] = piece
-                        self._board[move_i][move_j] = new_pos_piece
+                for new in self.candidate_moves(piece, i, j):
+                    if self.validate_move_legality((i, j), new):
+                        return False
         return True
 
+    def legal_moves(self, color: Color | None = None) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+        color = self._turn if color is None else color
+        moves = []
+        for i, line in enumerate(self._board):
+            for j, piece in enumerate(line):
+                if piece.color == color:
+                    moves.extend(((i, j), new) for new in self.legal_targets((i, j)))
+        return moves
+
+    def legal_targets(self, square: tuple[int, int]) -> list[tuple[int, int]]:
+        piece = self._board[square[0]][square[1]]
+        return [new for new in self.candidate_moves(piece, *square) if self.validate_move_legality(square, new)]
+
+    @staticmethod
+    def candidate_moves(piece: Piece, i: int, j: int) -> list[tuple[int, int]]:
+        # every square the piece could reach on an empty board - legality is checked separately
+        candidates = piece.possible_moves(i, j)
+        if isinstance(piece, Pawn):
+            candidates.extend(piece.possible_takes(i, j))
+            if not piece.was_moved and is_inside_board(piece.first_move(i, j)):
+                candidates.append(piece.first_move(i, j))
+        elif isinstance(piece, King):
+            candidates.extend(move for move in piece.castling_moves().keys() if move not in candidates)
+        return candidates
+
     def find_king(self, king: King) -> tuple[int, int]:
+        square = self._king_squares.get(king.color)
+        if square is not None and self._board[square[0]][square[1]] is king:
+            return square
         for i in range(self.SIZE):
             for j in range(self.SIZE):
                 if self._board[i][j] == king:
                     return i, j
         raise ValueError('There is no king on the board')
 
+    def position(self) -> bytes:
+        position = bytearray(POSITION_SIZE)
+        for i, line in enumerate(self._board):
+            for j, piece in enumerate(line):
+                position[i * self.SIZE + j] = piece_code(piece)
+        position[FLAGS_INDEX] = self.castling_flags() | (BLACK_TO_MOVE if self._turn == Color.Black else 0)
+        position[EN_PASSANT_INDEX] = self.en_passant[1] + 1 if self.en_passant else 0
+        return bytes(position)
+
+    def castling_flags(self) -> int:
+        flags = 0
+        for (i, j), flag in CASTLING_FLAGS.items():
+            rook = self._board[i][j]
+            king = self.white_king if i == self.SIZE - 1 else self.black_king
+            if isinstance(rook, Rook) and rook.color == king.color and rook.can_castle and king.can_castle:
+                flags |= flag
+        return flags
+
+    def set_position(self, position: bytes) -> None:
+        # the board is changed in place, so references to self.board stay valid
+        if len(position) != POSITION_SIZE:
+            raise ValueError(f'Position has to be {POSITION_SIZE} bytes long')
+        flags = position[FLAGS_INDEX]
+        for i in range(self.SIZE):
+            for j in range(self.SIZE):
+                piece = piece_from_code(position[i * self.SIZE + j])
+                if isinstance(piece, Pawn):
+                    # pawns never move back, so a pawn outside its starting row has moved
+                    piece.was_moved = i != (1 if piece.color == Color.Black else 6)
+                elif isinstance(piece, Rook):
+                    piece.can_castle = bool(flags & CASTLING_FLAGS.get((i, j), 0))
+                elif isinstance(piece, King):
+                    castling_row = self.SIZE - 1 if piece.color == Color.White else 0
+                    piece.can_castle = any(flags & flag for (row, _), flag in CASTLING_FLAGS.items() if row == castling_row)
+                    if piece.color == Color.White:
+                        self.white_king = piece
+                    else:
+                        self.black_king = piece
+                self._board[i][j] = piece
+        self.rebuild_attacks()
+        self._turn = Color.Black if flags & BLACK_TO_MOVE else Color.White
+        # the pawn which can be taken en passant belongs to the player who has just moved
+        en_passant_column = position[EN_PASSANT_INDEX] - 1
+        self.en_passant = None if en_passant_column < 0 else (5 if self._turn == Color.Black else 2, en_passant_column)
+        self.winner = None
+
+    @classmethod
+    def from_position(cls, position: bytes) -> 'ChessBoard':
+        chess_board = cls()
+        chess_board.set_position(position)
+        return chess_board
+
+    def fen(self) -> str:
+        rows = []
+        for line in self._board:
+            row = ''
+            empty = 0
+            # FEN lists the squares from the a file, which is the last column
+            for piece in reversed(line):
+                if isinstance(piece, EmptyPiece):
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                letter = PIECE_LETTERS[type(piece)]
+                row += letter if piece.color == Color.White else letter.lower()
+            rows.append(row + (str(empty) if empty else ''))
+        flags = self.castling_flags()
+        castling = ''.join(letter for square, letter in CASTLING_LETTERS.items() if flags & CASTLING_FLAGS[square])
+        return ' '.join(['/'.join(rows), 'w' if self._turn == Color.White else 'b', castling or '-',
+                         square_name(self.en_passant) if self.en_passant else '-',
+                         str(self.halfmove_clock), str(self.fullmove_number)])
+
+    def set_fen(self, fen: str) -> None:
+        fields = fen.split()
+        if len(fields) < 4 or len(fields[0].split('/')) != self.SIZE:
+            raise ValueError(f'Invalid FEN: {fen}')
+        position = bytearray(POSITION_SIZE)
+        for i, row in enumerate(fields[0].split('/')):
+            squares = []
+            for letter in row:
+                if letter.isdigit():
+                    squares.extend([0] * int(letter))
+                elif letter.upper() in LETTER_PIECES:
+                    code = PIECE_CODES[LETTER_PIECES[letter.upper()]]
+                    squares.append(code if letter.isupper() else code | BLACK_PIECE)
+                else:
+                    raise ValueError(f'Invalid FEN: {fen}')
+            if len(squares) != self.SIZE:
+                raise ValueError(f'Invalid FEN: {fen}')
+            position[i * self.SIZE:(i + 1) * self.SIZE] = bytes(reversed(squares))
+        flags = BLACK_TO_MOVE if fields[1] == 'b' else 0
+        for square, letter in CASTLING_LETTERS.items():
+            if letter in fields[2]:
+                flags |= CASTLING_FLAGS[square]
+        position[FLAGS_INDEX] = flags
+        if fields[3] != '-':
+            position[EN_PASSANT_INDEX] = square_from_name(fields[3])[1] + 1
+        self.set_position(bytes(position))
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+        self.moves = []
+
+    @classmethod
+    def from_fen(cls, fen: str) -> 'ChessBoard':
+        chess_board = cls()
+        chess_board.set_fen(fen)
+        return chess_board
+
+    def san(self, old: tuple[int, int], new: tuple[int, int], promotion: type[Piece] | None = None) -> str:
+        """
+        Standard algebraic notation of a legal move, without the check suffix - it is known after the move.
+        """
+        piece = self._board[old[0]][old[1]]
+        if isinstance(piece, King) and abs(new[1] - old[1]) == 2:
+            return 'O-O' if new[1] < old[1] else 'O-O-O'
+        takes = not isinstance(self._board[new[0]][new[1]], EmptyPiece) or self.is_en_passant(old, new)
+        if isinstance(piece, Pawn):
+            san = (FILES[old[1]] + 'x' if takes else '') + square_name(new)
+            if new[0] in (0, self.SIZE - 1):
+                san += '=' + PIECE_LETTERS[promotion or Queen]
+            return san
+        # other pieces of the same type which could move there too
+        rivals = [(i, j) for i, line in enumerate(self._board) for j, other in enumerate(line)
+                  if other is not piece and type(other) is type(piece) and other.color == piece.color and
+                  self.validate_move_legality((i, j), new)]
+        origin = ''
+        if rivals:
+            if all(j != old[1] for _, j in rivals):
+                origin = FILES[old[1]]
+            elif all(i != old[0] for i, _ in rivals):
+                origin = str(8 - old[0])
+            else:
+                origin = square_name(old)
+        return PIECE_LETTERS[type(piece)] + origin + ('x' if takes else '') + square_name(new)
+
+    def parse_san(self, san: str) -> tuple[tuple[int, int], tuple[int, int], type[Piece] | None]:
+        """
+        Finds the move of the player to move written in standard algebraic notation.
+        """
+        text = san.rstrip('+#!?')
+        king = self.white_king if self._turn == Color.White else self.black_king
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            old = self.find_king(king)
+            new = (old[0], old[1] - 2 if len(text) == 3 else old[1] + 2)
+            if not self.validate_move_legality(old, new):
+                raise ValueError(f'Illegal move: {san}')
+            return old, new, None
+        promotion = None
+        if '=' in text:
+            text, letter = text.split('=', 1)
+            promotion = LETTER_PIECES.get(letter)
+        elif text[-1:] in 'QRBN' and len(text) > 2 and text[-2] in '18':
+            # promotion written without '='
+            promotion = LETTER_PIECES[text[-1]]
+            text = text[:-1]
+        if promotion is not None and promotion not in PROMOTIONS:
+            raise ValueError(f'Invalid promotion: {san}')
+        piece_type = LETTER_PIECES.get(text[0], Pawn) if text[:1].isupper() else Pawn
+        if piece_type is not Pawn:
+            text = text[1:]
+        new = square_from_name(text[-2:])
+        hint = text[:-2].replace('x', '')
+        candidates = []
+        for i, line in enumerate(self._board):
+            for j, piece in enumerate(line):
+                if (type(piece) is not piece_type or piece.color != self._turn or
+                        any(FILES[j] != c if c in FILES else str(8 - i) != c for c in hint)):
+                    continue
+                if self.validate_move_legality((i, j), new):
+                    candidates.append((i, j))
+        if len(candidates) != 1:
+            raise ValueError(f'{"Ambiguous" if candidates else "Illegal"} move: {san}')
+        return candidates[0], new, promotion
+
+
+class LegalMoveCache:
+    """
+    Legal targets of pieces per position (ChessBoard.position()). The targets of a piece are computed the first
+    time it is picked up in that position; the least recently used positions are evicted.
+    """
+
+    def __init__(self, capacity: int = LEGAL_MOVE_CACHE_SIZE) -> None:
+        self._capacity = capacity
+        self._positions: OrderedDict[bytes, dict[tuple[int, int], frozenset[tuple[int, int]]]] = OrderedDict()
+
+    def targets(self, chess_board: ChessBoard, square: tuple[int, int]) -> frozenset[tuple[int, int]]:
+        key = chess_board.position()
+        squares = self._positions.get(key)
+        if squares is None:
+            squares = self._positions[key] = {}
+            if len(self._positions) > self._capacity:
+                self._positions.popitem(last=False)
+        else:
+            self._positions.move_to_end(key)
+        targets = squares.get(square)
+        if targets is None:
+            targets = squares[square] = frozenset(chess_board.legal_targets(square))
+        return targets
+
+    def clear(self) -> None:
+        self._positions.clear()
+
 
 # class Board(list):
 #     def __getitem__(self, key):
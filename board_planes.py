@@ -0,0 +1,204 @@
+import time
+import logging
+import argparse
+from typing import Iterable
+
+import numpy as np
+
+from board import *
+from engine import PIECE_VALUES, PIECE_SQUARE_TABLES
+from game_snapshot import GameSnapshot
+from move_archive import read_games
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+# one plane per piece code: white pawn, knight, bishop, rook, queen, king, then the black ones
+PIECE_ORDER = (Pawn, Knight, Bishop, Rook, Queen, King)
+PLANE_CODES = np.array([PIECE_CODES[piece_type] | color for color in (0, BLACK_PIECE) for piece_type in PIECE_ORDER],
+                       dtype=np.uint8)
+PLANES = len(PLANE_CODES)
+WHITE_PLANES = slice(0, 6)
+BLACK_PLANES = slice(6, 12)
+PAWN_PLANE, KNIGHT_PLANE, BISHOP_PLANE, ROOK_PLANE, QUEEN_PLANE, KING_PLANE = range(6)
+
+KNIGHT_STEPS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+BISHOP_STEPS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+ROOK_STEPS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+KING_STEPS = BISHOP_STEPS + ROOK_STEPS
+
+MOBILITY_WEIGHT = 4
+KING_ATTACK_WEIGHT = 10
+PAWN_SHIELD_WEIGHT = 8
+
+
+def build_square_scores() -> np.ndarray:
+    # the engine's material and piece-square scores per plane; black planes count negative
+    scores = np.zeros((PLANES, ChessBoard.SIZE, ChessBoard.SIZE), dtype=np.int32)
+    for plane in range(6):
+        code = int(PLANE_CODES[plane])
+        # the tables go from the eighth rank and from the a file, the columns of the board from the h file
+        table = np.array(PIECE_SQUARE_TABLES[code], dtype=np.int32).reshape(8, 8)[:, ::-1]
+        scores[plane] = PIECE_VALUES[code] + table
+        scores[plane + 6] = -(PIECE_VALUES[code] + table[::-1])
+    return scores
+
+
+SQUARE_SCORES = build_square_scores()
+MATERIAL = np.array([PIECE_VALUES[PIECE_CODES[piece_type]] for piece_type in PIECE_ORDER] * 2, dtype=np.int32) * \
+           np.repeat(np.array([1, -1], dtype=np.int32), 6)
+
+
+def positions_array(positions: Iterable[bytes]) -> np.ndarray:
+    """
+    Stacks compact positions (ChessBoard.position()) into an N x POSITION_SIZE array without decoding them.
+    """
+    data = b''.join(positions)
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, POSITION_SIZE)
+
+
+def to_planes(positions: np.ndarray) -> np.ndarray:
+    # N x 12 x 8 x 8 booleans, planes ordered like PLANE_CODES
+    codes = positions[:, :ChessBoard.SIZE * ChessBoard.SIZE].reshape(-1, 1, ChessBoard.SIZE, ChessBoard.SIZE)
+    return codes == PLANE_CODES.reshape(1, PLANES, 1, 1)
+
+
+def board_planes(chess_board: ChessBoard) -> np.ndarray:
+    return to_planes(positions_array([chess_board.position()]))[0]
+
+
+def to_bitboards(planes: np.ndarray) -> np.ndarray:
+    # N x 12 unsigned 64 bit integers; bit i * 8 + j is the square (i, j)
+    packed = np.packbits(planes.reshape(len(planes), PLANES, 64), axis=2, bitorder='little')
+    return packed.view('<u8').reshape(len(planes), PLANES)
+
+
+def game_positions(moves) -> np.ndarray:
+    # every position of an archived game, from the initial one to the last; replayed on the compact position
+    snapshot = GameSnapshot()
+    positions = [snapshot.position]
+    for old, new in moves:
+        snapshot.apply_move((tuple(old), tuple(new)))
+        positions.append(snapshot.position)
+    return positions_array(positions)
+
+
+def archive_positions(archive_path: str) -> np.ndarray:
+    batches = []
+    for name, moves in read_games(archive_path):
+        try:
+            batches.append(game_positions(moves))
+        except (ValueError, TypeError) as e:
+            logging.warning('skipping archived game %s: %s', name, e)
+    if not batches:
+        return np.empty((0, POSITION_SIZE), dtype=np.uint8)
+    return np.concatenate(batches)
+
+
+# squares of the columns which stay on the board after a step of dj columns
+COLUMN_MASKS = {dj: np.uint64(sum(1 << (i * 8 + j) for i in range(8) for j in range(8) if 0 <= j + dj < 8))
+                for dj in range(-2, 3)}
+
+
+def shift(bitboards: np.ndarray, di: int, dj: int) -> np.ndarray:
+    # moves every square by (di, dj); squares leaving the board are dropped
+    offset = di * ChessBoard.SIZE + dj
+    masked = bitboards & COLUMN_MASKS[dj]
+    return masked << np.uint64(offset) if offset > 0 else masked >> np.uint64(-offset)
+
+
+def count_bits(bitboards: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bitboards).astype(np.int32)
+    return np.unpackbits(bitboards.view(np.uint8).reshape(*bitboards.shape, 8), axis=-1).sum(axis=-1, dtype=np.int32)
+
+
+def attacks(bitboards: np.ndarray, side: slice) -> np.ndarray:
+    """
+    Squares attacked by one side, one bitboard per position. Sliding attacks are extended one step at a time
+    for the whole batch.
+    """
+    pieces = bitboards[:, side]
+    empty = ~np.bitwise_or.reduce(bitboards, axis=1)
+    pawn_forward = -1 if side == WHITE_PLANES else 1
+    attacked = shift(pieces[:, PAWN_PLANE], pawn_forward, -1) | shift(pieces[:, PAWN_PLANE], pawn_forward, 1)
+    for di, dj in KNIGHT_STEPS:
+        attacked |= shift(pieces[:, KNIGHT_PLANE], di, dj)
+    for di, dj in KING_STEPS:
+        attacked |= shift(pieces[:, KING_PLANE], di, dj)
+    for sliders, steps in ((pieces[:, BISHOP_PLANE] | pieces[:, QUEEN_PLANE], BISHOP_STEPS),
+                           (pieces[:, ROOK_PLANE] | pieces[:, QUEEN_PLANE], ROOK_STEPS)):
+        for di, dj in steps:
+            ray = shift(sliders, di, dj)
+            for _ in range(ChessBoard.SIZE - 1):
+                attacked |= ray
+                ray = shift(ray & empty, di, dj)
+    return attacked
+
+
+def material(planes: np.ndarray) -> np.ndarray:
+    # white minus black, in centipawns
+    return np.einsum('npij,p->n', planes, MATERIAL, dtype=np.int32)
+
+
+def piece_square(planes: np.ndarray) -> np.ndarray:
+    # material and piece-square tables, the same score as the engine's static evaluation from white's point of view
+    return np.einsum('npij,pij->n', planes, SQUARE_SCORES, dtype=np.int32)
+
+
+def mobility(bitboards: np.ndarray) -> np.ndarray:
+    # squares attacked and not occupied by own pieces, white minus black
+    white = attacks(bitboards, WHITE_PLANES) & ~np.bitwise_or.reduce(bitboards[:, WHITE_PLANES], axis=1)
+    black = attacks(bitboards, BLACK_PLANES) & ~np.bitwise_or.reduce(bitboards[:, BLACK_PLANES], axis=1)
+    return count_bits(white) - count_bits(black)
+
+
+def king_zone(king: np.ndarray) -> np.ndarray:
+    zone = king.copy()
+    for di, dj in KING_STEPS:
+        zone |= shift(king, di, dj)
+    return zone
+
+
+def king_safety(bitboards: np.ndarray) -> np.ndarray:
+    """
+    Attacked squares around each king and own pawns in front of it, as a score from white's point of view.
+    """
+    scores = np.zeros(len(bitboards), dtype=np.int32)
+    for side, enemy, forward, sign in ((WHITE_PLANES, BLACK_PLANES, -1, 1), (BLACK_PLANES, WHITE_PLANES, 1, -1)):
+        king = bitboards[:, side][:, KING_PLANE]
+        attacked = count_bits(king_zone(king) & attacks(bitboards, enemy))
+        front = shift(king, forward, 0)
+        shield = count_bits((front | shift(front, 0, -1) | shift(front, 0, 1)) & bitboards[:, side][:, PAWN_PLANE])
+        scores += sign * (PAWN_SHIELD_WEIGHT * shield - KING_ATTACK_WEIGHT * attacked)
+    return scores
+
+
+def evaluate(planes: np.ndarray) -> np.ndarray:
+    bitboards = to_bitboards(planes)
+    return piece_square(planes) + MOBILITY_WEIGHT * mobility(bitboards) + king_safety(bitboards)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate every position of the archived games')
+    parser.add_argument('archive', help='archive directory or file')
+    parser.add_argument('--batch', type=int, default=65536, help='positions evaluated at once')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    positions = archive_positions(args.archive)
+    loaded = time.perf_counter()
+    totals = {'material': 0, 'piece_square': 0, 'mobility': 0, 'king_safety': 0}
+    for start in range(0, len(positions), args.batch):
+        planes = to_planes(positions[start:start + args.batch])
+        bitboards = to_bitboards(planes)
+        for name, scores in (('material', material(planes)), ('piece_square', piece_square(planes)),
+                             ('mobility', mobility(bitboards)), ('king_safety', king_safety(bitboards))):
+            totals[name] += int(scores.sum(dtype=np.int64))
+    finished = time.perf_counter()
+    logging.info('%d positions loaded in %.2f s, evaluated in %.2f s', len(positions), loaded - started, finished - loaded)
+    for name, total in totals.items():
+        print(f'{name}: {total / max(1, len(positions)):.1f} on average for white')
+
+
+if __name__ == '__main__':
+    main()
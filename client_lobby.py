@@ -1,24 +1,28 @@
 import traceback
 
-import socket
 import sys
+import pickle
 import logging
 import threading
 
 from PyQt5.QtWidgets import *
 from PyQt5 import uic
-from PyQt5.QtCore import QCoreApplication, QMetaObject, Qt, Q_ARG, pyqtSlot
+from PyQt5.QtCore import QCoreApplication, QMetaObject, Qt, Q_ARG, pyqtSlot, QAbstractListModel, QModelIndex
 import os
 import datetime as dt
 
-from server_lobby import *
-from game_client import *
+from board import *
+from serialize import *
+from lobby_operation import *
 from networking import *
-from move_analyzer import *
+from session import *
+from server_network_constants import *
+from event_log import *
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 ARCHIVE_PATH = '.\\archive'
+GAME_INFO_ROLE = Qt.UserRole
 
 
 class LobbyWindow(QMainWindow):
@@ -30,26 +34,38 @@ class LobbyWindow(QMainWindow):
         self.show()
         self.setFixedSize(self.size())
 
+        self._game_model = GameListModel(self)
+        self.game_list.setModel(self._game_model)
+        # updates from the listening thread are queued and applied in the GUI thread in batches
+        self._game_list_updates: list[tuple[OperationType, list[GameInfo]]] = []
+        self._game_list_update_scheduled = False
+        self._updates_lock = threading.Lock()
+
         self.join_button.clicked.connect(self.join_button_clicked)
         self.create_button.clicked.connect(self.create_game)
-        self.game_list.model().rowsInserted.connect(self.check_game_list_and_nickname)
-        self.game_list.model().rowsRemoved.connect(self.check_game_list_and_nickname)
+        self.match_button.clicked.connect(self.match_button_clicked)
+        self._game_model.rowsInserted.connect(self.check_game_list_and_nickname)
+        self._game_model.rowsRemoved.connect(self.check_game_list_and_nickname)
+        self._game_model.modelReset.connect(self.check_game_list_and_nickname)
+        self.game_list.selectionModel().currentChanged.connect(self.check_game_list_and_nickname)
         # self.game_list.itemClicked.connect(self.game_list_clicked)
         self.game_name.textChanged.connect(self.game_name_or_nickname_changed)
         self.nickname.textChanged.connect(self.check_game_list_and_nickname)
         self.nickname.textChanged.connect(self.game_name_or_nickname_changed)
+        self.nickname.textChanged.connect(self.update_match_button)
         self.browse_button.clicked.connect(self.choose_file)
         self.accept_button.clicked.connect(self.game_analysis)
 
-        socket_ = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         logging.info('Connecting to a lobby server...')
-        socket_.connect(server_socket)
-        self._server_socket = Socket(socket_, server_socket)
+        # the lobby and every game of this client share one connection
+        self._session = Session.connect(server_socket)
+        self._server_socket = Socket(self._session.lobby, server_socket)
         self._client_connected = True
         logging.info('Connected to lobby server')
 
         self._my_game_info = None
         self._my_game_client = None
+        self._matchmaking = False
         self._available_port_number = GAME_SERVER_FIRST_PORT
 
         self._listen_server_thread = threading.Thread(target=self.listen_server_operations)
@@ -61,11 +77,13 @@ class LobbyWindow(QMainWindow):
         self.filepath.setText(filename)
 
     def game_analysis(self):
+        # pygame is loaded only when a game is shown
+        from move_analyzer import MoveAnalyzer
         moves = read_data_from_file(self.filepath.text())
         threading.Thread(target=MoveAnalyzer(moves).start_analysis())
 
     def join_button_clicked(self):
-        game_info: GameInfo = self.game_list.currentItem().game_info
+        game_info: GameInfo = self.game_list.currentIndex().data(GAME_INFO_ROLE)
         game_info.players_connected += 1
         self.join_game(game_info)
 
@@ -73,7 +91,33 @@ class LobbyWindow(QMainWindow):
     def join_game_in_main_thread(self, game_info: GameInfo):
         self.join_game(game_info)
 
-    def join_game(self, game_info: GameInfo):
+    @pyqtSlot(GameInfo)
+    def join_matched_game_in_main_thread(self, game_info: GameInfo):
+        # matched games are not on anyone's list - the lobby does not need to know that we joined
+        self.join_game(game_info, notify_lobby=False)
+
+    @pyqtSlot()
+    def matchmaking_rejected_in_main_thread(self):
+        self._matchmaking = False
+        self.update_match_button()
+
+    def match_button_clicked(self):
+        if self._matchmaking:
+            logging.info('Leaving matchmaking...')
+            self._server_socket.connection.sendall(send_data(LobbyOperation(OperationType.CancelMatchmaking, None)))
+        else:
+            game_time = self.game_time.time().minute() * 60
+            logging.info('Looking for an opponent for a %s s game...', game_time)
+            request = MatchRequest(self.nickname.text(), game_time)
+            self._server_socket.connection.sendall(send_data(LobbyOperation(OperationType.Matchmaking, request)))
+        self._matchmaking = not self._matchmaking
+        self.update_match_button()
+
+    def update_match_button(self):
+        self.match_button.setText('Cancel matching' if self._matchmaking else 'Quick match')
+        self.match_button.setEnabled(self._matchmaking or self.nickname.text() != '')
+
+    def join_game(self, game_info: GameInfo, notify_lobby: bool = True):
         logging.info('Joining new game...')
         self._client_connected = False
         logging.info('Stopped listening to server')
@@ -81,10 +125,12 @@ class LobbyWindow(QMainWindow):
         self.hide()
         logging.info('Hiding window...\nStarting the game client...')
 
-        logging.info('Sending info to server about joining to the game')
-        self._server_socket.connection.sendall(send_data(LobbyOperation(OperationType.JoinGame, game_info)))
-        logging.info('Info sent; Starting game client...')
-        self._my_game_client = GameClient(game_info.server_socket, self.nickname.text())
+        if notify_lobby:
+            logging.info('Sending info to server about joining to the game')
+            self._server_socket.connection.sendall(send_data(LobbyOperation(OperationType.JoinGame, game_info)))
+            logging.info('Info sent; Starting game client...')
+        from game_client import GameClient
+        self._my_game_client = GameClient(game_info.server_socket, self.nickname.text(), self._session)
         self._my_game_client.start_game()
         logging.info('Game has ended')
 
@@ -108,7 +154,7 @@ class LobbyWindow(QMainWindow):
         color = Color.White if self.white_radio.isChecked() else Color.Black
         game_time = self.game_time.time().minute() * 60
         args = game_server_port, game_name, self.nickname.text(), color, game_time
-        logging.info(f'New game created with args: {args}')
+        logging.info('New game created with args: %s', args)
         logging.info('Sending info about new game to server...')
         self._server_socket.connection.sendall(send_data(LobbyOperation(OperationType.StartGame, args)))
         logging.info('Info about new game sent')
@@ -116,7 +162,7 @@ class LobbyWindow(QMainWindow):
         self._my_game_info = GameInfo(game_name, (SERVER_IP, game_server_port), 1, display_info)
 
     def check_game_list_and_nickname(self):
-        if self.game_list.count() == 0 or not self.game_list.currentItem() or self.nickname.text() == '':
+        if self._game_model.rowCount() == 0 or not self.game_list.currentIndex().isValid() or self.nickname.text() == '':
             self.join_button.setEnabled(False)
         else:
             self.join_button.setEnabled(True)
@@ -128,19 +174,23 @@ class LobbyWindow(QMainWindow):
             self.create_button.setEnabled(True)
 
     def listen_server_operations(self):
+        # pickles are self-delimiting, so a list of thousands of games is read whole, whatever its size
+        stream = self._server_socket.connection.makefile('rb')
         while self._client_connected:
             logging.info('Waiting for any server operation...')
-            operation = receive_data(self._server_socket.connection.recv(1024))
-            logging.info(f'Server operation received: {operation}')
+            try:
+                operation = pickle.load(stream)
+            except (EOFError, OSError, pickle.UnpicklingError):
+                operation = None
+            # the operation itself may be a list of thousands of games; the cases below log what it is
+            logging.debug('Server operation received: %s', operation)
             if not operation:
                 operation = LobbyOperation(OperationType.Disconnect, None)
             match operation.type:
                 case OperationType.AllGames:
                     logging.info('operation: AllGames; got list of all games available')
                     game_info_list = operation.data
-                    for game_info in game_info_list:
-                        item = GameInfoItem(game_info=game_info)
-                        self.game_list.addItem(item)
+                    self.queue_game_list_update(OperationType.AllGames, game_info_list)
                     self._available_port_number = game_info_list[-1].server_socket[1] + 1 if game_info_list else self._available_port_number
                 case OperationType.StartGame:
                     logging.info('operation: StartGame')
@@ -150,41 +200,122 @@ class LobbyWindow(QMainWindow):
                                                  Q_ARG(GameInfo, self._my_game_info))
                     else:
                         logging.info('New game available on the list; adding...')
-                        item = GameInfoItem(game_info=operation.data)
-                        self.game_list.addItem(item)
+                        self.queue_game_list_update(OperationType.StartGame, [operation.data])
                         self._available_port_number = operation.data.server_socket[1] + 1
                 case OperationType.JoinGame:
                     logging.info('operation: JoinGame - if game is full - it is deleted from list')
                     if operation.data.players_connected == 2:
-                        self.remove_from_QListWidget(operation.data)
+                        self.queue_game_list_update(OperationType.RemoveGame, [operation.data])
+                case OperationType.RemoveGame:
+                    logging.info('operation: RemoveGame - game was abandoned')
+                    self.queue_game_list_update(OperationType.RemoveGame, [operation.data])
+                case OperationType.Matchmaking:
+                    logging.info('operation: Matchmaking - opponent found; joining the game...')
+                    QMetaObject.invokeMethod(self, "join_matched_game_in_main_thread", Qt.QueuedConnection,
+                                             Q_ARG(GameInfo, operation.data))
+                case OperationType.Rejected:
+                    refused, reason = operation.data
+                    logging.warning('operation: Rejected - %s refused by the server: %s', refused and refused.name, reason)
+                    if refused == OperationType.StartGame:
+                        self._my_game_info = None
+                    elif refused == OperationType.Matchmaking:
+                        QMetaObject.invokeMethod(self, "matchmaking_rejected_in_main_thread", Qt.QueuedConnection)
                 case OperationType.Disconnect:
                     logging.info('operation: Disconnect; disconnecting from server...')
                     self._server_socket.connection.close()
                     self.close()
                     sys.exit(0)
+        stream.close()
         self._server_socket.connection.close()
 
-    def remove_from_QListWidget(self, value: GameInfo) -> None:
-        for i in range(self.game_list.count()):
-            item_: GameInfoItem = self.game_list.item(i)
-            if (item_.game_info.name, item_.game_info.server_socket) == (value.name, value.server_socket):
-                self.game_list.removeItemWidget(item_)
-                break
+    def queue_game_list_update(self, operation_type: OperationType, games: list[GameInfo]) -> None:
+        # called from the listening thread - widgets can only be changed in the GUI thread
+        with self._updates_lock:
+            self._game_list_updates.append((operation_type, games))
+            if self._game_list_update_scheduled:
+                return
+            self._game_list_update_scheduled = True
+        QMetaObject.invokeMethod(self, "apply_game_list_updates", Qt.QueuedConnection)
+
+    @pyqtSlot()
+    def apply_game_list_updates(self):
+        with self._updates_lock:
+            updates, self._game_list_updates = self._game_list_updates, []
+            self._game_list_update_scheduled = False
+        added = []
+        for operation_type, games in updates:
+            match operation_type:
+                case OperationType.AllGames:
+                    self._game_model.set_games(games)
+                    added = []
+                case OperationType.StartGame:
+                    added.extend(games)
+                case OperationType.RemoveGame:
+                    self._game_model.add_games(added)
+                    added = []
+                    self._game_model.remove_games(games)
+        self._game_model.add_games(added)
 
     def closeEvent(self, event):
         logging.info('Closing lobby client...')
         sys.exit()
 
 
-class GameInfoItem(QListWidgetItem):
-    def __init__(self, game_info: GameInfo, parent=None):
-        super().__init__(game_info.display_info, parent)
-        self.game_info = game_info
+def game_key(game_info: GameInfo) -> tuple[str, tuple[str, int]]:
+    return game_info.name, game_info.server_socket
+
+
+class GameListModel(QAbstractListModel):
+    """
+    Open games shown in the lobby. Games are added and removed in batches - one signal for many rows -
+    and the view only asks for the rows it shows.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._games: list[GameInfo] = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._games)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        game_info = self._games[index.row()]
+        if role == Qt.DisplayRole:
+            return game_info.display_info
+        if role == GAME_INFO_ROLE:
+            return game_info
+        return None
+
+    def set_games(self, games: list[GameInfo]) -> None:
+        self.beginResetModel()
+        self._games = list(games)
+        self.endResetModel()
+
+    def add_games(self, games: list[GameInfo]) -> None:
+        if not games:
+            return
+        self.beginInsertRows(QModelIndex(), len(self._games), len(self._games) + len(games) - 1)
+        self._games.extend(games)
+        self.endInsertRows()
+
+    def remove_games(self, games: list[GameInfo]) -> None:
+        keys = {game_key(game_info) for game_info in games}
+        rows = [row for row, game_info in enumerate(self._games) if game_key(game_info) in keys]
+        if len(rows) == 1:
+            # a single row is removed without a reset, so the selection is kept
+            self.beginRemoveRows(QModelIndex(), rows[0], rows[0])
+            del self._games[rows[0]]
+            self.endRemoveRows()
+        elif rows:
+            self.set_games([game_info for game_info in self._games if game_key(game_info) not in keys])
 
 
 def main():
+    configure_logging()
     app = QApplication(sys.argv)
-    window = LobbyWindow(('127.0.0.1', 54321))
+    window = LobbyWindow((SERVER_IP, SESSION_SERVER_PORT))
     window.show()
     sys.exit(app.exec_())
 
@@ -1,4 +1,11 @@
-from time import time
+from dataclasses import dataclass
+from time import monotonic
+
+from pieces import Color
+
+
+# network lag is never compensated above this value, so a slow connection cannot buy unlimited time
+MAX_LAG_COMPENSATION = 1.0
 
 
 class ChessClock:
@@ -6,18 +13,25 @@ class ChessClock:
         self._max_time: float = max_time
         self._time_rest: float = max_time
         self._time_passed: bool = False
-        self._current_time: float = time()
+        self._current_time: float = monotonic()
 
     def start_timer(self):
-        self._current_time = time()
+        self._current_time = monotonic()
 
     def refresh_time(self):
-        diff = time()-self._current_time
-        self._current_time = time()
+        now = monotonic()
+        diff = now-self._current_time
+        self._current_time = now
         self._time_rest -= diff
         if self._time_rest <= 0:
             self._time_passed = True
 
+    def set_time_rest(self, time_rest: float):
+        # used when the server sends the authoritative time
+        self._time_rest = time_rest
+        self._current_time = monotonic()
+        self._time_passed = time_rest <= 0
+
     @property
     def time_passed(self):
         return self._time_passed
@@ -27,7 +41,87 @@ class ChessClock:
         return self._time_rest
 
     def time_rest_str(self) -> str:
-        total_seconds = int(self.time_rest)
+        total_seconds = max(0, int(self.time_rest))
         minutes = total_seconds // 60
         remaining_seconds = total_seconds % 60
         return f"{minutes:02}:{remaining_seconds:02}"
+
+
+@dataclass(frozen=True)
+class TimeControl:
+    base: float
+    increment: float = 0.0  # added after every move
+    delay: float = 0.0  # first seconds of every move are not charged
+
+
+class GameClock:
+    """
+    Server side clock of both players. Times are measured with time.monotonic(), a turn starts when
+    the previous move is sent to the player and the round trip time of the player's connection is not charged.
+    """
+
+    def __init__(self, time_control: TimeControl) -> None:
+        self._time_control = time_control
+        self._time_rest: dict[Color, float] = {
+            Color.White: time_control.base,
+            Color.Black: time_control.base
+        }
+        self._active: Color = Color.White
+        self._turn_started: float = monotonic()
+        self._flagged: Color | None = None
+
+    @property
+    def time_control(self):
+        return self._time_control
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def flagged(self):
+        return self._flagged
+
+    @staticmethod
+    def lag_compensation(round_trip_time: float | None) -> float:
+        return min(round_trip_time or 0.0, MAX_LAG_COMPENSATION)
+
+    def start_turn(self, color: Color, started_at: float | None = None) -> None:
+        self._active = color
+        self._turn_started = monotonic() if started_at is None else started_at
+
+    def restore(self, time_rest: dict[Color, float], active: Color) -> None:
+        # continues a game recovered after a server restart; the turn starts with start_turn
+        self._time_rest = dict(time_rest)
+        self._active = active
+
+    def deadline(self, round_trip_time: float | None) -> float:
+        # monotonic time at which the active player runs out of time
+        return (self._turn_started + self.lag_compensation(round_trip_time) + self._time_control.delay +
+                self._time_rest[self._active])
+
+    def stop_turn(self, received_at: float, round_trip_time: float | None) -> bool:
+        """
+        Charges the active player for the move received at received_at; returns False when the player ran out of time.
+        """
+        elapsed = max(0.0, received_at - self._turn_started - self.lag_compensation(round_trip_time))
+        charged = max(0.0, elapsed - self._time_control.delay)
+        if charged >= self._time_rest[self._active]:
+            self.flag()
+            return False
+        self._time_rest[self._active] += self._time_control.increment - charged
+        return True
+
+    def flag(self) -> None:
+        self._time_rest[self._active] = 0.0
+        self._flagged = self._active
+
+    def time_rest(self, now: float | None = None) -> dict[Color, float]:
+        """
+        Time left for both players; if now is given, the running turn is deducted (without lag compensation).
+        """
+        time_rest = dict(self._time_rest)
+        if now is not None and self._flagged is None:
+            running = max(0.0, now - self._turn_started - self._time_control.delay)
+            time_rest[self._active] = max(0.0, time_rest[self._active] - running)
+        return time_rest
@@ -0,0 +1,774 @@
+import sys
+import random
+import logging
+import argparse
+import threading
+from dataclasses import dataclass, field
+from time import perf_counter, sleep
+
+from board import *
+from clock import ChessClock
+from serialize import *
+from tablebase import *
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+# 10x12 mailbox: the 8x8 board is surrounded by sentinels, so moves leaving the board are detected with one lookup
+OFFBOARD = -1
+EMPTY = 0
+WHITE = 0
+BLACK = BLACK_PIECE
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = (PIECE_CODES[piece_type] for piece_type in (Pawn, Knight, Bishop, Rook, Queen, King))
+
+KNIGHT_STEPS = (-21, -19, -12, -8, 8, 12, 19, 21)
+BISHOP_STEPS = (-11, -9, 9, 11)
+ROOK_STEPS = (-10, -1, 1, 10)
+KING_STEPS = BISHOP_STEPS + ROOK_STEPS
+SLIDER_STEPS = {BISHOP: BISHOP_STEPS, ROOK: ROOK_STEPS, QUEEN: KING_STEPS}
+PROMOTION_CODES = (QUEEN, KNIGHT, ROOK, BISHOP)
+
+
+def to_mailbox(square: tuple[int, int]) -> int:
+    return 21 + square[0] * 10 + square[1]
+
+
+def from_mailbox(index: int) -> tuple[int, int]:
+    return index // 10 - 2, index % 10 - 1
+
+
+BOARD_SQUARES = tuple(to_mailbox((i, j)) for i in range(8) for j in range(8))
+
+# king from, king to, rook from, rook to, castling flag, squares which have to be empty, square the king passes
+CASTLES = {
+    WHITE: ((94, 92, 91, 93, CASTLING_FLAGS[(7, 0)], (93, 92), 93),
+            (94, 96, 98, 95, CASTLING_FLAGS[(7, 7)], (95, 96, 97), 95)),
+    BLACK: ((24, 22, 21, 23, CASTLING_FLAGS[(0, 0)], (23, 22), 23),
+            (24, 26, 28, 25, CASTLING_FLAGS[(0, 7)], (25, 26, 27), 25))
+}
+CASTLING_ROOKS = {king_to: (rook_from, rook_to) for castles in CASTLES.values() for _, king_to, rook_from, rook_to, *_ in castles}
+ALL_CASTLING = sum(CASTLING_FLAGS.values())
+# castling flags kept when a piece moves from or to the square
+CASTLING_MASK = [ALL_CASTLING] * 120
+for (rook_i, rook_j), rook_flag in CASTLING_FLAGS.items():
+    CASTLING_MASK[to_mailbox((rook_i, rook_j))] &= ~rook_flag
+CASTLING_MASK[94] &= ~(CASTLING_FLAGS[(7, 0)] | CASTLING_FLAGS[(7, 7)])
+CASTLING_MASK[24] &= ~(CASTLING_FLAGS[(0, 0)] | CASTLING_FLAGS[(0, 7)])
+
+PIECE_VALUES = {EMPTY: 0, PAWN: 100, KNIGHT: 320, BISHOP: 330, ROOK: 500, QUEEN: 900, KING: 0}
+# piece-square tables from white's point of view, from the eighth rank down and from the a file to the h file
+PIECE_SQUARE_TABLES = {
+    PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0),
+    KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50),
+    BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20),
+    ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0),
+    QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20),
+    KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20)
+}
+
+
+def build_square_scores() -> list[list[int]]:
+    # material and position of every piece code on every mailbox square; black pieces count negative
+    scores = [[0] * 120 for _ in range(16)]
+    for kind, table in PIECE_SQUARE_TABLES.items():
+        for i in range(8):
+            for j in range(8):
+                # the columns go from the h file, the table from the a file
+                scores[kind][to_mailbox((i, j))] = PIECE_VALUES[kind] + table[i * 8 + 7 - j]
+                scores[kind | BLACK][to_mailbox((i, j))] = -(PIECE_VALUES[kind] + table[(7 - i) * 8 + 7 - j])
+    return scores
+
+
+SQUARE_SCORES = build_square_scores()
+
+_zobrist_random = random.Random(20240601)
+ZOBRIST_PIECES = [[_zobrist_random.getrandbits(64) for _ in range(120)] for _ in range(16)]
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(ALL_CASTLING + 1)]
+ZOBRIST_EN_PASSANT = [0] + [_zobrist_random.getrandbits(64) for _ in range(119)]
+ZOBRIST_BLACK = _zobrist_random.getrandbits(64)
+
+
+class SearchBoard:
+    """
+    Board the engine searches on: piece codes of the compact position in a 10x12 mailbox, with make/unmake,
+    a Zobrist hash and an incrementally updated evaluation. Moves are (from, to, promotion) mailbox tuples.
+    """
+
+    def __init__(self, position: bytes | None = None, halfmove_clock: int = 0) -> None:
+        position = position or ChessBoard().position()
+        self.squares = [OFFBOARD] * 120
+        for index, square in enumerate(BOARD_SQUARES):
+            self.squares[square] = position[index]
+        flags = position[FLAGS_INDEX]
+        self.side = BLACK if flags & BLACK_TO_MOVE else WHITE
+        self.castling = flags & ALL_CASTLING
+        en_passant_column = position[EN_PASSANT_INDEX] - 1
+        self.en_passant = 0 if en_passant_column < 0 else to_mailbox((5 if self.side == BLACK else 2, en_passant_column))
+        self.halfmove_clock = halfmove_clock
+        self.kings = {piece & BLACK: square for square in BOARD_SQUARES if (piece := self.squares[square]) > 0 and piece & 7 == KING}
+        self.piece_count = sum(1 for square in BOARD_SQUARES if self.squares[square] > 0)
+        self.score = sum(SQUARE_SCORES[self.squares[square]][square] for square in BOARD_SQUARES if self.squares[square] > 0)
+        self.hash = self.compute_hash()
+        self.history = [self.hash]
+        self._undo: list[tuple] = []
+
+    def compute_hash(self) -> int:
+        value = ZOBRIST_CASTLING[self.castling] ^ ZOBRIST_EN_PASSANT[self.en_passant]
+        if self.side == BLACK:
+            value ^= ZOBRIST_BLACK
+        for square in BOARD_SQUARES:
+            if self.squares[square] > 0:
+                value ^= ZOBRIST_PIECES[self.squares[square]][square]
+        return value
+
+    def evaluate(self) -> int:
+        # from the point of view of the player to move
+        return self.score if self.side == WHITE else -self.score
+
+    def attacked(self, square: int, by: int) -> bool:
+        squares = self.squares
+        if by == WHITE:
+            if squares[square + 9] == PAWN or squares[square + 11] == PAWN:
+                return True
+        elif squares[square - 9] == PAWN | BLACK or squares[square - 11] == PAWN | BLACK:
+            return True
+        knight = KNIGHT | by
+        for step in KNIGHT_STEPS:
+            if squares[square + step] == knight:
+                return True
+        king = KING | by
+        for step in KING_STEPS:
+            if squares[square + step] == king:
+                return True
+        queen = QUEEN | by
+        for sliders, steps in (((BISHOP | by, queen), BISHOP_STEPS), ((ROOK | by, queen), ROOK_STEPS)):
+            for step in steps:
+                target = square + step
+                while squares[target] == EMPTY:
+                    target += step
+                if squares[target] in sliders:
+                    return True
+        return False
+
+    def in_check(self) -> bool:
+        return self.attacked(self.kings[self.side], self.side ^ BLACK)
+
+    def left_in_check(self) -> bool:
+        # after make(): the player who has just moved must not stay in check
+        return self.attacked(self.kings[self.side ^ BLACK], self.side)
+
+    def has_pieces(self, side: int) -> bool:
+        # anything apart from pawns and the king - without it a null move could miss a zugzwang
+        return any(piece > 0 and piece & BLACK == side and piece & 7 not in (PAWN, KING)
+                   for piece in (self.squares[square] for square in BOARD_SQUARES))
+
+    def pieces(self) -> list[tuple[int, int]]:
+        # (piece code, square of the compact position) of every piece, as the tablebase is probed
+        return [(piece, index) for index, square in enumerate(BOARD_SQUARES) if (piece := self.squares[square]) > 0]
+
+    def is_repetition(self) -> bool:
+        history = self.history
+        return self.hash in history[max(0, len(history) - 1 - self.halfmove_clock):-1]
+
+    def moves(self, captures_only: bool = False, promotions: tuple[int, ...] = PROMOTION_CODES) -> list[tuple[int, int, int]]:
+        """
+        Pseudo-legal moves - make() them and check left_in_check() to get the legal ones.
+        """
+        squares = self.squares
+        side = self.side
+        moves = []
+        append = moves.append
+        for start in BOARD_SQUARES:
+            piece = squares[start]
+            if piece <= 0 or piece & BLACK != side:
+                continue
+            kind = piece & 7
+            if kind == PAWN:
+                forward = -10 if side == WHITE else 10
+                target = start + forward
+                promote = target < 31 if side == WHITE else target > 88
+                if squares[target] == EMPTY:
+                    if promote:
+                        for promotion in promotions:
+                            append((start, target, promotion))
+                    elif not captures_only:
+                        append((start, target, 0))
+                        first_row = 80 < start < 89 if side == WHITE else 30 < start < 39
+                        if first_row and squares[target + forward] == EMPTY:
+                            append((start, target + forward, 0))
+                for target in (start + forward - 1, start + forward + 1):
+                    taken = squares[target]
+                    if taken > 0 and taken & BLACK != side or target == self.en_passant and self.en_passant:
+                        if promote:
+                            for promotion in promotions:
+                                append((start, target, promotion))
+                        else:
+                            append((start, target, 0))
+            elif kind == KNIGHT or kind == KING:
+                for step in KNIGHT_STEPS if kind == KNIGHT else KING_STEPS:
+                    target = start + step
+                    taken = squares[target]
+                    if taken == EMPTY:
+                        if not captures_only:
+                            append((start, target, 0))
+                    elif taken > 0 and taken & BLACK != side:
+                        append((start, target, 0))
+            else:
+                for step in SLIDER_STEPS[kind]:
+                    target = start + step
+                    while squares[target] == EMPTY:
+                        if not captures_only:
+                            append((start, target, 0))
+                        target += step
+                    taken = squares[target]
+                    if taken > 0 and taken & BLACK != side:
+                        append((start, target, 0))
+        if not captures_only and self.castling:
+            enemy = side ^ BLACK
+            for king_from, king_to, _, _, flag, empty, passed in CASTLES[side]:
+                if (self.castling & flag and all(squares[square] == EMPTY for square in empty) and
+                        not self.attacked(king_from, enemy) and not self.attacked(passed, enemy)):
+                    append((king_from, king_to, 0))
+        return moves
+
+    def make(self, move: tuple[int, int, int]) -> None:
+        start, target, promotion = move
+        squares = self.squares
+        piece = squares[start]
+        taken = squares[target]
+        taken_square = target
+        self._undo.append((move, taken, taken_square, self.castling, self.en_passant, self.hash, self.score, self.halfmove_clock))
+        value = self.hash ^ ZOBRIST_CASTLING[self.castling] ^ ZOBRIST_EN_PASSANT[self.en_passant] ^ ZOBRIST_BLACK
+        score = self.score
+        kind = piece & 7
+        if kind == PAWN and target == self.en_passant:
+            taken_square = target + (10 if piece & BLACK == WHITE else -10)
+            taken = squares[taken_square]
+            squares[taken_square] = EMPTY
+            self._undo[-1] = (move, taken, taken_square) + self._undo[-1][3:]
+        if taken > 0:
+            value ^= ZOBRIST_PIECES[taken][taken_square]
+            score -= SQUARE_SCORES[taken][taken_square]
+            self.piece_count -= 1
+        placed = promotion | (piece & BLACK) if promotion else piece
+        squares[start] = EMPTY
+        squares[target] = placed
+        value ^= ZOBRIST_PIECES[piece][start] ^ ZOBRIST_PIECES[placed][target]
+        score += SQUARE_SCORES[placed][target] - SQUARE_SCORES[piece][start]
+        en_passant = 0
+        if kind == PAWN:
+            if abs(target - start) == 20:
+                en_passant = (start + target) // 2
+        elif kind == KING:
+            self.kings[piece & BLACK] = target
+            if abs(target - start) == 2:
+                rook_from, rook_to = CASTLING_ROOKS[target]
+                rook = squares[rook_from]
+                squares[rook_from] = EMPTY
+                squares[rook_to] = rook
+                value ^= ZOBRIST_PIECES[rook][rook_from] ^ ZOBRIST_PIECES[rook][rook_to]
+                score += SQUARE_SCORES[rook][rook_to] - SQUARE_SCORES[rook][rook_from]
+        self.castling &= CASTLING_MASK[start] & CASTLING_MASK[target]
+        self.en_passant = en_passant
+        self.hash = value ^ ZOBRIST_CASTLING[self.castling] ^ ZOBRIST_EN_PASSANT[en_passant]
+        self.score = score
+        self.halfmove_clock = 0 if kind == PAWN or taken > 0 else self.halfmove_clock + 1
+        self.side ^= BLACK
+        self.history.append(self.hash)
+
+    def unmake(self) -> None:
+        move, taken, taken_square, self.castling, self.en_passant, self.hash, self.score, self.halfmove_clock = self._undo.pop()
+        self.history.pop()
+        self.side ^= BLACK
+        start, target, promotion = move
+        squares = self.squares
+        piece = PAWN | self.side if promotion else squares[target]
+        squares[start] = piece
+        squares[target] = EMPTY
+        if taken > 0:
+            squares[taken_square] = taken
+            self.piece_count += 1
+        if piece & 7 == KING:
+            self.kings[self.side] = start
+            if abs(target - start) == 2:
+                rook_from, rook_to = CASTLING_ROOKS[target]
+                squares[rook_from] = squares[rook_to]
+                squares[rook_to] = EMPTY
+
+    def make_null(self) -> None:
+        self._undo.append((None, 0, 0, self.castling, self.en_passant, self.hash, self.score, self.halfmove_clock))
+        self.hash ^= ZOBRIST_BLACK ^ ZOBRIST_EN_PASSANT[self.en_passant]
+        self.en_passant = 0
+        self.side ^= BLACK
+        self.history.append(self.hash)
+
+    def unmake_null(self) -> None:
+        _, _, _, self.castling, self.en_passant, self.hash, self.score, self.halfmove_clock = self._undo.pop()
+        self.history.pop()
+        self.side ^= BLACK
+
+    def legal_moves(self) -> list[tuple[int, int, int]]:
+        legal = []
+        for move in self.moves():
+            self.make(move)
+            if not self.left_in_check():
+                legal.append(move)
+            self.unmake()
+        return legal
+
+
+INFINITY = 1_000_000
+MATE = 100_000
+MAX_PLY = 64
+EXACT, LOWER, UPPER = range(3)
+CHECK_TIME_EVERY = 1023  # nodes between reading the time
+TABLE_SIZE = 1 << 18
+MOVES_TO_GO = 30  # the time left is shared among this many moves
+MAX_TIME_SHARE = 0.25  # of the time left, spent on one move at most
+MIN_MOVE_TIME = 0.05
+SOFT_TIME_SHARE = 0.5  # no new iteration is started after this part of the budget
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+@dataclass
+class SearchResult:
+    move: tuple[tuple[int, int], tuple[int, int]] | None
+    promotion: type[Piece] | None
+    score: int  # centipawns for the player to move
+    depth: int
+    nodes: int
+    time: float
+    pv: list[tuple[tuple[int, int], tuple[int, int]]] = field(default_factory=list)
+
+    @property
+    def nps(self) -> float:
+        return self.nodes / self.time if self.time else 0.0
+
+    @property
+    def mate(self) -> int | None:
+        # moves to mate, negative when the player to move is mated
+        if abs(self.score) < MATE - MAX_PLY:
+            return None
+        moves = (MATE - abs(self.score) + 1) // 2
+        return moves if self.score > 0 else -moves
+
+
+class Engine:
+    """
+    Negamax alpha-beta search with iterative deepening, principal variation search, a transposition table,
+    null move pruning, quiescence search and move ordering by the table move, MVV-LVA, killers and history.
+    With a tablebase, positions with few enough pieces are not searched but probed.
+    """
+
+    def __init__(self, table_size: int = TABLE_SIZE, underpromotions: bool = True, tablebase: Tablebase | None = None) -> None:
+        self._tablebase = tablebase
+        self._table: dict[int, tuple] = {}
+        self._table_size = table_size
+        self._promotions = PROMOTION_CODES if underpromotions else (QUEEN,)
+        self._board: SearchBoard | None = None
+        self._killers: list[list] = []
+        self._history: dict[tuple[int, int], int] = {}
+        self._deadline = float('inf')
+        self.nodes = 0
+
+    @staticmethod
+    def time_budget(time_rest: float, increment: float = 0.0) -> float:
+        budget = time_rest / MOVES_TO_GO + increment * 0.8
+        return max(MIN_MOVE_TIME, min(budget, time_rest * MAX_TIME_SHARE))
+
+    def best_move(self, chess_board: ChessBoard, clock: ChessClock, increment: float = 0.0) -> SearchResult:
+        return self.analyse(chess_board, time_limit=self.time_budget(clock.time_rest, increment))
+
+    def analyse(self, chess_board: ChessBoard, depth: int | None = None, time_limit: float | None = None) -> SearchResult:
+        board = SearchBoard(chess_board.position(), chess_board.halfmove_clock)
+        self._board = board
+        self.nodes = 0
+        self._killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self._history.clear()
+        started = perf_counter()
+        self._deadline = started + time_limit if time_limit else float('inf')
+        soft_deadline = started + time_limit * SOFT_TIME_SHARE if time_limit else float('inf')
+
+        if self._tablebase is not None:
+            probe = self._tablebase.best_move(chess_board)
+            if probe is not None and (probe[1] is None or PIECE_CODES[probe[1]] in self._promotions):
+                move, promotion, probed = probe
+                pv = self._tablebase.principal_variation(chess_board) or [move]
+                return SearchResult(move, promotion, self.tablebase_score(probed, 0), probed.plies, 0,
+                                    perf_counter() - started, pv)
+
+        root_moves = [move for move in board.legal_moves() if not move[2] or move[2] in self._promotions]
+        if not root_moves:
+            score = -MATE if board.in_check() else 0
+            return SearchResult(None, None, score, 0, 0, perf_counter() - started)
+        result = SearchResult(*self.to_coordinates(root_moves[0]), 0, 0, 0, 0.0)
+        for current_depth in range(1, (depth or MAX_PLY) + 1):
+            try:
+                score, move = self.search_root(root_moves, current_depth)
+            except SearchTimeout:
+                break
+            elapsed = perf_counter() - started
+            pv = self.principal_variation(current_depth)
+            result = SearchResult(*self.to_coordinates(move), score, current_depth, self.nodes, elapsed, pv)
+            logging.debug('depth %d score %d nodes %d nps %.0f', current_depth, score, self.nodes, result.nps)
+            root_moves.remove(move)
+            root_moves.insert(0, move)
+            if abs(score) >= MATE - MAX_PLY or perf_counter() > soft_deadline:
+                break
+        result.nodes = self.nodes
+        result.time = perf_counter() - started
+        return result
+
+    def analyse_game(self, moves, time_limit: float) -> list[SearchResult]:
+        # best move and score in every position of an archived game, before the move was played
+        chess_board = ChessBoard()
+        results = []
+        for old, new in moves:
+            results.append(self.analyse(chess_board, time_limit=time_limit))
+            chess_board.move(tuple(old), tuple(new))
+        return results
+
+    @staticmethod
+    def to_coordinates(move: tuple[int, int, int]) -> tuple[tuple[tuple[int, int], tuple[int, int]], type[Piece] | None]:
+        return (from_mailbox(move[0]), from_mailbox(move[1])), PIECE_TYPES[move[2]] if move[2] else None
+
+    def search_root(self, moves: list[tuple[int, int, int]], depth: int) -> tuple[int, tuple[int, int, int]]:
+        board = self._board
+        alpha, beta = -INFINITY, INFINITY
+        best_move = moves[0]
+        for index, move in enumerate(moves):
+            board.make(move)
+            if index == 0:
+                score = -self.negamax(depth - 1, -beta, -alpha, 1)
+            else:
+                score = -self.negamax(depth - 1, -alpha - 1, -alpha, 1)
+                if score > alpha:
+                    score = -self.negamax(depth - 1, -beta, -alpha, 1)
+            board.unmake()
+            if score > alpha:
+                alpha = score
+                best_move = move
+        self.store(board.hash, depth, EXACT, alpha, best_move, 0)
+        return alpha, best_move
+
+    def negamax(self, depth: int, alpha: int, beta: int, ply: int, null_allowed: bool = True) -> int:
+        board = self._board
+        self.nodes += 1
+        if not self.nodes & CHECK_TIME_EVERY and perf_counter() > self._deadline:
+            raise SearchTimeout
+        if board.halfmove_clock >= 100 or board.is_repetition():
+            return 0
+        if (self._tablebase is not None and board.piece_count <= self._tablebase.max_pieces and not board.castling and
+                not board.en_passant):
+            probed = self._tablebase.probe_pieces(board.pieces(), board.side == BLACK)
+            if probed is not None:
+                return self.tablebase_score(probed, ply)
+        in_check = board.in_check()
+        if in_check:
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY:
+            return self.quiescence(alpha, beta, ply)
+
+        original_alpha = alpha
+        table_move = None
+        entry = self._table.get(board.hash)
+        if entry is not None:
+            entry_depth, flag, score, table_move = entry
+            if entry_depth >= depth:
+                score = self.score_from_table(score, ply)
+                if flag == EXACT or flag == LOWER and score >= beta or flag == UPPER and score <= alpha:
+                    return score
+
+        if null_allowed and not in_check and depth >= 3 and board.evaluate() >= beta and board.has_pieces(board.side):
+            board.make_null()
+            score = -self.negamax(depth - 3, -beta, -beta + 1, ply + 1, False)
+            board.unmake_null()
+            if score >= beta:
+                return beta
+
+        best_score = -INFINITY
+        best_move = None
+        legal = 0
+        for move in self.ordered(board.moves(promotions=self._promotions), table_move, ply):
+            board.make(move)
+            if board.left_in_check():
+                board.unmake()
+                continue
+            legal += 1
+            if legal == 1:
+                score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            else:
+                score = -self.negamax(depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < score < beta:
+                    score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            board.unmake()
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        if board.squares[move[1]] == EMPTY and not move[2]:
+                            self.remember_quiet_move(move, depth, ply)
+                        break
+        if not legal:
+            return -MATE + ply if in_check else 0
+        flag = UPPER if best_score <= original_alpha else LOWER if best_score >= beta else EXACT
+        self.store(board.hash, depth, flag, best_score, best_move, ply)
+        return best_score
+
+    def quiescence(self, alpha: int, beta: int, ply: int) -> int:
+        board = self._board
+        self.nodes += 1
+        if not self.nodes & CHECK_TIME_EVERY and perf_counter() > self._deadline:
+            raise SearchTimeout
+        stand_pat = board.evaluate()
+        if stand_pat >= beta or ply >= MAX_PLY:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        squares = board.squares
+        moves = board.moves(captures_only=True, promotions=(QUEEN,))
+        moves.sort(key=lambda move: PIECE_VALUES[squares[move[1]] & 7] * 16 - (squares[move[0]] & 7) + PIECE_VALUES[move[2]],
+                   reverse=True)
+        for move in moves:
+            board.make(move)
+            if board.left_in_check():
+                board.unmake()
+                continue
+            score = -self.quiescence(-beta, -alpha, ply + 1)
+            board.unmake()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def ordered(self, moves: list[tuple[int, int, int]], table_move, ply: int) -> list[tuple[int, int, int]]:
+        squares = self._board.squares
+        killers = self._killers[ply]
+        history = self._history
+
+        def priority(move):
+            if move == table_move:
+                return 10_000_000
+            taken = squares[move[1]]
+            if taken > 0 or move[2]:
+                # most valuable victim first, taken by the least valuable attacker
+                return 1_000_000 + PIECE_VALUES[taken & 7] * 16 - (squares[move[0]] & 7) + PIECE_VALUES[move[2]]
+            if move == killers[0] or move == killers[1]:
+                return 900_000
+            return history.get(move[:2], 0)
+
+        moves.sort(key=priority, reverse=True)
+        return moves
+
+    def remember_quiet_move(self, move: tuple[int, int, int], depth: int, ply: int) -> None:
+        killers = self._killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        self._history[move[:2]] = min(self._history.get(move[:2], 0) + depth * depth, 800_000)
+
+    def store(self, key: int, depth: int, flag: int, score: int, move, ply: int) -> None:
+        if len(self._table) >= self._table_size:
+            self._table.clear()
+        self._table[key] = (depth, flag, self.score_to_table(score, ply), move)
+
+    @staticmethod
+    def tablebase_score(probed: TablebaseResult, ply: int) -> int:
+        # the mate comes the probed number of plies after this one
+        if probed.wdl > 0:
+            return MATE - ply - probed.plies
+        if probed.wdl < 0:
+            return -MATE + ply + probed.plies
+        return 0
+
+    @staticmethod
+    def score_to_table(score: int, ply: int) -> int:
+        # mate scores are stored relative to the position, not to the root
+        if score >= MATE - MAX_PLY:
+            return score + ply
+        if score <= -MATE + MAX_PLY:
+            return score - ply
+        return score
+
+    @staticmethod
+    def score_from_table(score: int, ply: int) -> int:
+        if score >= MATE - MAX_PLY:
+            return score - ply
+        if score <= -MATE + MAX_PLY:
+            return score + ply
+        return score
+
+    def principal_variation(self, depth: int) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+        board = self._board
+        pv = []
+        for _ in range(depth):
+            entry = self._table.get(board.hash)
+            if entry is None or entry[3] is None or entry[3] not in board.legal_moves():
+                break
+            pv.append(entry[3])
+            board.make(entry[3])
+        for _ in pv:
+            board.unmake()
+        return [self.to_coordinates(move)[0] for move in pv]
+
+
+class EngineOpponent:
+    """
+    Plays the other side of a Game: on its turn, the engine searches within the budget of its clock
+    and passes the move to the game the same way as a move received from the network.
+    """
+
+    def __init__(self, game, engine: Engine | None = None, increment: float = 0.0) -> None:
+        self._game = game
+        # the game promotes pawns to queens only
+        self._engine = engine or Engine(underpromotions=False)
+        self._increment = increment
+        self._color = Color.White if game.player_color == Color.Black else Color.Black
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.play, name='EngineOpponent')
+        thread.daemon = True
+        thread.start()
+
+    def play(self) -> None:
+        game = self._game
+        chess_board = game.chess_board
+        while game.winner is None:
+            if chess_board.turn != self._color:
+                sleep(0.01)
+                continue
+            result = self._engine.best_move(chess_board, game.clocks[self._color], self._increment)
+            if result.move is None:
+                break
+            logging.info('engine move %s, score %d, depth %d, %.0f nodes/s', result.move, result.score, result.depth, result.nps)
+            # the move is made before receive_move returns
+            game.receive_move(result.move)
+
+
+BENCH_POSITIONS = (
+    START_FEN,
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+)
+
+
+def pv_san(chess_board: ChessBoard, pv) -> str:
+    chess_board = ChessBoard.from_fen(chess_board.fen())
+    for old, new in pv:
+        chess_board.move(old, new)
+    return ' '.join(chess_board.moves)
+
+
+def bench(depth: int) -> SearchResult:
+    nodes = 0
+    elapsed = 0.0
+    for fen in BENCH_POSITIONS:
+        result = Engine().analyse(ChessBoard.from_fen(fen), depth=depth)
+        nodes += result.nodes
+        elapsed += result.time
+        print(f'{fen}: {pv_san(ChessBoard.from_fen(fen), result.pv[:1])} score {result.score} '
+              f'nodes {result.nodes} {result.nps:.0f} nodes/s')
+    print(f'total: {nodes} nodes in {elapsed:.2f} s, {nodes / elapsed:.0f} nodes/s')
+    return SearchResult(None, None, 0, depth, nodes, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chess engine: analysis, speed benchmark and games against the computer')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    analyse_parser = subparsers.add_parser('analyse', help='best move and score of a position or of every move of a game')
+    analyse_parser.add_argument('--fen', default=START_FEN)
+    analyse_parser.add_argument('--game', default=None, help='archived game (JSON move list) to analyse move by move')
+    analyse_parser.add_argument('--time', type=float, default=1.0, help='seconds per position')
+    analyse_parser.add_argument('--depth', type=int, default=None)
+    analyse_parser.add_argument('--tablebase', default=TABLEBASE_PATH, help='endgame tablebase file, used when it exists')
+    bench_parser = subparsers.add_parser('bench', help='search fixed positions and report nodes per second')
+    bench_parser.add_argument('--depth', type=int, default=4)
+    play_parser = subparsers.add_parser('play', help='play against the engine')
+    play_parser.add_argument('--color', choices=('white', 'black'), default='white', help='your color')
+    play_parser.add_argument('--time', type=float, default=300, help='seconds on each clock')
+    play_parser.add_argument('--tablebase', default=TABLEBASE_PATH, help='endgame tablebase file, used when it exists')
+    args = parser.parse_args()
+
+    match args.command:
+        case 'analyse' if args.game:
+            moves = read_data_from_file(args.game)
+            chess_board = ChessBoard()
+            engine = Engine(tablebase=open_tablebase(args.tablebase))
+            for (old, new), result in zip(moves, engine.analyse_game(moves, args.time)):
+                best = pv_san(chess_board, result.pv[:1])
+                chess_board.move(tuple(old), tuple(new))
+                print(f'{chess_board.moves[-1]:8} best {best:8} score {result.score:6} depth {result.depth}')
+        case 'analyse':
+            chess_board = ChessBoard.from_fen(args.fen)
+            engine = Engine(tablebase=open_tablebase(args.tablebase))
+            result = engine.analyse(chess_board, depth=args.depth, time_limit=None if args.depth else args.time)
+            print(f'best move: {pv_san(chess_board, result.pv[:1])}, score: {result.score}, depth: {result.depth}, '
+                  f'pv: {pv_san(chess_board, result.pv)}, {result.nodes} nodes, {result.nps:.0f} nodes/s')
+        case 'bench':
+            bench(args.depth)
+        case 'play':
+            # pygame is only needed here
+            from game import Game
+            color = Color.White if args.color == 'white' else Color.Black
+            names = {color: 'Player', Color.White if color == Color.Black else Color.Black: 'Engine'}
+            game = Game(color, names[Color.White], names[Color.Black], args.time)
+            EngineOpponent(game, Engine(underpromotions=False, tablebase=open_tablebase(args.tablebase))).start()
+            game.start()
+
+
+if __name__ == '__main__':
+    main()
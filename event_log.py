@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+from rate_limit import *
+
+LOG_FORMAT = '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+LOG_MODE_VARIABLE = 'CHESS_LOG'  # plain (the default) or async
+LOG_FILE_VARIABLE = 'CHESS_LOG_FILE'  # where the log goes; standard error by default
+LOG_MODES = ('plain', 'async')
+EVENT_RATE = (20, 100)  # records a second and in a burst kept of every call site; warnings and errors are all kept
+CONTEXT_FIELDS = ('game', 'connection', 'player')  # ids and names passed to a call with extra={...}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object a line. The event is the name given with extra={'event': ...}, the logging function
+    otherwise; game and connection ids and player names come from extra as well, so the events of one game
+    or one player can be picked out.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            'time': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'event': getattr(record, 'event', None) or f'{record.module}.{record.funcName}',
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                event[field] = value
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            event['suppressed'] = suppressed
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+class EventSampler(logging.Filter):
+    """
+    Keeps at most rate records a second of every call site, with bursts of up to burst; the records dropped
+    since are counted in the suppressed field of the next one kept, so rates can still be told from the log.
+    """
+
+    def __init__(self, rate: float = EVENT_RATE[0], burst: float = EVENT_RATE[1]) -> None:
+        super().__init__()
+        self._rate = rate
+        self._burst = burst
+        self._buckets: dict[tuple[str, int], TokenBucket] = {}
+        self._suppressed: dict[tuple[str, int], int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(site, None)
+            if bucket is None:
+                bucket = self._buckets[site] = TokenBucket(self._rate, self._burst)
+            if not bucket.take():
+                self._suppressed[site] = self._suppressed.get(site, 0) + 1
+                return False
+            record.suppressed = getattr(record, 'suppressed', 0) + self._suppressed.pop(site, 0)
+        return True
+
+
+class SampledEvent:
+    """
+    An event of a hot path, sampled before anything is logged: a record costs several microseconds to create,
+    a token bucket a fraction of one. sample() returns the number of events dropped since the last one kept,
+    or None when this one is dropped too. Only async logging samples; plain logs keep every event.
+    """
+    enabled = False
+
+    def __init__(self, rate: float = EVENT_RATE[0], burst: float = EVENT_RATE[1]) -> None:
+        self._bucket = TokenBucket(rate, burst)
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def sample(self) -> int | None:
+        if not SampledEvent.enabled:
+            return 0
+        with self._lock:
+            if not self._bucket.take():
+                self._suppressed += 1
+                return None
+            suppressed, self._suppressed = self._suppressed, 0
+            return suppressed
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are: the message is formatted by the listener's thread, not by the
+    caller. Arguments are therefore read a little later - mutable ones should be passed as copies.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(mode: str | None = None, level: int = logging.INFO, path: str | None = None):
+    """
+    Sets up the root logger; mode and path default to the CHESS_LOG and CHESS_LOG_FILE environment variables.
+    Plain mode writes text lines from the calling thread like before. Async mode samples records and queues
+    them for a background thread, which writes them as JSON; it returns the listener, stopped at exit.
+    """
+    mode = mode or os.environ.get(LOG_MODE_VARIABLE, 'plain')
+    path = path or os.environ.get(LOG_FILE_VARIABLE, None)
+    if mode not in LOG_MODES:
+        raise ValueError(f'unknown logging mode {mode}; one of {", ".join(LOG_MODES)}')
+    SampledEvent.enabled = mode == 'async'
+    if mode == 'plain':
+        handler = logging.FileHandler(path) if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logging.basicConfig(level=level, handlers=[handler], force=True)
+        return None
+    writer = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    writer.setFormatter(JsonFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    # dropped records never reach the queue
+    handler.addFilter(EventSampler())
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    listener = logging.handlers.QueueListener(records, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
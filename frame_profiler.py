@@ -0,0 +1,97 @@
+import os
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+
+# set to 1 to show the overlay from the start, or to a file name to record a trace of every frame
+HUD_ENVIRONMENT = 'CHESS_HUD'
+TRACE_ENVIRONMENT = 'CHESS_TRACE'
+HUD_WINDOW = 120  # frames the overlay averages over
+
+
+class FrameProfiler:
+    """
+    Durations of the parts of every frame and of other latencies, kept for the last frames. With a trace path,
+    every measurement is also written to a file in the Trace Event Format, which chrome://tracing and Perfetto
+    open. Events are written as they come; the viewers accept the file without its closing bracket, so a trace
+    of a crashed client can be read as well.
+    """
+
+    def __init__(self, trace_path: str | None = None, window: int = HUD_WINDOW) -> None:
+        self._window = window
+        self._measurements: dict[str, deque[float]] = {}
+        self._frame_started: float | None = None
+        self._origin = perf_counter()
+        self._pid = os.getpid()
+        self._tid = threading.get_ident()
+        self._lock = threading.Lock()
+        self._trace = None
+        if trace_path:
+            self._trace = open(trace_path, 'w', encoding='utf-8')
+            self._trace.write('[\n')
+            self.write_event({'name': 'thread_name', 'ph': 'M', 'args': {'name': 'game loop'}})
+
+    @property
+    def tracing(self) -> bool:
+        return self._trace is not None
+
+    def begin_frame(self) -> None:
+        self._frame_started = perf_counter()
+
+    def end_frame(self) -> None:
+        if self._frame_started is not None:
+            self.add_span('frame', self._frame_started, perf_counter())
+
+    @contextmanager
+    def span(self, name: str):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, started, perf_counter())
+
+    def add_span(self, name: str, started: float, finished: float) -> None:
+        self.store(name, finished - started)
+        if self._trace is not None:
+            self.write_event({'name': name, 'ph': 'X', 'ts': self.microseconds(started),
+                              'dur': round((finished - started) * 1e6, 1)})
+
+    def record(self, name: str, seconds: float) -> None:
+        # a latency which is not a part of a frame; traced as a counter
+        self.store(name, seconds)
+        if self._trace is not None:
+            self.write_event({'name': name, 'ph': 'C', 'ts': self.microseconds(perf_counter()),
+                              'args': {'ms': round(seconds * 1e3, 3)}})
+
+    def store(self, name: str, seconds: float) -> None:
+        with self._lock:
+            measurements = self._measurements.get(name, None)
+            if measurements is None:
+                measurements = self._measurements[name] = deque(maxlen=self._window)
+            measurements.append(seconds)
+
+    def microseconds(self, moment: float) -> float:
+        return round((moment - self._origin) * 1e6, 1)
+
+    def write_event(self, event: dict) -> None:
+        event['pid'] = self._pid
+        event['tid'] = self._tid
+        with self._lock:
+            self._trace.write(json.dumps(event) + ',\n')
+
+    def summary(self) -> list[tuple[str, float, float]]:
+        # (name, mean, maximum) in milliseconds over the last frames, in the order the measurements first came
+        with self._lock:
+            return [(name, 1e3 * sum(values) / len(values), 1e3 * max(values))
+                    for name, values in self._measurements.items() if values]
+
+    def close(self) -> None:
+        if self._trace is None:
+            return
+        with self._lock:
+            self._trace.write(json.dumps({'name': 'trace_end', 'ph': 'i', 's': 'g', 'pid': self._pid, 'tid': self._tid,
+                                          'ts': self.microseconds(perf_counter())}) + '\n]\n')
+            self._trace.close()
+            self._trace = None
@@ -1,21 +1,17 @@
 import os.path
+import threading
+from collections import deque
+from time import perf_counter
 
 import pygame
 import sys
-from enum import Enum, auto
 
 from board import *
 from clock import *
+from frame_profiler import *
 
-
-class GameState(Enum):
-    NotStarted = auto()
-    InProgress = auto()
-    Ended = auto()
-
-
-def opposite_color(color: Color) -> Color:
-    return Color.White if color == Color.Black else Color.Black
+# images and sounds are found next to this file, wherever the game is started from
+RESOURCES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
 
 
 class Game:
@@ -31,6 +27,12 @@ class Game:
     DARK_BROWN = (139, 69, 19)
     LIGHT_BROWN = (222, 184, 135)
     RED = (255, 0, 0)
+    LEGAL_TARGET = (40, 40, 40, 90)
+    PREMOVE = (60, 110, 190, 120)
+    PREMOVE_LIMIT = 8
+    HUD_BACKGROUND = (0, 0, 0, 160)
+    HUD_REFRESH = 0.25  # seconds between two renderings of the overlay text
+    HUD_KEY = pygame.K_F3
 
     piece_names = [
         'BishopBlack',
@@ -47,16 +49,24 @@ class Game:
         'RookWhite'
     ]
 
-    def __init__(self, player_color: Color, white_player: str, black_player: str, time: float) -> None:
+    def __init__(self, player_color: Color, white_player: str, black_player: str, time: float, server_clocks: bool = False,
+                 hud: bool | None = None, trace_path: str | None = None, on_own_move=None) -> None:
 
         self._chess_game = ChessBoard()
+        self._legal_moves = LegalMoveCache()
 
         self._player_color = player_color
-        self._another_player_move: tuple[tuple[int, int]] | None = None
         self._all_move_list: list[tuple[tuple[int, int]]] = []
+        # moves queued during the opponent's turn; the first legal one is played as soon as the opponent moves
+        self._premoves: deque[tuple[tuple[int, int], tuple[int, int]]] = deque()
+        # called with every own move right after it is made, e.g. to send it to the server
+        self._on_own_move = on_own_move
+        self._checked_king_pos: tuple[int, int] | None = None
+        # the board is changed by the game loop and by receive_move, which is called from other threads
+        self._lock = threading.Lock()
 
         self.piece_images = {
-            name: pygame.transform.scale(pygame.image.load(f'resources\\images\\{name}.png'), (self.CELL_SIZE, self.CELL_SIZE)) for
+            name: pygame.transform.scale(pygame.image.load(os.path.join(RESOURCES_PATH, 'images', f'{name}.png')), (self.CELL_SIZE, self.CELL_SIZE)) for
             name in self.piece_names
         }
 
@@ -66,6 +76,18 @@ class Game:
         self.screen = pygame.display.set_mode((self.SCREEN_WIDTH, self.SCREEN_HEIGHT))
         pygame.display.set_caption("Chess Game")
         self.clock = pygame.time.Clock()
+        self.clock_font = pygame.font.SysFont('Comic Sans MS', 30)
+        self.legal_target_image = pygame.Surface((self.CELL_SIZE, self.CELL_SIZE), pygame.SRCALPHA)
+        pygame.draw.circle(self.legal_target_image, self.LEGAL_TARGET, (self.CELL_SIZE // 2, self.CELL_SIZE // 2), self.CELL_SIZE // 6)
+        self.premove_image = pygame.Surface((self.CELL_SIZE, self.CELL_SIZE), pygame.SRCALPHA)
+        self.premove_image.fill(self.PREMOVE)
+
+        # the overlay is toggled with F3; both can be switched on from the environment in players' sessions
+        self.profiler = FrameProfiler(trace_path or os.environ.get(TRACE_ENVIRONMENT, None))
+        self._hud = bool(os.environ.get(HUD_ENVIRONMENT, '')) if hud is None else hud
+        self.hud_font = pygame.font.SysFont('Consolas', 14)
+        self._hud_image: pygame.Surface | None = None
+        self._hud_rendered_at = 0.0
         self._game_state: GameState = GameState.NotStarted
         self.players = {
             Color.White: white_player,
@@ -78,10 +100,12 @@ class Game:
             Color.Black: ChessClock(time)
         }
         self.active_clock = self.clocks[Color.White]
+        # with server clocks, the time is only displayed here - running out of time is decided by the server
+        self._server_clocks = server_clocks
 
         self._forced_ending_winner = False
 
-        sounds_path = 'resources\\sounds'
+        sounds_path = os.path.join(RESOURCES_PATH, 'sounds')
         self.move_sound = pygame.mixer.Sound(os.path.join(sounds_path, 'move.mp3'))
         self.take_sound = pygame.mixer.Sound(os.path.join(sounds_path, 'take.mp3'))
         self.wrong_move = pygame.mixer.Sound(os.path.join(sounds_path, 'wrong_move.mp3'))
@@ -90,17 +114,100 @@ class Game:
         self.game_end_sound = pygame.mixer.Sound(os.path.join(sounds_path, 'game_end.mp3'))
 
     @property
-    def another_player_move(self):
-        return self._another_player_move
+    def player_color(self):
+        return self._player_color
 
-    @another_player_move.setter
-    def another_player_move(self, value):
-        self._another_player_move = value
+    @property
+    def chess_board(self) -> ChessBoard:
+        return self._chess_game
 
     @property
     def all_move_list(self):
         return self._all_move_list
 
+    @property
+    def premoves(self) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+        return list(self._premoves)
+
+    def receive_move(self, move, received_at: float | None = None) -> None:
+        """
+        Called from the network or engine thread. The move is made right away, and so is a queued premove, so the
+        reply is sent before the game loop wakes up; the event only makes the loop draw the new position.
+        """
+        received_at = perf_counter() if received_at is None else received_at
+        (old_row, old_col), (row, col) = move
+        with self._lock:
+            self.make_move((old_row, old_col), (row, col))
+            if self._premoves and self._chess_game.turn == self._player_color and self._chess_game.winner is None:
+                self.play_premove()
+                self.profiler.record('premove_reply', perf_counter() - received_at)
+        pygame.event.post(pygame.event.Event(pygame.USEREVENT, {'posted_at': perf_counter(), 'received_at': received_at}))
+
+    def load_position(self, position: bytes, moves) -> None:
+        # used when joining a game which is already in progress (spectating or resuming) - nothing is replayed
+        with self._lock:
+            self._chess_game.set_position(position)
+            self._all_move_list[:] = [(tuple(old), tuple(new)) for old, new in moves]
+            self._premoves.clear()
+            self._checked_king_pos = None
+            self.active_clock = self.clocks[self._chess_game.turn]
+
+    def make_move(self, old: tuple[int, int], new: tuple[int, int], legal: bool = False) -> MoveType:
+        """
+        Makes a move of either player with its sounds and clocks; called with self._lock held.
+        """
+        own_move = self._chess_game.turn == self._player_color
+        with self.profiler.span('move'):
+            move_type, check_state = self._chess_game.move(old, new, legal=legal)
+
+        if move_type == MoveType.InvalidMove:
+            self.wrong_move.play()  # invalid move sound
+            return move_type
+        self._all_move_list.append((old, new))
+
+        self.active_clock = self.switch_clocks()
+        if move_type == MoveType.Move and check_state == CheckState.NoCheck:
+            self.move_sound.play()  # regular move sound
+        elif move_type == MoveType.Take:
+            self.take_sound.play()  # take sound
+        elif move_type == MoveType.Castle:
+            self.castle_sound.play()  # castle sound
+        match check_state:
+            case CheckState.NoCheck:
+                self._checked_king_pos = None
+            case CheckState.Check:
+                self.check_sound.play()
+                checked_king = self._chess_game.white_king if self._chess_game.turn == Color.White else self._chess_game.black_king
+                self._checked_king_pos = self._chess_game.find_king(checked_king)
+            case CheckState.Checkmate:
+                self.game_end_sound.play()
+
+        if own_move and self._on_own_move is not None:
+            self._on_own_move((old, new))
+        return move_type
+
+    def play_premove(self) -> None:
+        # premoves were queued for an older position; the first illegal one cancels the rest of them
+        old, new = self._premoves.popleft()
+        if self.make_move(old, new) == MoveType.InvalidMove:
+            self._premoves.clear()
+
+    def queue_premove(self, old: tuple[int, int], new: tuple[int, int]) -> None:
+        if len(self._premoves) < self.PREMOVE_LIMIT:
+            self._premoves.append((old, new))
+        if self._chess_game.turn == self._player_color and self._chess_game.winner is None:
+            # the opponent moved while the piece was dragged
+            self.play_premove()
+
+    def premove_piece(self, square: tuple[int, int]) -> Piece | None:
+        # the own piece which will stand on the square after the queued premoves
+        pieces = {}
+        for old, new in self._premoves:
+            pieces[new] = pieces.get(old, self._chess_game.board[old[0]][old[1]])
+            pieces[old] = None
+        piece = pieces.get(square, self._chess_game.board[square[0]][square[1]])
+        return piece if piece is not None and piece.color == self._player_color else None
+
     @property
     def game_state(self):
         return self._game_state
@@ -126,6 +233,15 @@ class Game:
                     piece_img = self.piece_images[str(piece)]
                     self.screen.blit(piece_img, (self.CELL_SIZE * col, self.CELL_SIZE * row + self.TIMER_HEIGHT))
 
+    def draw_legal_targets(self, targets: frozenset[tuple[int, int]]):
+        for row, col in targets:
+            self.screen.blit(self.legal_target_image, (self.CELL_SIZE * col, self.CELL_SIZE * row + self.TIMER_HEIGHT))
+
+    def draw_premoves(self):
+        for old, new in self.premoves:
+            for row, col in (old, new):
+                self.screen.blit(self.premove_image, (self.CELL_SIZE * col, self.CELL_SIZE * row + self.TIMER_HEIGHT))
+
     def get_cell_under_mouse(self, mouse_x, mouse_y):
         # mouse_x, mouse_y = pygame.mouse.get_pos()
         mouse_y -= self.TIMER_HEIGHT
@@ -137,23 +253,37 @@ class Game:
         dragging_piece = None
         dragging_piece_rect = None
         dragging_piece_pos = None
-
-        checked_king_pos = None
+        legal_targets = frozenset()
+        # the position the legal targets were found in
+        drag_position = None
+        premove_drag = False
 
         board = self._chess_game.board
 
         game_lasts = True
         self._game_state = GameState.InProgress
 
-        while game_lasts and not self._forced_ending_winner:
+        profiler = self.profiler
+        while game_lasts and not self._forced_ending_winner and self._chess_game.winner is None:
+            profiler.begin_frame()
+            events_started = perf_counter()
+            move_received_at = None
             for event in pygame.event.get():
                 if event == pygame.MOUSEBUTTONUP or pygame.MOUSEBUTTONDOWN:
                     pass
+                if event.type == pygame.USEREVENT and hasattr(event, 'posted_at'):
+                    profiler.record('event_latency', perf_counter() - event.posted_at)
+                    move_received_at = event.received_at
+                if event.type == pygame.KEYDOWN and event.key == self.HUD_KEY:
+                    self._hud = not self._hud
                 if event.type == pygame.QUIT:
                     self._winner = self.players[Color.White if self._player_color != Color.White else Color.Black]
                     self._game_state = GameState.Ended
                     pygame.quit()
                     sys.exit()
+                elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
+                    with self._lock:
+                        self._premoves.clear()
                 elif event.type == pygame.MOUSEBUTTONDOWN and self._player_color == self._chess_game.turn:
                     if event.button == 1:  # Left mouse button
                         row, col = self.get_cell_under_mouse(*event.pos)
@@ -161,52 +291,58 @@ class Game:
                             dragging_piece = board[row][col]
                             dragging_piece_pos = (row, col)
                             dragging_piece_rect = self.piece_images[str(dragging_piece)].get_rect(center=pygame.mouse.get_pos())
+                            with self._lock:
+                                drag_position = self._chess_game.position()
+                                with profiler.span('legal_targets'):
+                                    legal_targets = self._legal_moves.targets(self._chess_game, dragging_piece_pos)
+                            premove_drag = False
                             # board[row][col] = None
-                elif (event.type == pygame.MOUSEBUTTONUP and self._player_color == self._chess_game.turn and event.button == 1 and dragging_piece or
-                self._player_color != self._chess_game.turn and self.another_player_move is not None):
-                    if self._player_color == self._chess_game.turn:
-                        old_row, old_col = dragging_piece_pos
-                        row, col = self.get_cell_under_mouse(*event.pos)
-                    else:
-                        old_row, old_col = self.another_player_move[0]
-                        row, col = self.another_player_move[1]
-                        self.another_player_move = None
-
-                    move_type, check_state = self._chess_game.move((old_row, old_col), (row, col))
-
-                    if move_type == MoveType.InvalidMove:
-                        self.wrong_move.play()  # invalid move sound
-                    else:
-                        self._all_move_list.append(((old_row, old_col), (row, col)))
-
-                        self.active_clock = self.switch_clocks()
-                        if move_type == MoveType.Move and check_state == CheckState.NoCheck:
-                            self.move_sound.play()  # regular move sound
-                        elif move_type == MoveType.Take:
-                            self.take_sound.play()  # take sound
-                        elif move_type == MoveType.Castle:
-                            self.castle_sound.play()  # castle sound
-                    match check_state:
-                        case CheckState.NoCheck:
-                            checked_king_pos = None
-                        case CheckState.Check:
-                            self.check_sound.play()
-                            checked_king_pos = self._chess_game.find_king(self._chess_game.white_king if board[row][col].color == Color.Black else self._chess_game.black_king)
-                        case CheckState.Checkmate:
-                            self.game_end_sound.play()
-                            game_lasts = False  # end game
+                elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self._player_color in (Color.White, Color.Black):
+                    # a premove; where the piece can go is known only once the opponent has moved
+                    row, col = self.get_cell_under_mouse(*event.pos)
+                    with self._lock:
+                        piece = self.premove_piece((row, col)) if is_inside_board((row, col)) else None
+                    if piece is not None:
+                        dragging_piece = piece
+                        dragging_piece_pos = (row, col)
+                        dragging_piece_rect = self.piece_images[str(dragging_piece)].get_rect(center=pygame.mouse.get_pos())
+                        legal_targets = frozenset(filter(is_inside_board, ChessBoard.candidate_moves(piece, row, col)))
+                        premove_drag = True
+                elif event.type == pygame.MOUSEBUTTONUP and event.button == 1 and dragging_piece:
+                    row, col = self.get_cell_under_mouse(*event.pos)
+                    with self._lock:
+                        if premove_drag:
+                            if (row, col) in legal_targets:
+                                self.queue_premove(dragging_piece_pos, (row, col))
+                        elif self._chess_game.position() != drag_position:
+                            # the position was loaded again (e.g. on resume) while the piece was dragged
+                            self.make_move(dragging_piece_pos, (row, col))
+                        elif (row, col) not in legal_targets:
+                            self.wrong_move.play()  # invalid move sound
+                        else:
+                            # own drops were already checked against the cached legal targets
+                            self.make_move(dragging_piece_pos, (row, col), legal=True)
 
                     dragging_piece = None
                     dragging_piece_rect = None
                     dragging_piece_pos = None
+                    legal_targets = frozenset()
+                    drag_position = None
+                    premove_drag = False
                 elif event.type == pygame.MOUSEMOTION:
                     if dragging_piece:
                         dragging_piece_rect.center = pygame.mouse.get_pos()
 
-            self.draw_board(checked_king_pos)
-            self.draw_pieces(board, dragging_piece)
+            profiler.add_span('events', events_started, perf_counter())
+
+            with profiler.span('draw_board'):
+                self.draw_board(self._checked_king_pos)
+                self.draw_premoves()
+            with profiler.span('draw_pieces'):
+                self.draw_pieces(board, dragging_piece)
 
             if dragging_piece:
+                self.draw_legal_targets(legal_targets)
                 self.screen.blit(self.piece_images[str(dragging_piece)], dragging_piece_rect)
 
             if self.update_elapsed_time():
@@ -215,10 +351,20 @@ class Game:
                 self._game_state = GameState.Ended
                 self._winner = self.players[Color.White if self.clocks[Color.Black] == self.active_clock else Color.Black]
 
-            self.display_elapsed_time()
-
-            pygame.display.flip()
-            self.clock.tick(60)
+            with profiler.span('display_elapsed_time'):
+                self.display_elapsed_time()
+            if self._hud:
+                with profiler.span('hud'):
+                    self.draw_hud()
+
+            with profiler.span('flip'):
+                pygame.display.flip()
+            if move_received_at is not None:
+                profiler.record('receive_to_render', perf_counter() - move_received_at)
+            with profiler.span('idle'):
+                self.clock.tick(60)
+            profiler.end_frame()
+        profiler.close()
 
         self._game_state = GameState.Ended
         if not self._forced_ending_winner:
@@ -245,22 +391,42 @@ class Game:
 
     def update_elapsed_time(self) -> bool:
         self.active_clock.refresh_time()
-        if self.active_clock.time_passed:
+        if self.active_clock.time_passed and not self._server_clocks:
             return True
         return False
 
+    def set_clocks(self, clocks: dict[Color, float]) -> None:
+        for color, time_rest in clocks.items():
+            self.clocks[color].set_time_rest(time_rest)
+
     def display_elapsed_time(self) -> None:
         pygame.draw.rect(self.screen, self.LIGHT_BROWN, pygame.Rect(0, 0, self.SCREEN_WIDTH, self.TIMER_HEIGHT))
         pygame.draw.rect(self.screen, self.LIGHT_BROWN, pygame.Rect(0, self.SCREEN_HEIGHT-self.TIMER_HEIGHT, self.SCREEN_WIDTH, self.TIMER_HEIGHT))
 
-        font = pygame.font.SysFont('Comic Sans MS', 30)
-        text_white = font.render(self.clocks[Color.White].time_rest_str(), False, self.BLACK)
-        text_black = font.render(self.clocks[Color.Black].time_rest_str(), False, self.BLACK)
+        text_white = self.clock_font.render(self.clocks[Color.White].time_rest_str(), False, self.BLACK)
+        text_black = self.clock_font.render(self.clocks[Color.Black].time_rest_str(), False, self.BLACK)
         text_white_rect = text_white.get_rect(center=(self.SCREEN_WIDTH // 2, self.SCREEN_HEIGHT - self.TIMER_HEIGHT // 2))
         text_black_rect = text_black.get_rect(center=(self.SCREEN_WIDTH // 2, self.TIMER_HEIGHT // 2))
         self.screen.blit(text_white, text_white_rect)
         self.screen.blit(text_black, text_black_rect)
 
+    def draw_hud(self) -> None:
+        # the text is rendered again only a few times a second, so the overlay hardly shows in its own numbers
+        now = perf_counter()
+        if self._hud_image is None or now - self._hud_rendered_at >= self.HUD_REFRESH:
+            lines = [f'{name:<20} {mean:7.2f} {maximum:7.2f}' for name, mean, maximum in self.profiler.summary()]
+            lines.insert(0, f'{"ms":<20} {"mean":>7} {"max":>7}')
+            if self.profiler.tracing:
+                lines.append('tracing')
+            height = self.hud_font.get_linesize()
+            width = max(self.hud_font.size(line)[0] for line in lines)
+            self._hud_image = pygame.Surface((width + 8, height * len(lines) + 8), pygame.SRCALPHA)
+            self._hud_image.fill(self.HUD_BACKGROUND)
+            for index, line in enumerate(lines):
+                self._hud_image.blit(self.hud_font.render(line, True, self.WHITE), (4, 4 + index * height))
+            self._hud_rendered_at = now
+        self.screen.blit(self._hud_image, (0, self.TIMER_HEIGHT))
+
     def display_winner(self, winner: str):
         font = pygame.font.SysFont('Comic Sans MS', 72)
         text = font.render(f'{winner} wins!', False, (0, 0, 255))
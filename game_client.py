@@ -1,31 +1,46 @@
+import sys
 import socket
+import select
 import threading
 import logging
-from time import sleep
+from time import sleep, monotonic, perf_counter
 
 from game import *
 from serialize import *
+from session import *
 from server_network_constants import *
+from event_log import *
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 
 
 class GameClient:
-    def __init__(self, server_socket: tuple[str, int], nickname: str) -> None:
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, server_socket: tuple[str, int], nickname: str, session: Session | None = None) -> None:
+        # with a session, the game is one more channel of the connection the lobby uses
+        self._session = session
+        self._socket = None
         self._server_socket = server_socket
         self._nickname: str = nickname
+        self._token: str | None = None
+        self._nicknames: dict[Color, str] = {}
 
         self._chess_game: Game | None = None
+        # moves are sent by the game thread, pongs and reports by the network thread
+        self._send_lock = threading.Lock()
 
     @property
     def chess_game(self):
         return self._chess_game
 
+    @property
+    def token(self):
+        # lets the game be resumed by another client, e.g. after a restart
+        return self._token
+
     def connect(self):
         logging.info('Connecting to server...')
-        self._socket.connect(self._server_socket)
+        self._socket = open_game_connection(self._server_socket, self._session)
         logging.info('Connected to server!')
 
     def send_nickname(self):
@@ -33,47 +48,103 @@ class GameClient:
         self._socket.sendall(self._nickname.encode())
         logging.info('Nickname sent!')
 
-    def start_client(self, my_turn: bool) -> None:
+    def start_client(self) -> None:
         logging.info('START CLIENT METHOD and wait 0.01 sec')
         sleep(0.01)
 
         game_lasts = True
-        last_move = None
+        ended_by_server = False
         while game_lasts:
-            if not my_turn:
-                logging.info('Waiting for opponent to move...')
-                operation = receive_data(self._socket.recv(1024))
-                if operation.get('winner', None):
-                    self._chess_game.forced_game_ending(operation['winner'])
+            # own moves, premoves included, are sent by the game as soon as they are made
+            my_turn = self._chess_game.chess_board.turn == self._chess_game.player_color
+            try:
+                if not my_turn or self.server_message_waiting():
+                    if not my_turn:
+                        logging.debug('Waiting for opponent to move...')
+                    operation = receive_message(self._socket)
+                    received_at = perf_counter()
+                    self.handle_clocks(operation)
+                    if operation.get('winner', None):
+                        self._chess_game.forced_game_ending(operation['winner'])
+                        ended_by_server = True
+                        break
+                    elif operation.get('disconnected', None):
+                        self._chess_game.forced_game_ending(self._nickname)
+                        ended_by_server = True
+                        break
+                    elif operation.get('move', None) is None:
+                        # server confirmed the time of our own move
+                        continue
+                    # a premove reply is sent from receive_move, so it does not wait for the line to be logged
+                    self._chess_game.receive_move(operation['move'], received_at)
+                    logging.info('Opponent moved: %s', operation['move'], extra={'event': 'move'})
+            except (OSError, EOFError):
+                logging.info('Connection to the game server lost, resuming the game...')
+                snapshot = self.reconnect()
+                if snapshot is None:
+                    opponent = opposite_color(self._chess_game.player_color)
+                    self._chess_game.forced_game_ending(self._nicknames.get(opponent, 'Nobody'))
+                    ended_by_server = True
                     break
-                elif operation.get('disconnected', None):
-                    self._chess_game.forced_game_ending(self._nickname)
-                    break
-                else:
-                    move = operation['move']
-                logging.info(f'Opponent moved: {move}')
-                moves_length = len(self._chess_game.all_move_list)
-                self._chess_game.another_player_move = move
-                self.wait_until_move_performed(moves_length, self._chess_game.all_move_list)
-                last_move = move
-                my_turn = not my_turn
-            elif self._chess_game.all_move_list and self._chess_game.all_move_list[-1] != last_move:
-                logging.info('Self move detected. Sending to server...')
-                logging.info(f'ALL MOVE LIST: {self._chess_game.all_move_list}')
-                logging.info(f'LAST MOVE: {last_move}')
-                last_move = self._chess_game.all_move_list[-1]
-                data = {'move': last_move}
-                self._socket.sendall(send_data(data))
-                logging.info(f'Self move sent to: {self._server_socket}')
-                my_turn = not my_turn
+                # the server's snapshot wins - a move it has not received has to be made again
             game_lasts = self._chess_game.game_state == GameState.InProgress
-        self._socket.sendall(send_data({'winner': self._chess_game.winner}))
+        if not ended_by_server:
+            try:
+                self.send({'winner': self._chess_game.winner})
+            except OSError:
+                # the server already ended the game after the opponent's report
+                pass
         logging.info(f'Game ended!\nPlayer: {self._chess_game.winner} won!')
 
-    def wait_until_move_performed(self, length, list):
-        while length == len(list):
-            sleep(0.001) # used because did not want to implement synchronous programming
-            # in game.py - I wanted it to stay 'single-threaded', so didn't use semaphore
+    def send(self, message: dict) -> None:
+        with self._send_lock:
+            self._socket.sendall(pack_message(message))
+
+    def send_move(self, move) -> None:
+        # called by the game right after an own move; a move lost with the connection is made again after resuming
+        try:
+            self.send({'move': move})
+        except OSError as e:
+            logging.info('Move %s not sent: %s', move, e)
+
+    def reconnect(self) -> dict | None:
+        # the server keeps the game for RECONNECT_GRACE seconds after the connection dropped
+        deadline = monotonic() + RECONNECT_GRACE
+        while monotonic() < deadline:
+            self._socket.close()
+            try:
+                message = self.request_resume()
+            except (OSError, EOFError):
+                sleep(RECONNECT_INTERVAL)
+                continue
+            if not message.get('resume', None):
+                return None
+            snapshot = message['resume']
+            self._chess_game.load_position(snapshot['position'], snapshot['moves'])
+            self.handle_clocks({'ping': message.get('ping', None), 'clocks': snapshot['clocks']})
+            logging.info(f'Game resumed after {len(snapshot["moves"])} moves')
+            return snapshot
+        return None
+
+    def request_resume(self) -> dict:
+        self._socket = open_game_connection(self._server_socket, self._session, HANDSHAKE_TIMEOUT)
+        self._socket.sendall(pack_message({'resume': self._token}))
+        message = receive_message(self._socket)
+        self._socket.settimeout(None)
+        return message
+
+    def handle_clocks(self, operation: dict) -> None:
+        if operation.get('ping', None):
+            # answered before anything else, so the server does not charge us for the network lag
+            self.send({'pong': operation['ping']})
+        if operation.get('clocks', None):
+            self._chess_game.set_clocks(operation['clocks'])
+
+    def server_message_waiting(self) -> bool:
+        if isinstance(self._socket, Channel):
+            return self._socket.poll(0.001)
+        readable, _, _ = select.select([self._socket], [], [], 0.001)
+        return bool(readable)
 
     def start_game(self):
         logging.info(f'START GAME METHOD; THREAD: {threading.current_thread().name}')
@@ -82,14 +153,18 @@ class GameClient:
         self.send_nickname()
 
         logging.info('Waiting for the game args from server...')
-        args = receive_data(self._socket.recv(1024))
+        args = receive_message(self._socket)
+        if args.get('ping', None):
+            self._socket.sendall(pack_message({'pong': args['ping']}))
         logging.info(f'Received game args from server: {args}')
+        self._token = args['token']
+        self._nicknames = {Color.White: args['w_nick'], Color.Black: args['b_nick']}
 
-        self._chess_game = Game(*tuple(args.values()))
+        self._chess_game = Game(args['player_color'], args['w_nick'], args['b_nick'], args['time'], server_clocks=True,
+                                on_own_move=self.send_move)
 
         logging.info('Starting the game...')
-        my_turn = args['player_color'] == Color.White
-        client_thread = threading.Thread(target=self.start_client, args=(my_turn,))
+        client_thread = threading.Thread(target=self.start_client)
         client_thread.daemon = True
 
         client_thread.start()
@@ -98,8 +173,99 @@ class GameClient:
         while not self._chess_game.winner:
             sleep(1)
 
+    def resume_game(self, token: str):
+        # rebuilds the game from the server's snapshot, e.g. after the client was restarted
+        self._token = token
+        message = self.request_resume()
+        if not message.get('resume', None):
+            logging.info('The game cannot be resumed')
+            return
+        snapshot = message['resume']
+        self._nicknames = {Color.White: snapshot['w_nick'], Color.Black: snapshot['b_nick']}
+        self._chess_game = Game(message['player_color'], snapshot['w_nick'], snapshot['b_nick'], snapshot['time'], server_clocks=True,
+                                on_own_move=self.send_move)
+        self._chess_game.load_position(snapshot['position'], snapshot['moves'])
+        self.handle_clocks({'ping': message.get('ping', None), 'clocks': snapshot['clocks']})
+
+        client_thread = threading.Thread(target=self.start_client)
+        client_thread.daemon = True
+        client_thread.start()
+        self._chess_game.start()
+
+        while not self._chess_game.winner:
+            sleep(1)
+
+
+class SpectatorClient:
+    def __init__(self, server_socket: tuple[str, int], session: Session | None = None) -> None:
+        self._session = session
+        self._socket = None
+        self._server_socket = server_socket
+        self._chess_game: Game | None = None
+
+    @property
+    def chess_game(self):
+        return self._chess_game
+
+    def start_watching(self):
+        logging.info('Connecting to game as a spectator...')
+        self._socket = open_game_connection(self._server_socket, self._session)
+        self._socket.sendall(pack_message({'spectate': True}))
+        snapshot = receive_message(self._socket)['snapshot']
+        logging.info(f'Received game snapshot: {len(snapshot["moves"])} moves played')
+
+        # nobody plays Color.Empty, so every move comes from the server
+        self._chess_game = Game(Color.Empty, snapshot['w_nick'], snapshot['b_nick'], snapshot['time'], server_clocks=True)
+        self._chess_game.load_position(snapshot['position'], snapshot['moves'])
+        self._chess_game.set_clocks(snapshot['clocks'])
+
+        listen_thread = threading.Thread(target=self.listen_game)
+        listen_thread.daemon = True
+        listen_thread.start()
+        self._chess_game.start()
+
+    def listen_game(self):
+        while True:
+            try:
+                operation = receive_message(self._socket)
+                received_at = perf_counter()
+            except (OSError, EOFError):
+                self._chess_game.forced_game_ending('Nobody')
+                break
+            if operation.get('clocks', None):
+                self._chess_game.set_clocks(operation['clocks'])
+            if operation.get('winner', None):
+                self._chess_game.forced_game_ending(operation['winner'])
+                break
+            elif operation.get('disconnected', None):
+                self._chess_game.forced_game_ending('Nobody')
+                break
+            elif operation.get('move', None):
+                self._chess_game.receive_move(operation['move'], received_at)
+        self._socket.close()
+
+
+def open_game_connection(server_socket: tuple[str, int], session: Session | None = None, timeout: float | None = None):
+    # a channel of the client's session, or a connection of its own to the game's port
+    if session is not None:
+        channel = session.open_channel(server_socket[1])
+        channel.settimeout(timeout)
+        return channel
+    connection = socket.create_connection(server_socket, timeout=timeout)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
 
 def main():
+    configure_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == 'spectate':
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else GAME_SERVER_FIRST_PORT
+        SpectatorClient((SERVER_IP, port)).start_watching()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'resume':
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else GAME_SERVER_FIRST_PORT
+        GameClient((SERVER_IP, port), 'Mic').resume_game(sys.argv[2])
+        return
     game = GameClient((SERVER_IP, GAME_SERVER_FIRST_PORT), 'Mic')
     game.start_game()
 
@@ -0,0 +1,49 @@
+from board import *
+
+CHECKPOINT_INTERVAL = 8  # moves between two stored positions
+
+
+class GameReplay:
+    """
+    Positions of an archived game, replayed once without showing anything. The position after every
+    CHECKPOINT_INTERVAL-th move is kept; any other one is reached from the checkpoint before it, so seeking
+    to a move never replays more than the interval.
+    """
+
+    def __init__(self, moves, interval: int = CHECKPOINT_INTERVAL) -> None:
+        if interval < 1:
+            raise ValueError('The checkpoint interval has to be at least one move')
+        self._interval = interval
+        self.moves: list[tuple[tuple[int, int], tuple[int, int]]] = [(tuple(old), tuple(new)) for old, new in moves]
+        chess_board = ChessBoard()
+        self._checkpoints = [chess_board.position()]
+        for number, (old, new) in enumerate(self.moves, 1):
+            move_type, _ = chess_board.move(old, new)
+            if move_type == MoveType.InvalidMove:
+                raise ValueError(f'Move {number} of the game is illegal: {old} -> {new}')
+            if number % interval == 0:
+                self._checkpoints.append(chess_board.position())
+        self.san: list[str] = chess_board.moves
+        self._scratch = ChessBoard()
+
+    def __len__(self) -> int:
+        return len(self.moves)
+
+    def position(self, ply: int) -> bytes:
+        # the position after the first ply moves
+        if not 0 <= ply <= len(self.moves):
+            raise IndexError(f'The game has {len(self.moves)} moves, not {ply}')
+        checkpoint = ply // self._interval
+        self._scratch.set_position(self._checkpoints[checkpoint])
+        self._scratch.moves.clear()
+        for old, new in self.moves[checkpoint * self._interval:ply]:
+            # every move was checked when the game was replayed
+            self._scratch.move(old, new, legal=True)
+        return self._scratch.position()
+
+    def move_text(self, ply: int) -> str:
+        # the last move made before the position, e.g. '12... Nf6+'
+        if not ply:
+            return 'start'
+        number, black = divmod(ply - 1, 2)
+        return f'{number + 1}{"..." if black else "."} {self.san[ply - 1]}'
@@ -1,28 +1,70 @@
-import sys
+import queue
 import socket
+import secrets
 import threading
 import logging
 from threading import Lock
-from time import sleep
+from contextlib import contextmanager
+from time import sleep, monotonic
 
-from game import *
+from board import *
+from clock import *
 from serialize import *
+from networking import *
+from game_snapshot import *
+from timer_wheel import *
+from spectators import *
+from ratings import *
+from write_ahead_log import *
+from session import *
+from tablebase import *
+from rate_limit import *
+from event_log import *
 from server_network_constants import *
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 
+# one scheduler serves the timeouts of all games run by this server, one hub writes to all its spectators
+game_timers = TimerWheel()
+spectator_hub = SpectatorHub()
+# connections to any game which are still being handshaken, each with a thread of its own
+handshake_slots = threading.BoundedSemaphore(MAX_HANDSHAKES)
+
+# (messages a second, burst) a player may send to the game; a move comes at most once a turn anyway
+GAME_RATE_LIMITS = {
+    MessageType.Move: (20, 40),
+    MessageType.Pong: (20, 40),
+    MessageType.Pickle: (2, 10),
+}
+
+# a timer of a game whose lock is busy fires again after this many seconds, so the timer thread never waits
+TIMER_RETRY = 0.02
+
+# every game's moves together; a busy server logs a sample of them when logging is async
+relayed_moves = SampledEvent()
+
 
 class SingleGameHandler:
 
-    def __init__(self, game_name: str, socket_: tuple[str, int], first_connection_ip: str, first_player_color: Color, game_time: float):
+    def __init__(self, game_name: str, socket_: tuple[str, int], first_connection_ip: str | None, first_player_color: Color, game_time: float,
+                 increment: float = 0.0, delay: float = 0.0, timers: TimerWheel = game_timers, on_finished=None,
+                 spectators: SpectatorHub = spectator_hub, ratings: RatingTable | None = None,
+                 log: WriteAheadLog | None = None, tablebase: Tablebase | None = None):
 
         logging.info('SingleGameHandler created with socket: %s', socket_)
         self._game_name = game_name
         self._socket = socket_
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._server_socket.bind(socket_)
         self._server_socket.listen()
+        # port 0 lets the system choose a free one
+        self._socket = self._server_socket.getsockname()
+
+        # connections of players who have not joined yet, accepted here or admitted as session channels
+        self._arrivals: queue.Queue = queue.Queue()
+        self._players_joined = False
 
         self._first_connection_ip: str = first_connection_ip
         self._player1_socket = None
@@ -35,10 +77,53 @@ class SingleGameHandler:
         self._first_player_color = first_player_color
         self._game_time = game_time
         self._player_nicknames: list[str] = ['', '']
+        self._nicknames: dict[Color, str] = {}
+
+        self._clock = GameClock(TimeControl(game_time, increment, delay))
+        self._round_trip: dict[Color, RoundTripTimer] = {
+            Color.White: RoundTripTimer(),
+            Color.Black: RoundTripTimer()
+        }
+        # kept across reconnections, so a flooding player does not get a fresh allowance by resuming
+        self._rate_limits: dict[Color, RateLimiter] = {
+            Color.White: RateLimiter(GAME_RATE_LIMITS),
+            Color.Black: RateLimiter(GAME_RATE_LIMITS)
+        }
 
         self._game_lasts = False
+        self._finished = False
+        self._on_finished = on_finished
+        self._ratings = ratings
+        self._log = log
+        self._tablebase = tablebase
+        self._logged = False
+        self._game_id = secrets.token_hex(8)
+        # passed to the logging calls of the game, so its events can be told from the ones of other games
+        self._log_context = {'game': self._game_id}
+        self._snapshot = GameSnapshot()
+        # the rules are checked on a board of the server's own, so results and adjudications can be trusted
+        self._board = ChessBoard()
+        self._result: dict | None = None
+        # players resume the game after their connection dropped with these tokens
+        self._tokens: dict[str, Color] = {secrets.token_urlsafe(16): color for color in (Color.White, Color.Black)}
+        self._grace_timers: dict[Color, Timer] = {}
+        self._stale_sockets: list = []
+
+        self._spectators = spectators
+        self._spectators.start()
+        self._watched = False
+        # spectators on sessions share the connection with other channels, so they are written directly
+        self._channel_watchers: list[ChannelWatcher] = []
+
+        self._timers = timers
+        self._timers.start()
+        self._join_timer: Timer | None = None
+        self._flag_timer: Timer | None = None
+        self._idle_timer: Timer | None = None
+        self._heartbeat_timer: Timer | None = None
 
         self.lock = Lock()
+        self._reconnected = threading.Condition(self.lock)
 
     @property
     def game_name(self):
@@ -59,80 +144,586 @@ class SingleGameHandler:
         self.wait_for_players()
         white_nick = self._player_nicknames[0] if self._first_player_color == Color.White else self._player_nicknames[1]
         black_nick = self._player_nicknames[1] if white_nick != self._player_nicknames[1] else self._player_nicknames[0]
-        data = {
-            'player_color': self._first_player_color,
-            'w_nick': white_nick,
-            'b_nick': black_nick,
-            'time': self._game_time
-        }
+        self._nicknames = {Color.White: white_nick, Color.Black: black_nick}
+        time_control = self._clock.time_control
         logging.info('sending initial game info to both players...')
-        self._player1_socket.sendall(send_data(data))
-        data['player_color'] = Color.Black if self._first_player_color == Color.White else Color.White
-        self._player2_socket.sendall(send_data(data))
+        tokens = {color: token for token, color in self._tokens.items()}
+        for color in (Color.Black, Color.White):
+            data = {
+                'player_color': color,
+                'w_nick': white_nick,
+                'b_nick': black_nick,
+                'time': time_control.base,
+                'increment': time_control.increment,
+                'delay': time_control.delay,
+                'token': tokens[color]
+            }
+            if color == Color.White:
+                # white's clock starts now; the answer to the ping gives the first round trip measurement
+                data['ping'] = self._round_trip[color].ping()
+            self.player_socket(color).sendall(pack_message(data))
+        self.log_creation()
+        self._clock.start_turn(Color.White)
+
+    def log_creation(self) -> None:
+        if self._log is None:
+            return
+        time_control = self._clock.time_control
+        self._log.commit('create', self._game_id, {
+            'name': self.game_name,
+            'socket': self._socket,
+            'first_player_color': self._first_player_color,
+            'time_control': (time_control.base, time_control.increment, time_control.delay),
+            'nicknames': dict(self._nicknames),
+            'tokens': dict(self._tokens)
+        })
+        self._logged = True
+
+    def player_socket(self, color: Color):
+        return self._player1_socket if (color == self._first_player_color) else self._player2_socket
+
+    def set_player_socket(self, color: Color, player_socket) -> None:
+        if color == self._first_player_color:
+            self._player1_socket = player_socket
+        else:
+            self._player2_socket = player_socket
 
     def start(self) -> None:
-        self.send_game_initial_params()
+        self._join_timer = self._timers.schedule(JOIN_TIMEOUT, self.abandon, 'players did not join in time')
+        self.start_listening()
+        try:
+            self.send_game_initial_params()
+        except OSError:
+            # sockets were closed by the join timeout
+            logging.info('game %s was not started', self.game_name, extra=self._log_context)
+            self.finish()
+            return
+        finally:
+            self._join_timer.cancel()
         self._game_lasts = True
-        self.set_timer(self._game_time)
         thread = threading.Thread(target=self.run_game)
         thread.start()
-        self._game_lasts = False
 
-    def set_timer(self, duration):
-        timer = threading.Timer(duration, lambda: sys.exit())
-        timer.start()
+    def recover(self, game: LoggedGame) -> None:
+        """
+        Continues a game logged before the server went down. Both players have RECONNECT_GRACE to resume it
+        with their tokens; the clock of the player to move starts again once both are back.
+        """
+        self._game_id = game.game_id
+        self._log_context['game'] = game.game_id
+        self._logged = True
+        self._nicknames = game.params['nicknames']
+        self._tokens = game.params['tokens']
+        for move, _ in game.moves:
+            # logged moves were checked when they were played
+            self._board.move(*move, legal=True)
+            self._snapshot.apply_move(move)
+        color = self._snapshot.turn
+        if game.clocks is not None:
+            self._clock.restore(game.clocks, color)
+        logging.info('game %s recovered after %d moves', self.game_name, len(game.moves), extra=self._log_context)
+        with self.lock:
+            self._game_lasts = True
+            self._players_joined = True
+            for player_color in (Color.White, Color.Black):
+                self.player_disconnected(player_color)
+        self.start_listening()
+        with self._reconnected:
+            while not self._finished and self._grace_timers:
+                self._reconnected.wait()
+            if not self._finished:
+                self._clock.start_turn(color)
+        if self._finished:
+            self.finish()
+            return
+        thread = threading.Thread(target=self.run_game, args=(color,))
+        thread.start()
+
+    def start_listening(self) -> None:
+        thread = threading.Thread(target=self.accept_connections)
+        thread.daemon = True
+        thread.start()
+
+    def accept_connections(self) -> None:
+        while not self._finished:
+            try:
+                connection, address = self._server_socket.accept()
+            except OSError:
+                break
+            self.admit(connection, address)
+
+    def admit(self, connection, address: tuple[str, int]) -> None:
+        """
+        Takes a connection accepted by the game or a channel of a session. Until both players joined, connections
+        are theirs; after that they come from spectators and from players resuming the game.
+        """
+        # moves and pings are tiny messages - they must not wait for Nagle's algorithm
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            if self._finished:
+                connection.close()
+                return
+            if not self._players_joined:
+                self._arrivals.put((connection, address))
+                return
+        if not handshake_slots.acquire(blocking=False):
+            logging.warning('too many connections are being handshaken; connection from %s refused', address)
+            connection.close()
+            return
+        thread = threading.Thread(target=self.handshake, args=(connection,))
+        thread.daemon = True
+        thread.start()
+
+    def next_arrival(self):
+        arrival = self._arrivals.get()
+        if arrival is None:
+            raise OSError('the game was abandoned before the players joined')
+        return arrival
+
+    def players_joined(self) -> None:
+        # connections which came after the players are handshaken like any later connection
+        with self.lock:
+            self._players_joined = True
+        while not self._arrivals.empty():
+            arrival = self._arrivals.get()
+            if arrival is not None:
+                self.admit(*arrival)
+
+    def handshake(self, connection) -> None:
+        connection.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            message = receive_message(connection, MAX_GAME_MESSAGE)
+        except (OSError, EOFError, ValueError):
+            connection.close()
+            return
+        finally:
+            handshake_slots.release()
+        connection.settimeout(None)
+        if message.get('resume', None):
+            self.resume(connection, message['resume'])
+        elif message.get('spectate', None):
+            self.add_spectator(connection)
+        else:
+            connection.close()
+
+    def add_spectator(self, connection) -> None:
+        with self.lock:
+            if self._finished:
+                connection.close()
+                return
+            if self._spectators.watchers_count(self) + len(self._channel_watchers) >= MAX_SPECTATORS:
+                logging.warning('game %s has %d spectators; no more are admitted', self.game_name, MAX_SPECTATORS, extra=self._log_context)
+                connection.close()
+                return
+            if isinstance(connection, Channel):
+                watcher = ChannelWatcher(connection)
+                if watcher.send(pack_message({'snapshot': self.snapshot()})):
+                    self._channel_watchers.append(watcher)
+                return
+            self._watched = True
+            self._spectators.add_watcher(self, connection, pack_message({'snapshot': self.snapshot()}))
+
+    def resume(self, connection, token: str) -> None:
+        color = self._tokens.get(token, None)
+        with self.lock:
+            if color is None or self._finished:
+                self.send_silently(connection, {'resume_failed': True})
+                connection.close()
+                return
+            old_socket = self.player_socket(color)
+            self.set_player_socket(color, connection)
+            grace_timer = self._grace_timers.pop(color, None)
+            if grace_timer is not None:
+                grace_timer.cancel()
+            if not self._grace_timers:
+                self.touch()
+            self._round_trip[color].forget()
+            message = {'resume': self.snapshot(), 'player_color': color}
+            if self._clock.active == color:
+                message['ping'] = self._round_trip[color].ping()
+            self.send_silently(connection, message)
+            if old_socket is not None:
+                self._stale_sockets.append(old_socket)
+            self._reconnected.notify_all()
+        logging.info('player %s resumed game %s', self._nicknames[color], self.game_name, extra=self._log_context)
+        if old_socket is None:
+            # the game was recovered after a restart
+            return
+        try:
+            # run_game may still be reading the old connection
+            old_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-    def run_game(self) -> None:
-        white_socket = self._player1_socket if self._first_player_color == Color.White else self._player2_socket
-        black_socket = self._player2_socket if white_socket == self._player1_socket else self._player1_socket
+    def snapshot(self) -> dict:
+        # called with self.lock held, so no move can be relayed in the meantime
+        time_control = self._clock.time_control
+        return {
+            'w_nick': self._nicknames[Color.White],
+            'b_nick': self._nicknames[Color.Black],
+            'time': time_control.base,
+            'increment': time_control.increment,
+            'delay': time_control.delay,
+            'position': self._snapshot.position,
+            'moves': list(self._snapshot.moves),
+            'turn': self._clock.active,
+            'clocks': self._clock.time_rest(monotonic())
+        }
 
-        sending_socket: socket.socket = white_socket
-        receiving_socket: socket.socket = black_socket
+    def run_game(self, color: Color = Color.White) -> None:
+        winner = None
+        try:
+            winner = self.relay_messages(color)
+        finally:
+            # whatever ended the game, its port and its place on the server are given back
+            logging.info('game ended, winner: %s', winner, extra=self._log_context)
+            self.finish()
 
-        logging.info('starting the game...')
-        logging.info('CURRENT THREAD: %s', threading.current_thread().name)
+    def relay_messages(self, color: Color) -> str | None:
+        logging.info('game %s starts', self.game_name, extra=self._log_context)
+        with self.lock:
+            self.schedule_flag_fall()
+            self.touch()
+            self._heartbeat_timer = self._timers.schedule_periodic(HEARTBEAT_INTERVAL, self.heartbeat)
         winner = None
         while not winner:
-            logging.info('waiting for player move...')
+            sending_socket = self.player_socket(color)
+            logging.debug('waiting for player move...')
             try:
-                raw_data = sending_socket.recv(1024)
-                message = receive_data(raw_data)
-            except ConnectionResetError:
-                message = {'disconnected': True}
-                raw_data = send_data(message)
-
+                message_type, frame = receive_frame(sending_socket, MAX_GAME_MESSAGE)
+            except (OSError, EOFError, MessageTooLarge) as e:
+                if isinstance(e, MessageTooLarge):
+                    logging.warning('player %s sent too much: %s', self._nicknames[color], e, extra=self._log_context)
+                    self.drop_connection(sending_socket)
+                if self.wait_for_reconnect(color, sending_socket):
+                    continue
+                break
+            received_at = monotonic()
+            # messages over the limit are dropped; a player who keeps sending them loses the connection
+            rate_limit = self._rate_limits[color]
+            if not rate_limit.allow(message_type, received_at):
+                if not rate_limit.abusive:
+                    continue
+                logging.warning('player %s floods the game; disconnecting', self._nicknames[color], extra=self._log_context)
+                self.drop_connection(sending_socket)
+                if self.wait_for_reconnect(color, sending_socket):
+                    continue
+                break
+            payload = frame[MESSAGE_HEADER.size:]
             try:
-                logging.info('player move received: %s', message)
-                if message.get('move', None):
-                    receiving_socket.sendall(raw_data)
-                    logging.info('performed move sent to another player')
-                elif message.get('winner', None):
-                    winner = message['winner']
-                    receiving_socket.sendall(send_data(message))
-            except ConnectionResetError:
-                message = {'disconnected': True}
-                sending_socket.sendall(send_data(message))
+                if message_type == MessageType.Ping:
+                    # only the server pings; pings of a player would pass the rate limits and postpone abandoning
+                    raise InvalidMessage('players do not send pings')
+                message = decode_message(message_type, payload)
+            except InvalidMessage as e:
+                logging.warning('player %s sent an invalid message: %s', self._nicknames[color], e, extra=self._log_context)
+                self.drop_connection(sending_socket)
+                if self.wait_for_reconnect(color, sending_socket):
+                    continue
                 break
 
-            logging.info('next player turn...')
-            temp = sending_socket
-            sending_socket = receiving_socket
-            receiving_socket = temp
+            with self.lock:
+                if self._finished:
+                    # the flag fell or the game was abandoned while the message was on its way
+                    break
+                if self.player_socket(color) is not sending_socket:
+                    # the player has resumed the game meanwhile and got a snapshot without this message
+                    continue
+                self.touch()
+                # routed on the header; only the rare messages without a fixed payload were unpickled
+                match message_type:
+                    case MessageType.Pong:
+                        self._round_trip[color].pong(message['pong'], received_at)
+                        # the deadline depends on the round trip time
+                        self.schedule_flag_fall()
+                    case MessageType.Move:
+                        move = message['move']
+                        self._flag_timer.cancel()
+                        if not self._clock.stop_turn(received_at, self._round_trip[color].rtt):
+                            winner = self.flag_fall(color)
+                            break
+                        if self._board.move(*move)[0] == MoveType.InvalidMove:
+                            winner = self.forfeit(color, move)
+                            break
+                        self._snapshot.apply_move(move)
+                        # pongs to pings sent during this turn would come too late to measure anything
+                        self._round_trip[color].forget()
+                        clocks = self._clock.time_rest()
+                        if self._log is not None:
+                            # the move is relayed only once it is durable; other games' moves share the sync
+                            try:
+                                self._log.commit('move', self._game_id, move, clocks)
+                            except OSError as e:
+                                self.close_game(f'the move log failed: {e}')
+                                break
+                        # the clocks go first, so the ping is answered before the move is played; the move is the
+                        # player's own frame, forwarded without being packed again
+                        clocks_frame = pack_message({'clocks': clocks, 'ping': self._round_trip[opposite_color(color)].ping()})
+                        self.send_frames_to_player(opposite_color(color), [clocks_frame, frame])
+                        self._clock.start_turn(opposite_color(color))
+                        self.schedule_flag_fall()
+                        self.send_to_player(color, {'clocks': clocks})
+                        self.publish(pack_message({'move': move, 'clocks': clocks}))
+                        suppressed = relayed_moves.sample()
+                        if suppressed is not None:
+                            logging.info('move %s relayed', move, extra={'event': 'move', 'player': self._nicknames[color],
+                                                                         'suppressed': suppressed, **self._log_context})
+                        color = opposite_color(color)
+                        if self._tablebase is not None:
+                            winner = self.adjudicate()
+                    case MessageType.Pickle:
+                        logging.info('player message received: %s', message, extra={'player': self._nicknames[color], **self._log_context})
+                        if message.get('winner', None):
+                            winner = message['winner']
+                            self._result = {'winner': winner, 'clocks': self._clock.time_rest()}
+                            if winner != self.checkmating_player():
+                                # only a mate on the server's own board is rated; any other claim is just relayed
+                                self._result['claimed'] = True
+                            self.send_frames_to_player(opposite_color(color), [frame])
+        return winner
+
+    def publish(self, frame: bytes) -> None:
+        # called with self.lock held
+        if self._watched:
+            self._spectators.publish(self, frame)
+        # watchers which fell too far behind are dropped
+        self._channel_watchers = [watcher for watcher in self._channel_watchers if watcher.send(frame)]
+
+    def send_to_player(self, color: Color, message: dict) -> None:
+        self.send_frames_to_player(color, [pack_message(message)])
+
+    def send_frames_to_player(self, color: Color, frames: list) -> None:
+        # called with self.lock held; a player whose connection dropped gets the current state on resume
+        try:
+            send_frames(self.player_socket(color), frames)
+        except OSError:
+            self.player_disconnected(color)
+
+    @staticmethod
+    def drop_connection(connection) -> None:
+        # the reader of the connection sees it end and waits for the player to resume the game
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def player_disconnected(self, color: Color) -> None:
+        # called with self.lock held
+        if self._finished or color in self._grace_timers:
+            return
+        logging.info('player %s disconnected; waiting %d s for the game to be resumed', self._nicknames[color], RECONNECT_GRACE, extra=self._log_context)
+        if self._idle_timer is not None:
+            # the grace period decides about the game now
+            self._idle_timer.cancel()
+        self._grace_timers[color] = self._timers.schedule(RECONNECT_GRACE, self.reconnect_expired, color)
+
+    def wait_for_reconnect(self, color: Color, old_socket) -> bool:
+        # returns False if the game ended before the player came back
+        with self._reconnected:
+            if self.player_socket(color) is old_socket:
+                self.player_disconnected(color)
+            while not self._finished and self.player_socket(color) is old_socket:
+                self._reconnected.wait()
+            return not self._finished
+
+    def reconnect_expired(self, color: Color) -> None:
+        with self.timer_lock() as locked:
+            if not locked or self._finished or self._grace_timers.pop(color, None) is None:
+                return
+            logging.info('player %s did not resume game %s in time', self._nicknames[color], self.game_name, extra=self._log_context)
+            self._finished = True
+            opponent = opposite_color(color)
+            self._result = {'winner': self._nicknames[opponent], 'disconnected': color}
+            self.send_silently(self.player_socket(opponent), {'disconnected': True})
+            self.close_player_sockets()
+            self._reconnected.notify_all()
+
+    def schedule_flag_fall(self) -> None:
+        # called with self.lock held
+        if self._flag_timer is not None:
+            self._flag_timer.cancel()
+        color = self._clock.active
+        delay = self._clock.deadline(self._round_trip[color].rtt) - monotonic()
+        self._flag_timer = self._timers.schedule(max(delay, 0.0), self.on_flag_timer, color)
+
+    def on_flag_timer(self, color: Color) -> None:
+        with self.timer_lock() as locked:
+            if not locked or self._finished or self._clock.active != color:
+                return
+            self.flag_fall(color)
+            self.close_player_sockets()
+
+    def flag_fall(self, color: Color) -> str:
+        self._clock.flag()
+        self._finished = True
+        winner = self._nicknames[opposite_color(color)]
+        logging.info('player %s ran out of time', self._nicknames[color], extra=self._log_context)
+        message = {'winner': winner, 'flag': color, 'clocks': self._clock.time_rest()}
+        self._result = message
+        for player_socket in (self._player1_socket, self._player2_socket):
+            self.send_silently(player_socket, message)
+        self._reconnected.notify_all()
+        return winner
+
+    def adjudicate(self) -> str | None:
+        # called with self.lock held; an endgame the tablebase knows to be won is not played out. The position
+        # probed is the server's board, which only legal moves reach
+        probed = self._tablebase.probe(self._board)
+        if probed is None or not probed.wdl:
+            return None
+        turn = self._board.turn
+        winner = self._nicknames[turn if probed.wdl > 0 else opposite_color(turn)]
+        moves = abs(probed.mate)
+        logging.info('game %s adjudicated by the tablebase: %s mates in %d moves', self.game_name, winner, moves, extra=self._log_context)
+        self._finished = True
+        message = {'winner': winner, 'adjudicated': moves, 'clocks': self._clock.time_rest()}
+        self._result = message
+        for player_socket in (self._player1_socket, self._player2_socket):
+            self.send_silently(player_socket, message)
+        self._reconnected.notify_all()
+        return winner
+
+    def checkmating_player(self) -> str | None:
+        # called with self.lock held
+        return None if self._board.winner is None else self._nicknames[self._board.winner]
+
+    def forfeit(self, color: Color, move) -> str:
+        # called with self.lock held; the client of a player who sends an illegal move cannot be trusted
+        self._finished = True
+        winner = self._nicknames[opposite_color(color)]
+        logging.warning('player %s sent the illegal move %s and forfeits', self._nicknames[color], move, extra=self._log_context)
+        message = {'winner': winner, 'forfeit': color, 'clocks': self._clock.time_rest()}
+        self._result = message
+        for player_socket in (self._player1_socket, self._player2_socket):
+            self.send_silently(player_socket, message)
+        self._reconnected.notify_all()
+        return winner
+
+    def touch(self) -> None:
+        # any message from the players postpones abandoning the game
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        self._idle_timer = self._timers.schedule(IDLE_TIMEOUT, self.abandon, 'no message from players')
+
+    @contextmanager
+    def timer_lock(self):
+        """
+        The game's lock for a timer callback, which runs on the thread shared by all games: when a move of this
+        game holds the lock (e.g. while the log is synced), the callback is deferred instead of waiting.
+        """
+        locked = self.lock.acquire(blocking=False)
+        if not locked:
+            self._timers.defer(TIMER_RETRY)
+        try:
+            yield locked
+        finally:
+            if locked:
+                self.lock.release()
+
+    def heartbeat(self) -> None:
+        # only the player to move is read by run_game, so only that player is asked to answer
+        with self.timer_lock() as locked:
+            if not locked or self._finished:
+                return
+            color = self._clock.active
+            self.send_silently(self.player_socket(color), {'ping': self._round_trip[color].ping()})
+
+    def abandon(self, reason: str) -> None:
+        with self.timer_lock() as locked:
+            if not locked or self._finished:
+                return
+            self.close_game(reason)
+
+    def close_game(self, reason: str) -> None:
+        # called with self.lock held; the game ends without a result
+        logging.info('game %s abandoned: %s', self.game_name, reason, extra=self._log_context)
+        self._finished = True
+        self._result = {'disconnected': True}
+        for player_socket in (self._player1_socket, self._player2_socket):
+            if player_socket is not None:
+                self.send_silently(player_socket, {'disconnected': True})
+        self.close_player_sockets()
+        self.stop_listening()
+        # wakes up wait_for_players
+        self._arrivals.put(None)
+        self._reconnected.notify_all()
+
+    def stop_listening(self) -> None:
+        try:
+            # unlike close(), shutdown() wakes up the thread blocked in accept()
+            self._server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close_player_sockets(self) -> None:
+        # unblocks the thread reading from the sockets
+        for player_socket in (self._player1_socket, self._player2_socket):
+            if player_socket is not None:
+                try:
+                    player_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def finish(self) -> None:
+        with self.lock:
+            self._finished = True
+            self._game_lasts = False
+            for timer in (self._join_timer, self._flag_timer, self._idle_timer, self._heartbeat_timer,
+                          *self._grace_timers.values()):
+                if timer is not None:
+                    timer.cancel()
+            self._grace_timers.clear()
+            if self._watched:
+                self._spectators.close_group(self, pack_message(self._result or {'disconnected': True}))
+            for watcher in self._channel_watchers:
+                watcher.close(pack_message(self._result or {'disconnected': True}))
+        for player_socket in (self._player1_socket, self._player2_socket, *self._stale_sockets):
+            if player_socket is not None:
+                player_socket.close()
+        self.stop_listening()
+        self._server_socket.close()
+        if self._logged:
+            try:
+                self._log.commit('result', self._game_id, self._result or {'disconnected': True})
+            except OSError as e:
+                logging.error('result of game %s not logged: %s', self.game_name, e, extra=self._log_context)
+        self.rate_game()
+        if self._on_finished is not None:
+            self._on_finished(self)
+
+    def rate_game(self) -> None:
+        # abandoned games, unverified claims and games of two players with the same nickname are not rated
+        winner = (self._result or {}).get('winner', None)
+        if self._ratings is None or not winner or not self._nicknames or self._result.get('claimed', False):
+            return
+        white, black = self._nicknames[Color.White], self._nicknames[Color.Black]
+        if white == black or winner not in (white, black):
+            return
+        self._ratings.record_result(white, black, 1.0 if winner == white else 0.0)
+        logging.info('game %s rated: %s won', self.game_name, winner, extra=self._log_context)
 
-        logging.info('game ended, winner: %s', winner)
+    @staticmethod
+    def send_silently(player_socket, message: dict) -> None:
+        if player_socket is None:
+            return
+        try:
+            player_socket.sendall(pack_message(message))
+        except OSError:
+            pass
 
     def wait_for_players(self) -> None:
         logging.info('waiting for first player to join...')
         while not self.verify_first_connection():
             logging.info('WHILE LOOP waiting for player...')
-            self._player1_socket, (self._player1_ip, self._player1_port) = self._server_socket.accept()
-            logging.info('WHILE LOOP player joined!: %s', self._player1_ip, self._first_connection_ip)
+            self._player1_socket, (self._player1_ip, self._player1_port) = self.next_arrival()
+            logging.info('WHILE LOOP player joined!: %s (expected %s)', self._player1_ip, self._first_connection_ip)
         logging.info('first player joined!')
         logging.info('getting first player nickname...')
         t1 = threading.Thread(target=self.get_player_nickname, args=(self._player1_socket, 0,))
         t1.start()
         logging.info('waiting for second player to join...')
-        self._player2_socket, (self._player2_ip, self._player2_port) = self._server_socket.accept()
+        self._player2_socket, (self._player2_ip, self._player2_port) = self.next_arrival()
+        self.players_joined()
         logging.info('getting second player nickname...')
         t2 = threading.Thread(target=self.get_player_nickname, args=(self._player2_socket, 1,))
         t2.start()
@@ -148,10 +739,14 @@ class SingleGameHandler:
         self.lock.release()
 
     def verify_first_connection(self):
+        # without an expected address (matched games), the first player to connect is the first player
+        if self._first_connection_ip is None:
+            return self._player1_socket is not None
         return self._player1_ip == self._first_connection_ip
 
 
 def main():
+    configure_logging()
     server = SingleGameHandler('test_game', (SERVER_IP, GAME_SERVER_FIRST_PORT), '127.0.0.1', Color.Black, 300)
     t = threading.Thread(target=server.start)
     t.start()
@@ -0,0 +1,63 @@
+from board import *
+
+
+START_POSITION = ChessBoard().position()
+KING_CODE = PIECE_CODES[King]
+PAWN_CODE = PIECE_CODES[Pawn]
+QUEEN_CODE = PIECE_CODES[Queen]
+
+
+class GameSnapshot:
+    """
+    Position and moves of a game kept by the server. Moves are applied to the compact position with a few
+    byte operations - no legality checks are done here, the server checks moves on its ChessBoard first.
+    """
+
+    def __init__(self) -> None:
+        self._position = bytearray(START_POSITION)
+        self._moves: list[tuple[tuple[int, int], tuple[int, int]]] = []
+
+    @property
+    def position(self) -> bytes:
+        return bytes(self._position)
+
+    @property
+    def moves(self):
+        return self._moves
+
+    @property
+    def turn(self) -> Color:
+        return Color.Black if self._position[FLAGS_INDEX] & BLACK_TO_MOVE else Color.White
+
+    def apply_move(self, move) -> None:
+        (old_i, old_j), (new_i, new_j) = move
+        old, new = old_i * ChessBoard.SIZE + old_j, new_i * ChessBoard.SIZE + new_j
+        position = self._position
+        code = position[old]
+        en_passant = 0
+        if code & ~BLACK_PIECE == PAWN_CODE:
+            if old_j != new_j and not position[new]:
+                # only a pawn taking en passant moves diagonally to an empty square
+                position[old_i * ChessBoard.SIZE + new_j] = 0
+            elif abs(new_i - old_i) == 2:
+                en_passant = old_j + 1
+            if new_i in (0, ChessBoard.SIZE - 1):
+                # moves sent by the clients are always promoted to a queen, like ChessBoard does
+                code = code & BLACK_PIECE | QUEEN_CODE
+        position[new] = code
+        position[old] = 0
+        position[EN_PASSANT_INDEX] = en_passant
+        flags = position[FLAGS_INDEX]
+        if code & ~BLACK_PIECE == KING_CODE:
+            # the king gives up castling on both sides
+            for (row, _), flag in CASTLING_FLAGS.items():
+                if row == old_i:
+                    flags &= ~flag
+            if abs(new_j - old_j) == 2:
+                rook_old_j, rook_new_j = (0, 2) if new_j < old_j else (7, 4)
+                position[old_i * ChessBoard.SIZE + rook_new_j] = position[old_i * ChessBoard.SIZE + rook_old_j]
+                position[old_i * ChessBoard.SIZE + rook_old_j] = 0
+        # a rook which moved or was taken cannot castle
+        flags &= ~(CASTLING_FLAGS.get((old_i, old_j), 0) | CASTLING_FLAGS.get((new_i, new_j), 0))
+        position[FLAGS_INDEX] = flags ^ BLACK_TO_MOVE
+        self._moves.append(((old_i, old_j), (new_i, new_j)))
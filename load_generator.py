@@ -0,0 +1,479 @@
+import os
+import sys
+import json
+import random
+import pickle
+import socket
+import tempfile
+import argparse
+import selectors
+import threading
+import logging
+from collections import Counter
+from time import perf_counter, sleep
+
+from board import *
+from serialize import *
+from lobby_operation import *
+from session import *
+from server_network_constants import *
+from event_log import *
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+DRAW = 'Draw'
+
+
+def generate_game_script(max_moves: int, rng: random.Random) -> tuple[list[tuple[tuple[int, int], tuple[int, int]]], Color]:
+    """
+    Plays a random legal game on ChessBoard; returns its moves and the winning color (Color.Empty means draw).
+    Scripts are generated before the test, so simulated players do not spend CPU on move generation.
+    """
+    chess_board = ChessBoard()
+    moves = []
+    while len(moves) < max_moves:
+        legal_moves = chess_board.legal_moves()
+        if not legal_moves:
+            break
+        move = rng.choice(legal_moves)
+        chess_board.move(*move)
+        moves.append(move)
+        if chess_board.winner:
+            return moves, chess_board.winner
+    return moves, Color.Empty
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+class LoadStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.lobby_connect: list[float] = []
+        self.game_connect: list[float] = []
+        self.move_rtt: list[float] = []
+        self.spectator_latency: list[float] = []
+        self.resume: list[float] = []
+        self.match: list[float] = []
+        self.errors: Counter = Counter()
+        self.games_finished = 0
+        self.moves_relayed = 0
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+
+    def record(self, metric: str, value: float) -> None:
+        with self._lock:
+            getattr(self, metric).append(value)
+            if metric == 'move_rtt':
+                self.moves_relayed += 1
+
+    def error(self, kind: str) -> None:
+        with self._lock:
+            self.errors[kind] += 1
+
+    def game_finished(self) -> None:
+        with self._lock:
+            self.games_finished += 1
+
+    @property
+    def duration(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    def summary(self) -> dict:
+        def describe(values: list[float]) -> dict:
+            return {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p90_ms': percentile(values, 90) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': max(values, default=0.0) * 1000
+            }
+
+        duration = self.duration
+        return {
+            'duration_s': duration,
+            'games_finished': self.games_finished,
+            'moves_relayed': self.moves_relayed,
+            'moves_per_second': self.moves_relayed / duration if duration else 0.0,
+            'lobby_connect': describe(self.lobby_connect),
+            'game_connect': describe(self.game_connect),
+            'move_rtt': describe(self.move_rtt),
+            'spectator_latency': describe(self.spectator_latency),
+            'resume': describe(self.resume),
+            'match': describe(self.match),
+            'errors': dict(self.errors)
+        }
+
+
+class SimulatedGame:
+    """
+    State shared by both simulated players of one game. Both players live in this process,
+    so a move's send time can be compared directly with the moment the opponent receives it.
+    """
+    def __init__(self, game_id: int, port: int, script: list, result: Color, game_time: float) -> None:
+        self.game_id = game_id
+        self.name = f'load_{game_id}'
+        self.port = port
+        self.script = script
+        self.result = result
+        self.game_time = game_time
+        self.created = threading.Event()
+        self.started = threading.Event()
+        self.aborted = threading.Event()
+        self.sent_at: list[float | None] = [None] * len(script)
+
+    def winner_nickname(self, nicknames: dict[Color, str]) -> str:
+        return nicknames[self.result] if self.result != Color.Empty else DRAW
+
+
+class SimulatedPlayer:
+    def __init__(self, game: SimulatedGame, creator: bool, lobby_server: tuple[str, int], game_host: str,
+                 stats: LoadStats, move_interval: float, timeout: float, drop_rate: float = 0.0,
+                 matchmaking: bool = False, session_port: int | None = None) -> None:
+        self._game = game
+        self._creator = creator
+        self._lobby_server = lobby_server
+        self._game_host = game_host
+        self._stats = stats
+        self._move_interval = move_interval
+        self._timeout = timeout
+        self._drop_rate = drop_rate
+        self._matchmaking = matchmaking
+        # with a session port, the lobby and the game are channels of one connection
+        self._session_port = session_port
+        self._session: Session | None = None
+        self.nickname = f'{"c" if creator else "j"}{game.game_id}'
+
+    def run(self) -> None:
+        try:
+            if self._session_port is not None:
+                self._session = Session.connect((self._lobby_server[0], self._session_port))
+            self.use_lobby()
+            self.play_game()
+            if self._creator:
+                self._stats.game_finished()
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError) as e:
+            self._game.aborted.set()
+            self._stats.error(type(e).__name__)
+            logging.warning('player %s failed: %r', self.nickname, e)
+        finally:
+            if self._session is not None:
+                self._session.close()
+
+    def connect_game(self):
+        if self._session is not None:
+            channel = self._session.open_channel(self._game.port)
+            channel.settimeout(self._timeout)
+            return channel
+        connection = socket.create_connection((self._game_host, self._game.port), timeout=self._timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def use_lobby(self) -> None:
+        start = perf_counter()
+        if self._session is not None:
+            lobby = self._session.lobby
+            lobby.settimeout(self._timeout)
+        else:
+            lobby = socket.create_connection(self._lobby_server, timeout=self._timeout)
+        stream = lobby.makefile('rb')
+        try:
+            operation = pickle.load(stream)
+            if operation.type != OperationType.AllGames:
+                raise KeyError(f'unexpected first lobby operation: {operation.type}')
+            self._stats.record('lobby_connect', perf_counter() - start)
+
+            if self._matchmaking:
+                # every simulated game has its own time control, so both of its players are paired together
+                requested = perf_counter()
+                request = MatchRequest(self.nickname, self._game.game_time)
+                lobby.sendall(send_data(LobbyOperation(OperationType.Matchmaking, request)))
+                while operation.type != OperationType.Matchmaking:
+                    operation = pickle.load(stream)
+                    if operation.type == OperationType.Rejected:
+                        raise ConnectionRefusedError(f'lobby rejected the game: {operation.data[1]}')
+                self._game.port = operation.data.server_socket[1]
+                self._stats.record('match', perf_counter() - requested)
+                if self._creator:
+                    self._game.created.set()
+            elif self._creator:
+                color = random.choice([Color.White, Color.Black])
+                args = self._game.port, self._game.name, self.nickname, color, self._game.game_time
+                lobby.sendall(send_data(LobbyOperation(OperationType.StartGame, args)))
+                # other games are broadcast on the same connection - skip them until our game is confirmed
+                while not (operation.type == OperationType.StartGame and operation.data is None):
+                    operation = pickle.load(stream)
+                    if operation.type == OperationType.Rejected:
+                        raise ConnectionRefusedError(f'lobby rejected the game: {operation.data[1]}')
+                self._game.created.set()
+            else:
+                if not self._game.created.wait(self._timeout) or self._game.aborted.is_set():
+                    raise TimeoutError('game was not created in time')
+                game_info = GameInfo(self._game.name, (self._game_host, self._game.port), 2, self._game.name)
+                lobby.sendall(send_data(LobbyOperation(OperationType.JoinGame, game_info)))
+
+            # the lobby reads one recv(1024) per operation, so a Disconnect right after JoinGame could be merged
+            # into the same read and lost; closing our half of the connection is reported as Disconnect instead
+            lobby.shutdown(socket.SHUT_WR)
+            # drain remaining broadcasts until the server closes the connection
+            while lobby.recv(4096):
+                pass
+        finally:
+            stream.close()
+            lobby.close()
+
+    def play_game(self) -> None:
+        start = perf_counter()
+        connection = self.connect_game()
+        try:
+            connection.sendall(self.nickname.encode())
+            args = self.receive(connection)
+            self._stats.record('game_connect', perf_counter() - start)
+            self._game.started.set()
+
+            my_color = args['player_color']
+            nicknames = {Color.White: args['w_nick'], Color.Black: args['b_nick']}
+            script = self._game.script
+            for ply, move in enumerate(script):
+                if (Color.White if ply % 2 == 0 else Color.Black) == my_color:
+                    if random.random() < self._drop_rate:
+                        connection = self.resume(connection, args['token'], ply)
+                    sleep(self._move_interval * random.uniform(0.5, 1.5))
+                    self._game.sent_at[ply] = perf_counter()
+                    connection.sendall(pack_message({'move': move}))
+                else:
+                    message = self.receive(connection)
+                    received_at = perf_counter()
+                    if 'move' not in message:
+                        raise KeyError(f'expected move, got {message}')
+                    if self._game.sent_at[ply] is not None:
+                        self._stats.record('move_rtt', received_at - self._game.sent_at[ply])
+
+            if (Color.White if len(script) % 2 == 0 else Color.Black) == my_color:
+                connection.sendall(pack_message({'winner': self._game.winner_nickname(nicknames)}))
+            else:
+                message = self.receive(connection)
+                if 'winner' not in message:
+                    raise KeyError(f'expected winner, got {message}')
+        finally:
+            connection.close()
+
+    def resume(self, connection: socket.socket, token: str, ply: int) -> socket.socket:
+        # drops the connection like a phone switching networks and resumes the game on a new one
+        connection.close()
+        start = perf_counter()
+        connection = self.connect_game()
+        connection.sendall(pack_message({'resume': token}))
+        message = self.receive(connection)
+        if 'resume' not in message or len(message['resume']['moves']) != ply:
+            raise KeyError(f'expected snapshot after {ply} moves, got {message}')
+        self._stats.record('resume', perf_counter() - start)
+        return connection
+
+    @staticmethod
+    def receive(connection: socket.socket) -> dict:
+        # answers the server's pings like GameClient does and skips confirmations of own move times
+        while True:
+            message = receive_message(connection)
+            if message.get('ping', None):
+                connection.sendall(pack_message({'pong': message['ping']}))
+            if message.keys() - {'ping', 'clocks'} or 'player_color' in message:
+                return message
+
+
+class SpectatorPool:
+    """
+    Watches games like SpectatorClient does, but all spectators are read by one selector thread -
+    a thread per spectator would make the load generator, not the server, the bottleneck.
+    """
+    def __init__(self, game_host: str, stats: LoadStats, timeout: float) -> None:
+        self._game_host = game_host
+        self._stats = stats
+        self._timeout = timeout
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._watching = 0
+
+    def watch(self, game: SimulatedGame, count: int) -> None:
+        try:
+            if not game.started.wait(self._timeout) or game.aborted.is_set():
+                raise TimeoutError('game was not started in time')
+            for _ in range(count):
+                connection = socket.create_connection((self._game_host, game.port), timeout=self._timeout)
+                connection.sendall(pack_message({'spectate': True}))
+                connection.setblocking(False)
+                with self._lock:
+                    self._selector.register(connection, selectors.EVENT_READ, [game, bytearray(), None])
+                    self._watching += 1
+        except OSError as e:
+            self._stats.error(f'spectator {type(e).__name__}')
+            logging.warning('spectator of game %s failed: %r', game.game_id, e)
+
+    def run(self, players_finished: threading.Event) -> None:
+        # the server closes spectator connections when a game ends
+        deadline = None
+        while self._watching or not players_finished.is_set():
+            if players_finished.is_set():
+                deadline = deadline or perf_counter() + self._timeout
+                if perf_counter() > deadline:
+                    break
+            with self._lock:
+                events = self._selector.select(0.01) if self._watching else None
+            if events is None:
+                sleep(0.01)
+                continue
+            for key, _ in events:
+                self.read(key.fileobj, key.data)
+
+    def read(self, connection: socket.socket, state: list) -> None:
+        game, buffer, ply = state
+        try:
+            data = connection.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        received_at = perf_counter()
+        buffer += data
+        while len(buffer) >= MESSAGE_HEADER.size:
+            message_type, length = MESSAGE_HEADER.unpack_from(buffer)
+            if len(buffer) < MESSAGE_HEADER.size + length:
+                break
+            if ply is None:
+                payload = bytes(buffer[MESSAGE_HEADER.size:MESSAGE_HEADER.size + length])
+                snapshot = decode_message(message_type, payload)['snapshot']
+                ply = len(snapshot['moves'])
+            else:
+                # only moves follow the snapshot (and the result after the last one), so frames are not decoded
+                sent_at = game.sent_at[ply] if ply < len(game.sent_at) else None
+                if sent_at is not None:
+                    self._stats.record('spectator_latency', received_at - sent_at)
+                ply += 1
+            del buffer[:MESSAGE_HEADER.size + length]
+        state[2] = ply
+        if not data:
+            with self._lock:
+                self._selector.unregister(connection)
+                self._watching -= 1
+            connection.close()
+
+
+def start_lobby_server(lobby_server: tuple[str, int], session_port: int | None = SESSION_SERVER_PORT) -> None:
+    from server_lobby import ServerLobby, RatingTable, WriteAheadLog
+    # ratings of simulated players are kept in memory only; moves are logged to a scratch directory
+    log_path = os.path.join(tempfile.mkdtemp(prefix='load_test_'), 'moves.log')
+    server = ServerLobby(lobby_server, RatingTable(None, None), WriteAheadLog(log_path), session_port)
+    thread = threading.Thread(target=server.start, name='ServerLobby')
+    thread.daemon = True
+    thread.start()
+
+
+def run_load_test(players: int, lobby_server: tuple[str, int], first_port: int, move_interval: float,
+                  max_moves: int, scripts: int, ramp_up: float, timeout: float, seed: int | None,
+                  spectators: int = 0, drop_rate: float = 0.0, matchmaking: bool = False,
+                  session_port: int | None = None) -> LoadStats:
+    rng = random.Random(seed)
+    game_scripts = [generate_game_script(max_moves, rng) for _ in range(scripts)]
+    stats = LoadStats()
+
+    spectator_pool = SpectatorPool(lobby_server[0], stats, timeout)
+    players_finished = threading.Event()
+    spectators_thread = threading.Thread(target=spectator_pool.run, args=(players_finished,), name='spectators')
+    spectators_thread.daemon = True
+    spectators_thread.start()
+
+    threads = []
+    for game_id in range(players // 2):
+        script, result = game_scripts[game_id % len(game_scripts)]
+        game = SimulatedGame(game_id, first_port + game_id, script, result, game_time=3600 + (game_id if matchmaking else 0))
+        for creator in (True, False):
+            player = SimulatedPlayer(game, creator, lobby_server, lobby_server[0], stats, move_interval, timeout, drop_rate,
+                                     matchmaking, session_port)
+            thread = threading.Thread(target=player.run, name=player.nickname)
+            thread.daemon = True
+            threads.append(thread)
+        if spectators:
+            thread = threading.Thread(target=spectator_pool.watch, args=(game, spectators), name=f's{game_id}')
+            thread.daemon = True
+            threads.append(thread)
+
+    stats.started_at = perf_counter()
+    delay = ramp_up / len(threads) if threads else 0
+    for thread in threads:
+        thread.start()
+        sleep(delay)
+    for thread in threads:
+        thread.join()
+    stats.finished_at = perf_counter()
+    players_finished.set()
+    spectators_thread.join()
+    return stats
+
+
+def print_summary(summary: dict) -> None:
+    print(f'duration: {summary["duration_s"]:.2f} s, games finished: {summary["games_finished"]}, '
+          f'moves relayed: {summary["moves_relayed"]} ({summary["moves_per_second"]:.1f} moves/s)')
+    for metric in ('lobby_connect', 'game_connect', 'move_rtt', 'spectator_latency', 'resume', 'match'):
+        values = summary[metric]
+        print(f'{metric:>17}: n={values["count"]:<7} p50={values["p50_ms"]:8.2f} ms  p90={values["p90_ms"]:8.2f} ms  '
+              f'p99={values["p99_ms"]:8.2f} ms  max={values["max_ms"]:8.2f} ms')
+    print(f'           errors: {summary["errors"] or "none"}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless load generator for the chess lobby and game servers')
+    parser.add_argument('--players', type=int, default=100, help='number of simulated players (two per game)')
+    parser.add_argument('--host', default=SERVER_IP)
+    parser.add_argument('--lobby-port', type=int, default=LOBBY_SERVER_PORT)
+    parser.add_argument('--first-port', type=int, default=GAME_SERVER_FIRST_PORT, help='port of the first game server')
+    parser.add_argument('--spawn-lobby', action='store_true', help='run ServerLobby inside this process')
+    parser.add_argument('--move-interval', type=float, default=0.1, help='average seconds between own moves')
+    parser.add_argument('--max-moves', type=int, default=80, help='moves per game before it is declared a draw')
+    parser.add_argument('--scripts', type=int, default=16, help='number of distinct random games to play')
+    parser.add_argument('--ramp-up', type=float, default=1.0, help='seconds over which players connect')
+    parser.add_argument('--timeout', type=float, default=30.0, help='socket timeout per player')
+    parser.add_argument('--spectators', type=int, default=0, help='spectators watching every game')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='probability that a player drops the connection and resumes the game before a move')
+    parser.add_argument('--matchmaking', action='store_true',
+                        help='pair players through the matchmaking queue instead of creating and joining games')
+    parser.add_argument('--multiplexed', action='store_true',
+                        help='every player uses one session connection for the lobby and its game')
+    parser.add_argument('--session-port', type=int, default=SESSION_SERVER_PORT)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', default=None, help='write summary to this file')
+    parser.add_argument('--log', choices=LOG_MODES, default=None,
+                        help='log everything down to INFO in this mode, e.g. to measure its cost; only warnings by default')
+    parser.add_argument('--log-file', default=None, help='where the log goes; standard error by default')
+    args = parser.parse_args()
+
+    if args.players < 2 or args.players % 2:
+        parser.error('--players has to be an even number greater than 1')
+
+    if args.log:
+        configure_logging(args.log, logging.INFO, args.log_file)
+    lobby_server = (args.host, args.lobby_port)
+    if args.spawn_lobby:
+        start_lobby_server(lobby_server, args.session_port)
+        sleep(0.2)
+
+    stats = run_load_test(args.players, lobby_server, args.first_port, args.move_interval, args.max_moves,
+                          args.scripts, args.ramp_up, args.timeout, args.seed, args.spectators,
+                          args.drop_rate, args.matchmaking, args.session_port if args.multiplexed else None)
+    summary = stats.summary()
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(summary, file, indent=2)
+    sys.exit(1 if summary['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,14 @@ class OperationType(Enum):
     StartGame = auto()
     JoinGame = auto()
     Disconnect = auto()
+    RemoveGame = auto()
+    Matchmaking = auto()  # a MatchRequest from the player; the GameInfo of the paired game from the server
+    CancelMatchmaking = auto()
+    Leaderboard = auto()  # the number of places from the player; (nickname, rating) pairs from the server
+    Rejected = auto()  # from the server: (type of the refused operation or None for the connection, reason)
+
+
+DEFAULT_RATING = 1500
 
 
 @dataclass(frozen=False)
@@ -22,3 +30,24 @@ class GameInfo:
 class LobbyOperation:
     type: OperationType
     data: Any
+
+
+@dataclass(frozen=True)
+class MatchRequest:
+    nickname: str
+    game_time: float
+    increment: float = 0.0
+    rating: float | None = None
+    max_rating_difference: float | None = None  # None accepts any opponent
+
+    @property
+    def time_control(self) -> tuple[float, float]:
+        return self.game_time, self.increment
+
+    @property
+    def effective_rating(self) -> float:
+        return DEFAULT_RATING if self.rating is None else self.rating
+
+    def accepts(self, other: 'MatchRequest') -> bool:
+        return (self.max_rating_difference is None or
+                abs(self.effective_rating - other.effective_rating) <= self.max_rating_difference)
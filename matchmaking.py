@@ -0,0 +1,102 @@
+import threading
+from collections import deque
+
+from lobby_operation import *
+
+RATING_BAND_WIDTH = 100
+MAX_SCANNED = 8  # waiting players looked at in one band before moving to the next one
+
+
+class Waiting:
+    __slots__ = ('player', 'request', 'active')
+
+    def __init__(self, player, request: MatchRequest) -> None:
+        self.player = player
+        self.request = request
+        self.active = True
+
+
+class MatchmakingQueue:
+    """
+    Players waiting for an opponent, bucketed by time control and rating band. Each bucket is a FIFO queue, so
+    the longest waiting compatible player is paired first. Entering the queue only looks at the player's own band
+    and its neighbours - a few buckets, however many players wait. Players who leave are dropped lazily.
+    """
+
+    def __init__(self, band_width: int = RATING_BAND_WIDTH) -> None:
+        self._band_width = band_width
+        self._buckets: dict[tuple[float, float], dict[int, deque[Waiting]]] = {}
+        self._waiting: dict[object, Waiting] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    def enter(self, player, request: MatchRequest) -> tuple[object, MatchRequest] | None:
+        """
+        Pairs the player with a waiting opponent and returns the opponent with their request,
+        or queues the player and returns None. A player already in the queue is moved to the new request.
+        """
+        with self._lock:
+            self._leave(player)
+            bands = self._buckets.setdefault(request.time_control, {})
+            for band in self.candidate_bands(request, bands):
+                opponent = self.take_compatible(bands, band, request)
+                if opponent is not None:
+                    del self._waiting[opponent.player]
+                    return opponent.player, opponent.request
+            waiting = Waiting(player, request)
+            bands.setdefault(self.band(request.effective_rating), deque()).append(waiting)
+            self._waiting[player] = waiting
+            return None
+
+    def leave(self, player) -> bool:
+        with self._lock:
+            return self._leave(player)
+
+    def _leave(self, player) -> bool:
+        waiting = self._waiting.pop(player, None)
+        if waiting is None:
+            return False
+        waiting.active = False
+        return True
+
+    def band(self, rating: float) -> int:
+        return int(rating // self._band_width)
+
+    def candidate_bands(self, request: MatchRequest, bands: dict[int, deque[Waiting]]) -> list[int]:
+        # the closest bands first
+        own = self.band(request.effective_rating)
+        if request.max_rating_difference is None:
+            occupied = bands.keys()
+        else:
+            lowest = self.band(request.effective_rating - request.max_rating_difference)
+            highest = self.band(request.effective_rating + request.max_rating_difference)
+            occupied = [band for band in range(lowest, highest + 1) if band in bands]
+        return sorted(occupied, key=lambda band: abs(band - own))
+
+    @staticmethod
+    def take_compatible(bands: dict[int, deque[Waiting]], band: int, request: MatchRequest) -> Waiting | None:
+        queue = bands[band]
+        while queue and not queue[0].active:
+            queue.popleft()
+        found = None
+        scanned = 0
+        for index, waiting in enumerate(queue):
+            if scanned == MAX_SCANNED:
+                break
+            if not waiting.active:
+                continue
+            scanned += 1
+            if waiting.request.accepts(request) and request.accepts(waiting.request):
+                found = index
+                break
+        if found is None:
+            if not queue:
+                del bands[band]
+            return None
+        waiting = queue[found]
+        del queue[found]
+        if not queue:
+            del bands[band]
+        return waiting
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import timeit
+import logging
+import logging.handlers
+import argparse
+import platform
+from typing import Callable
+
+from board import *
+from serialize import *
+from lobby_operation import *
+from event_log import *
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+REGRESSION_THRESHOLD = 0.25  # slowdown against the baseline which fails the run
+REPEAT = 5
+
+# opening, middlegames, an endgame, a check and a mate; every position is benchmarked with the side to move
+CORPUS = (
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    'rnbqkbnr/ppp2ppp/8/3pp2Q/4P3/8/PPPP1PPP/RNB1KBNR b KQkq - 1 3',
+    'rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3',
+)
+
+
+def king_to_move(chess_board: ChessBoard) -> King:
+    return chess_board.white_king if chess_board.turn == Color.White else chess_board.black_king
+
+
+def board_benchmarks() -> list[tuple[str, Callable, int]]:
+    """
+    (name, function, operations per call) of the rules; a move is benchmarked together with restoring the
+    position it is made from, whose own cost is the set_position benchmark.
+    """
+    boards = [ChessBoard.from_fen(fen) for fen in CORPUS]
+    positions = [chess_board.position() for chess_board in boards]
+    moves = [(position, move) for chess_board, position in zip(boards, positions) for move in chess_board.legal_moves()]
+    pieces = [(piece, i, j) for chess_board in boards for i, line in enumerate(chess_board.board)
+              for j, piece in enumerate(line) if not isinstance(piece, EmptyPiece)]
+    scratch = ChessBoard()
+
+    def set_position():
+        for position in positions:
+            scratch.set_position(position)
+
+    def move():
+        for position, (old, new) in moves:
+            scratch.set_position(position)
+            scratch.move(old, new)
+
+    def get_check_state():
+        for chess_board in boards:
+            chess_board.get_check_state(king_to_move(chess_board))
+
+    def is_checkmate():
+        for chess_board in boards:
+            chess_board.is_checkmate(king_to_move(chess_board))
+
+    def possible_moves():
+        for piece, i, j in pieces:
+            piece.possible_moves(i, j)
+
+    return [
+        ('ChessBoard.set_position', set_position, len(positions)),
+        ('ChessBoard.move', move, len(moves)),
+        ('ChessBoard.get_check_state', get_check_state, len(boards)),
+        ('ChessBoard.is_checkmate', is_checkmate, len(boards)),
+        ('Piece.possible_moves', possible_moves, len(pieces)),
+    ]
+
+
+def serialize_benchmarks() -> list[tuple[str, Callable, int]]:
+    games = [GameInfo(f'game {number}', ('127.0.0.1', 50000 + number), number % 2, f'player{number} - 5+3')
+             for number in range(50)]
+    messages = {
+        'lobby': LobbyOperation(OperationType.AllGames, games),
+        'move': {'move': ((6, 3), (4, 3)), 'clocks': {Color.White: 287.25, Color.Black: 295.5}, 'ping': 0.012},
+    }
+    benchmarks = []
+    for kind, message in messages.items():
+        data = send_data(message)
+        benchmarks.append((f'send_data[{kind}]', lambda message=message: send_data(message), 1))
+        benchmarks.append((f'receive_data[{kind}]', lambda data=data: receive_data(data), 1))
+    # a move on the game connection, framed as the client sends it and as the server routes it
+    move = {'move': ((6, 3), (4, 3))}
+    payload = memoryview(pack_message(move))[MESSAGE_HEADER.size:]
+    benchmarks.append(('pack_message[move]', lambda: pack_message(move), 1))
+    benchmarks.append(('decode_message[move]', lambda: decode_message(MessageType.Move, payload), 1))
+    return benchmarks
+
+
+def logging_benchmarks() -> list[tuple[str, Callable, int]]:
+    """
+    A move logged by the relay in either mode, written to the null device; in async mode the caller's share is
+    sampling and queueing, while the listener thread writes the lines. A sampled event is usually dropped
+    before a record is made.
+    """
+    move = ((6, 3), (4, 3))
+    context = {'event': 'move', 'game': '0123456789abcdef'}
+    plain = logging.Logger('benchmark.plain')
+    handler = logging.FileHandler(os.devnull)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    plain.addHandler(handler)
+    queued = logging.Logger('benchmark.async')
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(EventSampler())
+    queued.addHandler(queue_handler)
+    writer = logging.FileHandler(os.devnull)
+    writer.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    SampledEvent.enabled = True
+    moves = SampledEvent()
+
+    def sampled():
+        suppressed = moves.sample()
+        if suppressed is not None:
+            queued.info('move %s relayed', move, extra={'suppressed': suppressed, **context})
+
+    return [
+        ('log[plain]', lambda: plain.info('move %s relayed', move, extra=context), 1),
+        ('log[async]', lambda: queued.info('move %s relayed', move, extra=context), 1),
+        ('log[async sampled]', sampled, 1),
+    ]
+
+
+def render_benchmarks() -> list[tuple[str, Callable, int]] | None:
+    # a whole frame of the game drawn with the SDL dummy driver, so no window is needed
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    try:
+        import pygame
+        from game import Game
+    except ImportError as e:
+        logging.warning('frame rendering not benchmarked: %s', e)
+        return []
+    try:
+        game = Game(Color.White, 'white', 'black', 300, hud=False)
+    except (OSError, pygame.error) as e:
+        # missing assets are a broken build, not a missing dependency: the other groups run, but the run fails
+        logging.error('frame rendering not benchmarked: %s', e)
+        return None
+    board = ChessBoard.from_fen(CORPUS[2]).board
+
+    def frame():
+        game.draw_board(None)
+        game.draw_pieces(board, None)
+        game.display_elapsed_time()
+        pygame.display.flip()
+
+    return [('Game frame', frame, 1)]
+
+
+BENCHMARK_GROUPS = {
+    'board': board_benchmarks,
+    'serialize': serialize_benchmarks,
+    'logging': logging_benchmarks,
+    'render': render_benchmarks,
+}
+
+
+def measure(function: Callable, operations: int, repeat: int) -> float:
+    # the fastest of the runs, in seconds per operation; each run lasts at least 0.2 s
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / (number * operations)
+
+
+def run(groups, repeat: int = REPEAT) -> tuple[dict[str, float], list[str]]:
+    # returns the results and the groups which could not be set up
+    results = {}
+    broken = []
+    for group in groups:
+        benchmarks = BENCHMARK_GROUPS[group]()
+        if benchmarks is None:
+            broken.append(group)
+            continue
+        for name, function, operations in benchmarks:
+            results[name] = measure(function, operations, repeat)
+    return results, broken
+
+
+def machine() -> dict:
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor()}
+
+
+def load_baseline(path: str) -> dict[str, float]:
+    with open(path, 'r') as file:
+        return json.load(file)['results']
+
+
+def save_baseline(path: str, results: dict[str, float]) -> None:
+    with open(path, 'w') as file:
+        json.dump({'machine': machine(), 'results': results}, file, indent=2)
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """
+    Prints every metric against the baseline; returns the names of the metrics slower by more than the threshold.
+    """
+    regressions = []
+    print(f'{"benchmark":<28} {"time":>12} {"baseline":>12} {"change":>8}')
+    for name, seconds in results.items():
+        before = baseline.get(name, None)
+        if before is None:
+            print(f'{name:<28} {seconds * 1e6:10.2f}us {"-":>12} {"new":>8}')
+            continue
+        change = seconds / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<28} {seconds * 1e6:10.2f}us {before * 1e6:10.2f}us {change:+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the hot paths, compared against a stored baseline')
+    parser.add_argument('groups', nargs='*', help=f'benchmark groups to run: {", ".join(BENCHMARK_GROUPS)}; all by default')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='JSON file with the results to compare against')
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--output', help='also write the results to this file, e.g. to keep a before and after')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='relative slowdown which counts as a regression')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs per benchmark; the fastest one is reported')
+    args = parser.parse_args()
+    unknown = set(args.groups) - set(BENCHMARK_GROUPS)
+    if unknown:
+        parser.error(f'unknown benchmark groups: {", ".join(sorted(unknown))}')
+
+    results, broken = run(args.groups or BENCHMARK_GROUPS, args.repeat)
+    baseline = load_baseline(args.baseline) if os.path.exists(args.baseline) else {}
+    regressions = compare(results, baseline, args.threshold)
+    if args.output:
+        save_baseline(args.output, results)
+    if args.save:
+        save_baseline(args.baseline, {**baseline, **results})
+        logging.info('baseline written to %s', args.baseline)
+    elif regressions:
+        logging.error('%d benchmarks regressed by more than %.0f%%: %s', len(regressions), 100 * args.threshold,
+                      ', '.join(regressions))
+        sys.exit(1)
+    if broken:
+        logging.error('benchmark groups could not be set up: %s', ', '.join(broken))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
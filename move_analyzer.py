@@ -1,56 +1,120 @@
-import threading
+import argparse
 
 import pygame
 
 from game import *
-import time
+from game_replay import *
+from serialize import *
 
 
-WAITING_TIME = 2
-DUMMY_CLICK = (0, 0), (0, 0)
+class MoveAnalyzer:
+    """
+    Shows any position of an archived game: the game is replayed once into checkpoints and the window only
+    draws the position asked for. Left and right arrows step, page up and down skip ten moves, home and end
+    jump to the start and the end, the mouse wheel scrubs and clicking the bar at the bottom seeks.
+    """
 
+    PAGE = 10  # moves skipped by page up and page down
+    LAST_MOVE = (230, 210, 60, 110)
+    SCRUB_BAR = (90, 60, 30)
+    SCRUB_MARK = (255, 255, 255)
 
-class MoveAnalyzer:
+    def __init__(self, moves, interval: int = CHECKPOINT_INTERVAL, ply: int = 0):
+        self.replay = GameReplay(moves, interval)
+        self.chess_game = Game(Color.White, 'White', 'Black', 0)
+        self.ply = 0
+        self.jump(ply)
+        self._shown_ply: int | None = None
+        self.last_move_image = pygame.Surface((Game.CELL_SIZE, Game.CELL_SIZE), pygame.SRCALPHA)
+        self.last_move_image.fill(self.LAST_MOVE)
+
+    def jump(self, ply: int) -> None:
+        self.ply = max(0, min(ply, len(self.replay)))
+
+    def step(self, plies: int) -> None:
+        self.jump(self.ply + plies)
 
-    def __init__(self, moves):
-        self.moves = moves
-        self.chess_game = Game(Color.White, 'Me', 'Opponent', 3599)
-        self.analysis_thread = None
+    def scrub(self, x: int) -> None:
+        # the bar spans the whole width; its left edge is the start of the game
+        self.jump(round(x * len(self.replay) / Game.SCREEN_WIDTH))
 
     def start_analysis(self):
-        self.analysis_thread = threading.Thread(target=self.analysis)
-        self.analysis_thread.daemon = True
-        self.analysis_thread.start()
-        self.chess_game.start()
-        pygame.quit()
-
-    def analysis(self):
-        my_turn = True
-        cell_size = Game.CELL_SIZE
-        for old, new in self.moves:
-            time.sleep(WAITING_TIME)
-            if my_turn:
-                self.simulate_click(old, new)
-            else:
-                self.chess_game.another_player_move = [old, new]
-                time.sleep(0.001)
-                self.simulate_click(*DUMMY_CLICK)  # for refreshing purposes
-            my_turn = not my_turn
-
-    def simulate_click(self, old, new):
-        old_i = old[1] * Game.CELL_SIZE + Game.CELL_SIZE // 2
-        old_j = old[0] * Game.CELL_SIZE + Game.CELL_SIZE // 2 + Game.TIMER_HEIGHT
-        new_i = new[1] * Game.CELL_SIZE + Game.CELL_SIZE // 2
-        new_j = new[0] * Game.CELL_SIZE + Game.CELL_SIZE // 2 + Game.TIMER_HEIGHT
-        mouse_down_event = pygame.event.Event(pygame.MOUSEBUTTONDOWN, {'pos': (old_i, old_j), 'button': 1})
-        mouse_up_event = pygame.event.Event(pygame.MOUSEBUTTONUP, {'pos': (new_i, new_j), 'button': 1})
-        pygame.event.post(mouse_down_event)
-        pygame.event.post(mouse_up_event)
+        scrubbing = False
+        while True:
+            for event in pygame.event.get():
+                match event.type:
+                    case pygame.QUIT:
+                        pygame.quit()
+                        return
+                    case pygame.KEYDOWN:
+                        match event.key:
+                            case pygame.K_LEFT:
+                                self.step(-1)
+                            case pygame.K_RIGHT:
+                                self.step(1)
+                            case pygame.K_PAGEUP:
+                                self.step(-self.PAGE)
+                            case pygame.K_PAGEDOWN:
+                                self.step(self.PAGE)
+                            case pygame.K_HOME:
+                                self.jump(0)
+                            case pygame.K_END:
+                                self.jump(len(self.replay))
+                    case pygame.MOUSEWHEEL:
+                        self.step(-event.y)
+                    case pygame.MOUSEBUTTONDOWN if event.button == 1 and self.on_scrub_bar(event.pos):
+                        scrubbing = True
+                        self.scrub(event.pos[0])
+                    case pygame.MOUSEMOTION if scrubbing:
+                        self.scrub(event.pos[0])
+                    case pygame.MOUSEBUTTONUP if event.button == 1:
+                        scrubbing = False
+            if self.ply != self._shown_ply:
+                self.render()
+            self.chess_game.clock.tick(60)
+
+    @staticmethod
+    def on_scrub_bar(pos: tuple[int, int]) -> bool:
+        return pos[1] >= Game.SCREEN_HEIGHT - Game.TIMER_HEIGHT
+
+    def render(self) -> None:
+        game = self.chess_game
+        game.load_position(self.replay.position(self.ply), self.replay.moves[:self.ply])
+        chess_board = game.chess_board
+        king = chess_board.white_king if chess_board.turn == Color.White else chess_board.black_king
+        checked = chess_board.get_check_state(king, verify_checkmate=False) != CheckState.NoCheck
+        game.draw_board(chess_board.find_king(king) if checked else None)
+        if self.ply:
+            for row, col in self.replay.moves[self.ply - 1]:
+                game.screen.blit(self.last_move_image, (Game.CELL_SIZE * col, Game.CELL_SIZE * row + Game.TIMER_HEIGHT))
+        game.draw_pieces(chess_board.board, None)
+        self.draw_status()
+        pygame.display.flip()
+        self._shown_ply = self.ply
+
+    def draw_status(self) -> None:
+        game = self.chess_game
+        screen = game.screen
+        bottom = Game.SCREEN_HEIGHT - Game.TIMER_HEIGHT
+        pygame.draw.rect(screen, Game.LIGHT_BROWN, pygame.Rect(0, 0, Game.SCREEN_WIDTH, Game.TIMER_HEIGHT))
+        pygame.draw.rect(screen, Game.LIGHT_BROWN, pygame.Rect(0, bottom, Game.SCREEN_WIDTH, Game.TIMER_HEIGHT))
+        text = game.clock_font.render(f'{self.replay.move_text(self.ply)}  ({self.ply}/{len(self.replay)})', False, Game.BLACK)
+        screen.blit(text, text.get_rect(center=(Game.SCREEN_WIDTH // 2, Game.TIMER_HEIGHT // 2)))
+        # how far into the game the position is
+        pygame.draw.rect(screen, self.SCRUB_BAR, pygame.Rect(0, bottom + Game.TIMER_HEIGHT // 3, Game.SCREEN_WIDTH, Game.TIMER_HEIGHT // 3))
+        x = Game.SCREEN_WIDTH * self.ply // max(1, len(self.replay))
+        pygame.draw.rect(screen, self.SCRUB_MARK, pygame.Rect(max(0, x - 3), bottom + Game.TIMER_HEIGHT // 4, 6, Game.TIMER_HEIGHT // 2))
 
 
 def main():
-    move_list = [[[6, 2], [5, 2]], [[1, 3], [2, 3]], [[6, 1], [4, 1]], [[0, 4], [4, 0]]]
-    analyzer = MoveAnalyzer(move_list)
+    parser = argparse.ArgumentParser(description='Browse the positions of an archived game')
+    parser.add_argument('game', nargs='?', help='archived game (JSON move list); a short sample game by default')
+    parser.add_argument('--move', type=int, default=0, help='number of moves made in the position shown first')
+    parser.add_argument('--interval', type=int, default=CHECKPOINT_INTERVAL, help='moves between stored positions')
+    args = parser.parse_args()
+
+    move_list = read_data_from_file(args.game) if args.game else [[[6, 2], [5, 2]], [[1, 3], [2, 3]], [[6, 1], [4, 1]], [[0, 4], [4, 0]]]
+    analyzer = MoveAnalyzer(move_list, args.interval, args.move)
     analyzer.start_analysis()
 
 
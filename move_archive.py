@@ -0,0 +1,217 @@
+import os
+import mmap
+import time
+import struct
+import logging
+import argparse
+from typing import Iterable, Iterator
+
+from serialize import *
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+# magic, version, number of games, offset of the index
+ARCHIVE_HEADER = struct.Struct('<4sHxxQQ')
+ARCHIVE_MAGIC = b'CHMA'
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = '.chma'
+MOVE = struct.Struct('<H')
+OFFSET = struct.Struct('<Q')
+
+Move = tuple[tuple[int, int], tuple[int, int]]
+
+
+def encode_move(move) -> int:
+    # 6 bits per square; the top four bits are left for promotions, which the archive does not record yet
+    (old_i, old_j), (new_i, new_j) = move
+    if not all(0 <= coordinate < 8 for coordinate in (old_i, old_j, new_i, new_j)):
+        raise ValueError(f'move off the board: {move}')
+    return (old_i * 8 + old_j) << 6 | new_i * 8 + new_j
+
+
+def decode_move(code: int) -> Move:
+    old, new = code >> 6 & 0o77, code & 0o77
+    return (old >> 3, old & 7), (new >> 3, new & 7)
+
+
+# every 12 bit move decoded in advance, so reading a game is one table lookup per move
+DECODED_MOVES = [decode_move(code) for code in range(1 << 12)]
+
+
+class ArchiveWriter:
+    """
+    Writes games as blocks of 16 bit moves, one block after another, followed by the game names and an index
+    with the offset of every block. Moves are streamed to the file; only the index is kept in memory.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, 'wb')
+        self._file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0))
+        self._move_offsets = [0]
+        self._names: list[bytes] = []
+
+    def __enter__(self) -> 'ArchiveWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def add(self, name: str, moves: Iterable) -> None:
+        codes = [encode_move(move) for move in moves]
+        self._file.write(struct.pack(f'<{len(codes)}H', *codes))
+        self._move_offsets.append(self._move_offsets[-1] + len(codes))
+        self._names.append(name.encode())
+
+    def close(self) -> None:
+        name_offsets = [0]
+        for name in self._names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        self._file.write(b''.join(self._names))
+        # the index is aligned, so it can be read as an array of 64 bit integers
+        self._file.write(bytes(-self._file.tell() % 8))
+        index_offset = self._file.tell()
+        count = len(self._names)
+        self._file.write(struct.pack(f'<{2 * (count + 1)}Q', *self._move_offsets, *name_offsets))
+        self._file.seek(0)
+        self._file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, count, index_offset))
+        self._file.close()
+
+
+class ArchiveReader:
+    """
+    Random access to an archive through mmap: a game, or a range of its moves, is decoded from its own block,
+    and nothing else is read.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self._index_offset = ARCHIVE_HEADER.unpack_from(self._map, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a move archive')
+        self._names_start = ARCHIVE_HEADER.size + MOVE.size * self.move_offset(self._count)
+
+    def __enter__(self) -> 'ArchiveReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def move_offset(self, game: int) -> int:
+        # in moves from the first block; the offset of the game after the last one is the number of all moves
+        return OFFSET.unpack_from(self._map, self._index_offset + OFFSET.size * game)[0]
+
+    def name_offset(self, game: int) -> int:
+        return OFFSET.unpack_from(self._map, self._index_offset + OFFSET.size * (self._count + 1 + game))[0]
+
+    def name(self, game: int) -> str:
+        self.check(game)
+        return self._map[self._names_start + self.name_offset(game):self._names_start + self.name_offset(game + 1)].decode()
+
+    def move_count(self, game: int) -> int:
+        self.check(game)
+        return self.move_offset(game + 1) - self.move_offset(game)
+
+    def check(self, game: int) -> None:
+        if not 0 <= game < self._count:
+            raise IndexError(f'game {game} is not in the archive of {self._count} games')
+
+    def raw_moves(self, game: int, start: int = 0, stop: int | None = None) -> memoryview:
+        # the encoded moves without copying them; the view has to be released before the reader is closed
+        count = self.move_count(game)
+        start, stop, _ = slice(start, stop).indices(count)
+        first = ARCHIVE_HEADER.size + MOVE.size * (self.move_offset(game) + start)
+        return memoryview(self._map)[first:first + MOVE.size * max(0, stop - start)]
+
+    def moves(self, game: int, start: int = 0, stop: int | None = None) -> list[Move]:
+        raw = self.raw_moves(game, start, stop)
+        return [DECODED_MOVES[code & 0o7777] for code in struct.unpack(f'<{len(raw) // MOVE.size}H', raw)]
+
+    def games(self) -> Iterator[tuple[str, list[Move]]]:
+        for game in range(self._count):
+            yield self.name(game), self.moves(game)
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def read_games(archive_path: str) -> Iterator[tuple[str, list]]:
+    """
+    Games of an archive file, or of a directory of JSON move lists written by the lobby client.
+    """
+    if os.path.isfile(archive_path):
+        with ArchiveReader(archive_path) as reader:
+            yield from reader.games()
+        return
+    # scandir does not list the whole directory at once
+    with os.scandir(archive_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                yield entry.name, read_data_from_file(entry.path)
+            except (OSError, ValueError) as e:
+                logging.warning('skipping archived game %s: %s', entry.name, e)
+
+
+def pack_directory(directory: str, archive_path: str) -> int:
+    with ArchiveWriter(archive_path) as writer:
+        count = 0
+        for name, moves in read_games(directory):
+            try:
+                writer.add(name, moves)
+            except (TypeError, ValueError) as e:
+                logging.warning('skipping archived game %s: %s', name, e)
+                continue
+            count += 1
+    return count
+
+
+def unpack_archive(archive_path: str, directory: str) -> int:
+    os.makedirs(directory, exist_ok=True)
+    count = 0
+    with ArchiveReader(archive_path) as reader:
+        for name, moves in reader.games():
+            write_data_to_file([[list(old), list(new)] for old, new in moves], os.path.join(directory, name))
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the game archive between JSON files and one indexed binary file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = subparsers.add_parser('pack', help='write all JSON games of a directory to an archive file')
+    pack_parser.add_argument('directory', help='archive directory')
+    pack_parser.add_argument('archive', help=f'archive file ({ARCHIVE_SUFFIX})')
+    unpack_parser = subparsers.add_parser('unpack', help='write every game of an archive file as a JSON file')
+    unpack_parser.add_argument('archive', help=f'archive file ({ARCHIVE_SUFFIX})')
+    unpack_parser.add_argument('directory', help='archive directory')
+    show_parser = subparsers.add_parser('show', help='print the moves of one game')
+    show_parser.add_argument('archive', help=f'archive file ({ARCHIVE_SUFFIX})')
+    show_parser.add_argument('game', type=int, help='game number')
+    show_parser.add_argument('--start', type=int, default=0, help='first move')
+    show_parser.add_argument('--stop', type=int, default=None, help='move after the last one')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    match args.command:
+        case 'pack':
+            count = pack_directory(args.directory, args.archive)
+            logging.info('%d games packed to %s (%d bytes) in %.2f s', count, args.archive,
+                         os.path.getsize(args.archive), time.perf_counter() - started)
+        case 'unpack':
+            count = unpack_archive(args.archive, args.directory)
+            logging.info('%d games unpacked to %s in %.2f s', count, args.directory, time.perf_counter() - started)
+        case 'show':
+            with ArchiveReader(args.archive) as reader:
+                print(reader.name(args.game))
+                for old, new in reader.moves(args.game, args.start, args.stop):
+                    print(list(old), list(new))
+
+
+if __name__ == '__main__':
+    main()
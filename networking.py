@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from time import monotonic
 import socket
 
 
@@ -6,3 +7,37 @@ import socket
 class Socket:
     connection: socket.socket
     info: tuple[str, int]
+
+
+class RoundTripTimer:
+    """
+    Measures round trip time of a connection: every ping is answered immediately by the client with a pong
+    carrying the same sequence number. The estimate is smoothed the same way TCP smooths its RTT.
+    """
+    SMOOTHING = 0.125
+
+    def __init__(self) -> None:
+        self._sequence = 0
+        self._pending: dict[int, float] = {}
+        self._rtt: float | None = None
+
+    @property
+    def rtt(self) -> float | None:
+        return self._rtt
+
+    def ping(self) -> int:
+        self._sequence += 1
+        self._pending[self._sequence] = monotonic()
+        return self._sequence
+
+    def pong(self, sequence: int, received_at: float | None = None) -> float | None:
+        sent_at = self._pending.pop(sequence, None)
+        if sent_at is None:
+            return None
+        sample = (monotonic() if received_at is None else received_at) - sent_at
+        self._rtt = sample if self._rtt is None else self._rtt + self.SMOOTHING * (sample - self._rtt)
+        return sample
+
+    def forget(self) -> None:
+        # pings which were not answered in time are not used for measurement
+        self._pending.clear()
@@ -0,0 +1,228 @@
+import os
+import re
+import sys
+import bz2
+import gzip
+import argparse
+import logging
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, TextIO
+
+from board import *
+from serialize import *
+from move_archive import read_games, ArchiveWriter, ARCHIVE_SUFFIX
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+SEVEN_TAG_ROSTER = {'Event': '?', 'Site': '?', 'Date': '????.??.??', 'Round': '?', 'White': '?', 'Black': '?', 'Result': '*'}
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+TAG_RE = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*]')
+TOKEN_RE = re.compile(r'[{}();]|\$\d+|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s{}();$]+')
+LINE_LENGTH = 80
+
+
+@dataclass
+class PgnGame:
+    headers: dict[str, str] = field(default_factory=dict)
+    moves: list[str] = field(default_factory=list)  # in SAN
+    result: str = '*'
+
+    def start_board(self) -> ChessBoard:
+        fen = self.headers.get('FEN', None)
+        return ChessBoard.from_fen(fen) if fen else ChessBoard()
+
+    def coordinate_moves(self) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+        """
+        Replays the game; raises ValueError on an illegal or ambiguous move.
+        """
+        chess_board = self.start_board()
+        moves = []
+        for san in self.moves:
+            old, new, promotion = chess_board.parse_san(san)
+            chess_board.move(old, new, promotion)
+            moves.append((old, new))
+        return moves
+
+
+def read_pgn(stream: TextIO) -> Iterator[PgnGame]:
+    """
+    Yields games one by one, so only the game being read is kept in memory.
+    Comments, variations and annotation glyphs are skipped.
+    """
+    game = PgnGame()
+    in_comment = False
+    variation_depth = 0
+    for line in stream:
+        if not in_comment and not variation_depth:
+            stripped = line.lstrip('\ufeff').strip()
+            if stripped.startswith('['):
+                if game.moves:
+                    # the previous game had no result at the end of its moves
+                    yield finish_game(game)
+                    game = PgnGame()
+                match = TAG_RE.match(stripped)
+                if match:
+                    game.headers[match[1]] = match[2].replace('\\"', '"').replace('\\\\', '\\')
+                continue
+            if stripped.startswith('%'):
+                # escaped line
+                continue
+        for token in TOKEN_RE.findall(line):
+            if in_comment:
+                in_comment = token != '}'
+                continue
+            match token:
+                case '{':
+                    in_comment = True
+                case ';':
+                    # comment to the end of the line
+                    break
+                case '(':
+                    variation_depth += 1
+                case ')':
+                    variation_depth = max(0, variation_depth - 1)
+                case _ if variation_depth or token[0] == '$' or token[0].isdigit() and token[-1] == '.':
+                    continue
+                case _ if token in RESULTS:
+                    game.result = token
+                    yield finish_game(game)
+                    game = PgnGame()
+                case _:
+                    game.moves.append(token)
+    if game.moves or game.headers:
+        yield finish_game(game)
+
+
+def finish_game(game: PgnGame) -> PgnGame:
+    if game.result == '*':
+        game.result = game.headers.get('Result', '*')
+    game.headers['Result'] = game.result
+    return game
+
+
+def write_pgn(stream: TextIO, games: Iterable[PgnGame]) -> int:
+    count = 0
+    for game in games:
+        stream.write(format_game(game))
+        count += 1
+    return count
+
+
+def format_game(game: PgnGame) -> str:
+    headers = {tag: game.headers.get(tag, default) for tag, default in SEVEN_TAG_ROSTER.items()}
+    headers.update(game.headers)
+    headers['Result'] = game.result
+    lines = [f'[{tag} "{escape_tag(value)}"]' for tag, value in headers.items()]
+    lines.append('')
+
+    start = game.start_board()
+    number = start.fullmove_number
+    black_first = start.turn == Color.Black
+    tokens = []
+    for ply, san in enumerate(game.moves):
+        if ply == 0 and black_first:
+            tokens.append(f'{number}...')
+        elif (ply % 2 == 0) != black_first:
+            tokens.append(f'{number}.')
+        tokens.append(san)
+        if (ply % 2 == 1) != black_first:
+            number += 1
+    tokens.append(game.result)
+
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > LINE_LENGTH:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    return '\n'.join(lines) + '\n\n'
+
+
+def escape_tag(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def game_from_moves(moves, headers: dict[str, str] | None = None) -> PgnGame:
+    # moves are lists of coordinates as stored in the archive
+    chess_board = ChessBoard()
+    for old, new in moves:
+        move_type, _ = chess_board.move(tuple(old), tuple(new))
+        if move_type == MoveType.InvalidMove:
+            raise ValueError(f'Illegal move: {old} -> {new}')
+    result = '*'
+    if chess_board.winner is not None:
+        result = '1-0' if chess_board.winner == Color.White else '0-1'
+    return finish_game(PgnGame(dict(headers or {}), chess_board.moves, result))
+
+
+def read_archive(archive_path: str) -> Iterator[PgnGame]:
+    # a directory of JSON games or an archive file
+    for name, moves in read_games(archive_path):
+        try:
+            yield game_from_moves(moves, {'Event': name})
+        except (ValueError, TypeError) as e:
+            logging.warning('skipping archived game %s: %s', name, e)
+
+
+def import_pgn(stream: TextIO, archive_path: str) -> int:
+    # games are written to an archive file if the path has its suffix, otherwise as JSON files to a directory
+    writer = ArchiveWriter(archive_path) if archive_path.endswith(ARCHIVE_SUFFIX) else None
+    if writer is None:
+        os.makedirs(archive_path, exist_ok=True)
+    count = 0
+    for index, game in enumerate(read_pgn(stream)):
+        if 'FEN' in game.headers:
+            # archived games always start from the initial position
+            logging.warning('skipping game %d: it does not start from the initial position', index)
+            continue
+        try:
+            moves = game.coordinate_moves()
+        except ValueError as e:
+            logging.warning('skipping game %d: %s', index, e)
+            continue
+        players = f'{game.headers.get("White", "?")}-{game.headers.get("Black", "?")}'
+        filename = f'{index:09}_' + re.sub(r'[^\w-]', '_', players)
+        if writer is None:
+            write_data_to_file(moves, os.path.join(archive_path, filename))
+        else:
+            writer.add(filename, moves)
+        count += 1
+    if writer is not None:
+        writer.close()
+    return count
+
+
+def open_text(path: str, mode: str) -> TextIO:
+    # '-' means standard input / output; compressed dumps are read and written on the fly
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    opener = {'.gz': gzip.open, '.bz2': bz2.open}.get(os.path.splitext(path)[1], open)
+    return opener(path, mode + 't', encoding='utf-8', errors='replace')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import PGN files into the game archive and export the archive to PGN')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='store every game of a PGN file in the archive')
+    import_parser.add_argument('pgn', help='PGN file (.gz and .bz2 are decompressed, - reads standard input)')
+    import_parser.add_argument('archive', help=f'archive directory or file ({ARCHIVE_SUFFIX})')
+    export_parser = subparsers.add_parser('export', help='write all archived games to a PGN file')
+    export_parser.add_argument('archive', help='archive directory or file')
+    export_parser.add_argument('pgn', help='PGN file (.gz and .bz2 are compressed, - writes standard output)')
+    args = parser.parse_args()
+
+    match args.command:
+        case 'import':
+            with open_text(args.pgn, 'r') as stream:
+                count = import_pgn(stream, args.archive)
+            logging.info('%d games imported to %s', count, args.archive)
+        case 'export':
+            with open_text(args.pgn, 'w') as stream:
+                count = write_pgn(stream, read_archive(args.archive))
+            logging.info('%d games exported to %s', count, args.pgn)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,10 @@ class Color(Enum):
     Empty = auto()
 
 
+def opposite_color(color: Color) -> Color:
+    return Color.White if color == Color.Black else Color.Black
+
+
 BOARD_SIZE = 8
 
 
@@ -72,7 +76,11 @@ class Pawn(Piece):
         return move_i+i, j
 
     def possible_takes(self, i, j) -> list[tuple[int, int]]:
-        move_i, move_j = self.possible_moves(i, j)[0]
+        forward = self.possible_moves(i, j)
+        if not forward:
+            # pawn standing on the last rank cannot take anything
+            return []
+        move_i, move_j = forward[0]
         return filter_outside_board([(move_i, move_j+1), (move_i, move_j-1)])
 
     def en_passant(self, i, j) -> list[tuple[int, int]]:
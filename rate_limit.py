@@ -0,0 +1,46 @@
+from time import monotonic
+
+STRIKE_LIMIT = (1.0, 20)  # refused messages a second and in a burst before a client counts as abusive
+
+
+class TokenBucket:
+    """
+    Lets through rate messages a second on average and up to burst of them at once: the bucket refills
+    continuously and every message takes one token out of it.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def take(self, now: float | None = None) -> bool:
+        now = monotonic() if now is None else now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    The token buckets of one connection, one for every kind of message given a (rate, burst) limit; other kinds
+    always pass. Refused messages are strikes, which have a bucket of their own - a client which runs it dry is
+    not just bursty but abusive, and should be disconnected.
+    """
+
+    def __init__(self, limits: dict, strikes: tuple[float, float] = STRIKE_LIMIT) -> None:
+        self._buckets = {kind: TokenBucket(*limit) for kind, limit in limits.items()}
+        self._strikes = TokenBucket(*strikes)
+        self.abusive = False
+
+    def allow(self, kind, now: float | None = None) -> bool:
+        bucket = self._buckets.get(kind, None)
+        if bucket is None or bucket.take(now):
+            return True
+        if not self._strikes.take(now):
+            self.abusive = True
+        return False
@@ -0,0 +1,149 @@
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from ratings import *
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+MAX_ITERATIONS = 100
+
+
+def g(phi: np.ndarray) -> np.ndarray:
+    return 1 / np.sqrt(1 + 3 * phi * phi / (np.pi * np.pi))
+
+
+def new_volatilities(phi: np.ndarray, sigma: np.ndarray, v: np.ndarray, delta: np.ndarray) -> np.ndarray:
+    # the Illinois algorithm of ratings.new_volatility, run for all players of a rating period at once
+    a = np.log(sigma * sigma)
+    phi2 = phi * phi
+
+    def f(x: np.ndarray, mask=slice(None)) -> np.ndarray:
+        ex = np.exp(x)
+        return (ex * (delta[mask] ** 2 - phi2[mask] - v[mask] - ex) / (2 * (phi2[mask] + v[mask] + ex) ** 2) -
+                (x - a[mask]) / (TAU * TAU))
+
+    upper = a.copy()
+    excess = delta * delta - phi2 - v
+    lower = np.where(excess > 0, np.log(np.maximum(excess, 1e-300)), a - TAU)
+    searching = excess <= 0
+    while searching.any():
+        below = f(lower[searching], searching) < 0
+        indices = np.flatnonzero(searching)
+        lower[indices[below]] -= TAU
+        searching[indices[~below]] = False
+    f_upper, f_lower = f(upper), f(lower)
+    for _ in range(MAX_ITERATIONS):
+        active = np.abs(lower - upper) > CONVERGENCE
+        if not active.any():
+            break
+        middle = upper[active] + (upper[active] - lower[active]) * f_upper[active] / (f_lower[active] - f_upper[active])
+        f_middle = f(middle, active)
+        crossed = f_middle * f_lower[active] <= 0
+        upper[active] = np.where(crossed, lower[active], upper[active])
+        f_upper[active] = np.where(crossed, f_lower[active], f_upper[active] / 2)
+        lower[active], f_lower[active] = middle, f_middle
+    return np.exp(upper / 2)
+
+
+def recompute(played_at: np.ndarray, white: np.ndarray, black: np.ndarray, score: np.ndarray, players: int,
+              period: float = RATING_PERIOD) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rates all games from scratch with Glicko-2, in rating periods of the given length. Games are given as arrays
+    of times, player indices and white's scores; returns ratings, deviations, volatilities, games and last games
+    per player. Each period is one vectorized update of everybody who played in it.
+    """
+    mu = np.zeros(players)
+    phi = np.full(players, DEFAULT_DEVIATION / SCALE)
+    sigma = np.full(players, DEFAULT_VOLATILITY)
+    games = np.bincount(white, minlength=players) + np.bincount(black, minlength=players)
+    last_played = np.full(players, np.nan)
+    if not len(played_at):
+        return DEFAULT_RATING + SCALE * mu, SCALE * phi, sigma, games, last_played
+
+    order = np.argsort(played_at, kind='stable')
+    played_at, white, black, score = played_at[order], white[order], black[order], score[order]
+    periods = ((played_at - played_at[0]) // period).astype(np.int64)
+    boundaries = np.flatnonzero(np.diff(periods)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(periods)]))
+    max_phi = DEFAULT_DEVIATION / SCALE
+    # players who have not played yet keep the default deviation
+    started = np.zeros(players, dtype=bool)
+    previous_period = periods[0]
+    for start, end in zip(starts, ends):
+        # periods without any game make the deviation of everybody grow
+        idle = periods[start] - previous_period - 1
+        if idle > 0:
+            phi[started] = np.minimum(np.sqrt(phi[started] ** 2 + idle * sigma[started] ** 2), max_phi)
+        previous_period = periods[start]
+
+        period_white, period_black, period_score = white[start:end], black[start:end], score[start:end]
+        sides = np.concatenate((period_white, period_black))
+        opponents = np.concatenate((period_black, period_white))
+        scores = np.concatenate((period_score, 1 - period_score))
+        g_opponent = g(phi[opponents])
+        expected = 1 / (1 + np.exp(-g_opponent * (mu[sides] - mu[opponents])))
+        variance_inverse = np.bincount(sides, g_opponent * g_opponent * expected * (1 - expected), minlength=players)
+        improvement = np.bincount(sides, g_opponent * (scores - expected), minlength=players)
+
+        played = variance_inverse > 0
+        v = 1 / variance_inverse[played]
+        sigma_played = new_volatilities(phi[played], sigma[played], v, v * improvement[played])
+        phi_star = np.minimum(np.sqrt(phi[played] ** 2 + sigma_played ** 2), max_phi)
+        new_phi = 1 / np.sqrt(1 / (phi_star * phi_star) + 1 / v)
+
+        rest = started & ~played
+        phi[rest] = np.minimum(np.sqrt(phi[rest] ** 2 + sigma[rest] ** 2), max_phi)
+        mu[played] += new_phi * new_phi * improvement[played]
+        phi[played] = new_phi
+        sigma[played] = sigma_played
+        started |= played
+        last_played[sides] = np.concatenate((played_at[start:end], played_at[start:end]))
+    return DEFAULT_RATING + SCALE * mu, SCALE * phi, sigma, games, last_played
+
+
+def load_results(results_path: str) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    results = list(read_results(results_path))
+    played_at = np.array([result[0] for result in results], dtype=np.float64)
+    nicknames, indices = np.unique(np.array([result[1:3] for result in results], dtype=str).reshape(-1, 2),
+                                   return_inverse=True)
+    indices = indices.reshape(-1, 2)
+    score = np.array([result[3] for result in results], dtype=np.float64)
+    return [str(nickname) for nickname in nicknames], played_at, indices[:, 0], indices[:, 1], score
+
+
+def recompute_table(results_path: str = RESULTS_PATH, ratings_path: str = RATINGS_PATH,
+                    period: float = RATING_PERIOD) -> RatingTable:
+    nicknames, played_at, white, black, score = load_results(results_path)
+    ratings, deviations, volatilities, games, last_played = recompute(played_at, white, black, score,
+                                                                      len(nicknames), period)
+    records = [PlayerRecord(nickname, float(rating), float(deviation), float(volatility), int(count),
+                            None if np.isnan(last) else float(last))
+               for nickname, rating, deviation, volatility, count, last
+               in zip(nicknames, ratings, deviations, volatilities, games, last_played)]
+    table = RatingTable(None, None)
+    table.replace_players(records, len(played_at))
+    table.save(ratings_path)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute all Glicko-2 ratings from the logged results')
+    parser.add_argument('--results', default=RESULTS_PATH, help='log of rated games')
+    parser.add_argument('--ratings', default=RATINGS_PATH, help='player table written by the recomputation')
+    parser.add_argument('--period', type=float, default=RATING_PERIOD / 3600, help='rating period in hours')
+    parser.add_argument('--top', type=int, default=10, help='leaderboard places printed')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    table = recompute_table(args.results, args.ratings, args.period * 3600)
+    logging.info('%d players rated in %.2f s', len(table), time.perf_counter() - started)
+    for place, player in enumerate(table.leaderboard(args.top), start=1):
+        print(f'{place:>3}. {player.nickname:<20} {player.rating:7.1f} ±{2 * player.deviation:.0f} ({player.games} games)')
+
+
+if __name__ == '__main__':
+    main()
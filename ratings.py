@@ -0,0 +1,262 @@
+import os
+import json
+import math
+import time
+import bisect
+import heapq
+import logging
+import threading
+from dataclasses import dataclass
+
+from lobby_operation import DEFAULT_RATING
+
+# Glicko-2 (Glickman, "Example of the Glicko-2 system")
+DEFAULT_DEVIATION = 350.0
+DEFAULT_VOLATILITY = 0.06
+TAU = 0.5  # limits the change of the volatility
+SCALE = 173.7178
+CONVERGENCE = 1e-6
+RATING_PERIOD = 24 * 3600.0  # seconds
+
+RATINGS_PATH = 'ratings.json'
+RESULTS_PATH = 'results.jsonl'
+SNAPSHOT_EVERY = 1000  # results between two snapshots of the player table
+LEADERBOARD_SIZE = 100
+
+
+@dataclass
+class PlayerRecord:
+    nickname: str
+    rating: float = DEFAULT_RATING
+    deviation: float = DEFAULT_DEVIATION
+    volatility: float = DEFAULT_VOLATILITY
+    games: int = 0
+    last_played: float | None = None
+
+
+def g(phi: float) -> float:
+    return 1 / math.sqrt(1 + 3 * phi * phi / (math.pi * math.pi))
+
+
+def new_volatility(phi: float, sigma: float, v: float, delta: float) -> float:
+    # the Illinois algorithm from step 5 of the Glicko-2 paper
+    a = math.log(sigma * sigma)
+
+    def f(x: float) -> float:
+        ex = math.exp(x)
+        return ex * (delta * delta - phi * phi - v - ex) / (2 * (phi * phi + v + ex) ** 2) - (x - a) / (TAU * TAU)
+
+    upper = a
+    if delta * delta > phi * phi + v:
+        lower = math.log(delta * delta - phi * phi - v)
+    else:
+        k = 1
+        while f(a - k * TAU) < 0:
+            k += 1
+        lower = a - k * TAU
+    f_upper, f_lower = f(upper), f(lower)
+    while abs(lower - upper) > CONVERGENCE:
+        middle = upper + (upper - lower) * f_upper / (f_lower - f_upper)
+        f_middle = f(middle)
+        if f_middle * f_lower <= 0:
+            upper, f_upper = lower, f_lower
+        else:
+            f_upper /= 2
+        lower, f_lower = middle, f_middle
+    return math.exp(upper / 2)
+
+
+def glicko2_update(player: PlayerRecord, results: list[tuple[float, float, float]],
+                   periods: float = 1.0) -> tuple[float, float, float]:
+    """
+    New (rating, deviation, volatility) of the player after games against opponents given as
+    (rating, deviation, score) tuples. The deviation grows by the new volatility once per elapsed rating period.
+    """
+    mu = (player.rating - DEFAULT_RATING) / SCALE
+    phi = player.deviation / SCALE
+    sigma = player.volatility
+    if not results:
+        return player.rating, min(SCALE * math.sqrt(phi * phi + periods * sigma * sigma), DEFAULT_DEVIATION), sigma
+    variance_inverse = 0.0
+    improvement = 0.0
+    for rating, deviation, score in results:
+        g_opponent = g(deviation / SCALE)
+        expected = 1 / (1 + math.exp(-g_opponent * (mu - (rating - DEFAULT_RATING) / SCALE)))
+        variance_inverse += g_opponent * g_opponent * expected * (1 - expected)
+        improvement += g_opponent * (score - expected)
+    v = 1 / variance_inverse
+    sigma = new_volatility(phi, sigma, v, v * improvement)
+    phi_star = min(math.sqrt(phi * phi + periods * sigma * sigma), DEFAULT_DEVIATION / SCALE)
+    phi = 1 / math.sqrt(1 / (phi_star * phi_star) + 1 / v)
+    mu += phi * phi * improvement
+    return DEFAULT_RATING + SCALE * mu, SCALE * phi, sigma
+
+
+class Leaderboard:
+    """
+    The best players, kept sorted as ratings change. More than the published places are kept, so a leader who
+    drops out is usually replaced from the list itself; the player table is scanned only when it runs short.
+    """
+
+    def __init__(self, players: dict[str, PlayerRecord], size: int = LEADERBOARD_SIZE) -> None:
+        self._players = players
+        self._size = size
+        self._capacity = 2 * size
+        self._entries: list[tuple[float, str]] = []
+        self._members: dict[str, tuple[float, str]] = {}
+        # True while every player of the table is on the list
+        self._complete = True
+        self.refill()
+
+    @staticmethod
+    def key(player: PlayerRecord) -> tuple[float, str]:
+        return -player.rating, player.nickname
+
+    def update(self, player: PlayerRecord) -> None:
+        old_key = self._members.pop(player.nickname, None)
+        if old_key is not None:
+            del self._entries[bisect.bisect_left(self._entries, old_key)]
+        key = self.key(player)
+        # every player off the list is behind its last entry
+        if self._complete or self._entries and key < self._entries[-1]:
+            bisect.insort(self._entries, key)
+            self._members[player.nickname] = key
+            if len(self._entries) > self._capacity:
+                del self._members[self._entries.pop()[1]]
+                self._complete = False
+        if not self._complete and len(self._entries) < self._size:
+            self.refill()
+
+    def refill(self) -> None:
+        self._entries = sorted(heapq.nsmallest(self._capacity, map(self.key, self._players.values())))
+        self._members = {key[1]: key for key in self._entries}
+        self._complete = len(self._entries) == len(self._players)
+
+    def top(self, count: int | None = None) -> list[PlayerRecord]:
+        count = self._size if count is None else min(count, self._size)
+        return [self._players[nickname] for _, nickname in self._entries[:count]]
+
+
+class RatingTable:
+    """
+    Player records rated with Glicko-2 and updated after every game. Results are appended to a log, so the
+    ratings can be recomputed in rating periods by rating_batch; the table itself is saved as a snapshot
+    together with the number of logged results it includes. Without paths the table is kept in memory only.
+    """
+
+    def __init__(self, path: str | None = RATINGS_PATH, results_path: str | None = RESULTS_PATH,
+                 leaderboard_size: int = LEADERBOARD_SIZE) -> None:
+        self._path = path
+        self._results_path = results_path
+        self._players: dict[str, PlayerRecord] = {}
+        self._results = 0
+        self._saved_results = 0
+        self._lock = threading.Lock()
+        self._leaderboard = Leaderboard(self._players, leaderboard_size)
+        self.load()
+        self._results_file = open(results_path, 'a', encoding='utf-8') if results_path else None
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def get(self, nickname: str) -> PlayerRecord:
+        # unknown players get the default record, which is not stored
+        with self._lock:
+            player = self._players.get(nickname, None)
+            return PlayerRecord(nickname) if player is None else PlayerRecord(**vars(player))
+
+    def rating(self, nickname: str) -> float:
+        return self.get(nickname).rating
+
+    def leaderboard(self, count: int | None = None) -> list[PlayerRecord]:
+        with self._lock:
+            return [PlayerRecord(**vars(player)) for player in self._leaderboard.top(count)]
+
+    def record_result(self, white: str, black: str, score: float, played_at: float | None = None) -> None:
+        """
+        Rates a game; score is white's: 1 for a win, 0.5 for a draw and 0 for a loss.
+        """
+        played_at = time.time() if played_at is None else played_at
+        with self._lock:
+            self.apply_result(white, black, score, played_at)
+            self._results += 1
+            if self._results_file is not None:
+                self._results_file.write(json.dumps([played_at, white, black, score]) + '\n')
+                self._results_file.flush()
+            if self._results - self._saved_results >= SNAPSHOT_EVERY:
+                self.save_snapshot()
+
+    def apply_result(self, white: str, black: str, score: float, played_at: float) -> None:
+        # called with self._lock held
+        players = [self._players.get(nickname, None) or PlayerRecord(nickname) for nickname in (white, black)]
+        updated = []
+        for player, opponent, player_score in ((players[0], players[1], score), (players[1], players[0], 1 - score)):
+            periods = 0.0 if player.last_played is None else max(0.0, played_at - player.last_played) / RATING_PERIOD
+            updated.append(glicko2_update(player, [(opponent.rating, opponent.deviation, player_score)], periods))
+        for player, (rating, deviation, volatility) in zip(players, updated):
+            player.rating, player.deviation, player.volatility = rating, deviation, volatility
+            player.games += 1
+            player.last_played = played_at
+            self._players[player.nickname] = player
+            self._leaderboard.update(player)
+
+    def replace_players(self, players: list[PlayerRecord], results: int) -> None:
+        # used by the batch recomputation; results is the number of logged results the records include
+        with self._lock:
+            self._players.clear()
+            self._players.update((player.nickname, player) for player in players)
+            self._results = results
+            self._leaderboard.refill()
+            self.save_snapshot()
+
+    def load(self) -> None:
+        if self._path and os.path.exists(self._path):
+            with open(self._path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+            for fields in snapshot['players']:
+                player = PlayerRecord(*fields)
+                self._players[player.nickname] = player
+            self._results = self._saved_results = snapshot['results']
+            self._leaderboard.refill()
+        # results logged after the snapshot are rated again
+        for index, (played_at, white, black, score) in enumerate(read_results(self._results_path)):
+            if index >= self._saved_results:
+                self.apply_result(white, black, score, played_at)
+                self._results += 1
+        if self._results != self._saved_results:
+            logging.info('%d rated games replayed from %s', self._results - self._saved_results, self._results_path)
+
+    def save(self, path: str | None = None) -> None:
+        with self._lock:
+            self.save_snapshot(path)
+
+    def save_snapshot(self, path: str | None = None) -> None:
+        # called with self._lock held; the snapshot replaces the previous one atomically
+        path = path or self._path
+        self._saved_results = self._results
+        if not path:
+            return
+        players = [[player.nickname, player.rating, player.deviation, player.volatility, player.games, player.last_played]
+                   for player in self._players.values()]
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump({'results': self._results, 'players': players}, file)
+        os.replace(temporary_path, path)
+
+    def close(self) -> None:
+        self.save()
+        if self._results_file is not None:
+            self._results_file.close()
+
+
+def read_results(results_path: str | None):
+    # (time, white, black, white's score) of every logged game
+    if not results_path or not os.path.exists(results_path):
+        return
+    with open(results_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line may be cut short by a crash
+                logging.warning('skipping malformed result in %s: %r', results_path, line)
@@ -10,6 +10,8 @@
 
 import pickle
 import json
+import struct
+from enum import IntEnum
 
 
 def receive_data(data):
@@ -29,3 +31,167 @@ def read_data_from_file(filename):
     with open(filename, 'r') as file:
         data = json.load(file)
     return data
+
+
+class MessageTooLarge(ValueError):
+    pass
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+class MessageType(IntEnum):
+    Pickle = 0  # any other message, decoded with pickle
+    Move = 1
+    Ping = 2
+    Pong = 3
+
+
+# messages on the game connection are framed with their type and length, so several of them can be sent in a row
+# and the server can route them on the header alone; the frequent ones have fixed payloads instead of pickles
+MESSAGE_HEADER = struct.Struct('!BI')
+MOVE_PAYLOAD = struct.Struct('!4B')
+BOARD_SIZE = 8
+SEQUENCE_PAYLOAD = struct.Struct('!I')
+
+
+def pack_message(data) -> bytes:
+    keys = data.keys() if isinstance(data, dict) else None
+    if keys == {'move'}:
+        (old_i, old_j), (new_i, new_j) = data['move']
+        return pack_frame(MessageType.Move, MOVE_PAYLOAD.pack(old_i, old_j, new_i, new_j))
+    if keys == {'ping'}:
+        return pack_frame(MessageType.Ping, SEQUENCE_PAYLOAD.pack(data['ping']))
+    if keys == {'pong'}:
+        return pack_frame(MessageType.Pong, SEQUENCE_PAYLOAD.pack(data['pong']))
+    return pack_frame(MessageType.Pickle, send_data(data))
+
+
+def pack_frame(message_type: MessageType, payload: bytes) -> bytes:
+    return MESSAGE_HEADER.pack(message_type, len(payload)) + payload
+
+
+def decode_move_payload(payload) -> tuple[tuple[int, int], tuple[int, int]]:
+    # the bytes come from a client; a square off the board would be written past the squares of the position
+    old_i, old_j, new_i, new_j = unpack_payload(MOVE_PAYLOAD, payload)
+    if max(old_i, old_j, new_i, new_j) >= BOARD_SIZE:
+        raise InvalidMessage(f'move off the board: {(old_i, old_j)} -> {(new_i, new_j)}')
+    return (old_i, old_j), (new_i, new_j)
+
+
+def unpack_payload(payload_struct: struct.Struct, payload) -> tuple:
+    try:
+        return payload_struct.unpack(payload)
+    except struct.error as e:
+        raise InvalidMessage(f'payload of {len(payload)} bytes: {e}') from e
+
+
+def decode_message(message_type: int, payload):
+    """
+    A message of the game connection; anything which is not a well-formed message raises InvalidMessage.
+    """
+    match message_type:
+        case MessageType.Move:
+            return {'move': decode_move_payload(payload)}
+        case MessageType.Ping:
+            return {'ping': unpack_payload(SEQUENCE_PAYLOAD, payload)[0]}
+        case MessageType.Pong:
+            return {'pong': unpack_payload(SEQUENCE_PAYLOAD, payload)[0]}
+        case MessageType.Pickle:
+            try:
+                message = receive_data(payload)
+            except Exception as e:
+                # a broken pickle can raise almost anything
+                raise InvalidMessage(f'message cannot be unpickled: {e!r}') from e
+            if not isinstance(message, dict):
+                raise InvalidMessage(f'message is a {type(message).__name__}, not a dict')
+            return message
+        case _:
+            raise InvalidMessage(f'unknown message type {message_type}')
+
+
+def receive_frame(connection, max_size: int | None = None) -> tuple[int, memoryview]:
+    """
+    The type of the next message and the whole frame, header included, so it can be forwarded as it is;
+    the payload is the frame from MESSAGE_HEADER.size on. A payload longer than max_size is refused before
+    anything is allocated for it.
+    """
+    header = receive_exactly(connection, MESSAGE_HEADER.size)
+    message_type, length = MESSAGE_HEADER.unpack(header)
+    if max_size is not None and length > max_size:
+        raise MessageTooLarge(f'message of {length} bytes, at most {max_size} are accepted')
+    frame = memoryview(bytearray(MESSAGE_HEADER.size + length))
+    frame[:MESSAGE_HEADER.size] = header
+    receive_into(connection, frame[MESSAGE_HEADER.size:])
+    return message_type, frame
+
+
+def receive_message(connection, max_size: int | None = None):
+    message_type, frame = receive_frame(connection, max_size)
+    return decode_message(message_type, frame[MESSAGE_HEADER.size:])
+
+
+def receive_exactly(connection, size: int) -> bytes:
+    buffer = bytearray(size)
+    receive_into(connection, memoryview(buffer))
+    return bytes(buffer)
+
+
+def receive_into(connection, view: memoryview) -> None:
+    received = 0
+    while received < len(view):
+        chunk_size = connection.recv_into(view[received:])
+        if not chunk_size:
+            raise EOFError('connection closed by peer')
+        received += chunk_size
+
+
+class BoundedReader:
+    """
+    A binary file for pickle.load which reads at most limit bytes of one pickle from the stream under it, so
+    a client cannot make the server buffer an endless one; reset() before every pickle.
+    """
+
+    def __init__(self, stream, limit: int) -> None:
+        self._stream = stream
+        self._limit = limit
+        self._remaining = limit
+
+    def reset(self) -> None:
+        self._remaining = self._limit
+
+    def _consume(self, size: int) -> None:
+        if size > self._remaining:
+            raise MessageTooLarge(f'pickle longer than {self._limit} bytes')
+        self._remaining -= size
+
+    def read(self, size: int = -1) -> bytes:
+        self._consume(self._remaining + 1 if size is None or size < 0 else size)
+        return self._stream.read(size)
+
+    def readinto(self, buffer) -> int:
+        self._consume(len(memoryview(buffer).cast('B')))
+        return self._stream.readinto(buffer)
+
+    def readline(self, size: int = -1) -> bytes:
+        line = self._stream.readline(self._remaining + 1 if size is None or size < 0 else min(size, self._remaining + 1))
+        self._consume(len(line))
+        return line
+
+    def peek(self, size: int = 0) -> bytes:
+        return self._stream.peek(size)
+
+
+def send_frames(connection, frames: list) -> None:
+    # several messages in one system call where the connection supports it; sendmsg may send only a part of them
+    if not hasattr(connection, 'sendmsg'):
+        connection.sendall(b''.join(frames))
+        return
+    views = [memoryview(frame) for frame in frames]
+    while views:
+        sent = connection.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
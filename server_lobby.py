@@ -1,40 +1,96 @@
 import sys
+import pickle
+import random
 import socket
 import threading
 import logging
 
 from game_server import *
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from serialize import *
 from lobby_operation import *
 from networking import *
+from matchmaking import *
+from session import *
+from rate_limit import *
+from event_log import *
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 
+# (operations a second, burst) one player may send; each game started costs a thread and a listening socket
+LOBBY_RATE_LIMITS = {
+    OperationType.StartGame: (0.2, 3),
+    OperationType.JoinGame: (1, 5),
+    OperationType.Matchmaking: (0.5, 3),
+    OperationType.CancelMatchmaking: (0.5, 3),
+    OperationType.Leaderboard: (1, 5),
+}
+
 
 class ServerLobby:
 
-    def __init__(self, socket_: tuple[str, int]) -> None:
+    def __init__(self, socket_: tuple[str, int], ratings: RatingTable | None = None,
+                 log: WriteAheadLog | None = None, session_port: int | None = SESSION_SERVER_PORT,
+                 tablebase: Tablebase | None = None, max_players: int = MAX_PLAYERS, max_games: int = MAX_GAMES) -> None:
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server_socket.bind(socket_)
         self._server_socket.listen()
+        # clients which carry the lobby and all their games over one connection connect here
+        self._session_socket = None
+        if session_port is not None:
+            self._session_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._session_socket.bind((socket_[0], session_port))
+            self._session_socket.listen()
 
         self._player_list: list[Socket] = []
         self._game_list: list[GameInfo] = []
         self._players_thread: list[threading.Thread] = []
         self._games_thread: list[threading.Thread] = []
+        # running games by port, which is how session channels name the game they lead to
+        self._games: dict[int, SingleGameHandler] = {}
         self._running = True
         self._lock = threading.Lock()
+        # past these, new connections and new games are refused, while the ones already there carry on
+        self._max_players = max_players
+        self._max_games = max_games
+        # paired games are not put on the game list, so they are never broadcast to other players
+        self._matchmaking = MatchmakingQueue()
+        self._ratings = RatingTable() if ratings is None else ratings
+        self._log = WriteAheadLog() if log is None else log
+        # won endgames are adjudicated when the tablebase file is there
+        self._tablebase = open_tablebase() if tablebase is None else tablebase
 
     def start(self):
+        self.recover_games()
+        if self._session_socket is not None:
+            thread = threading.Thread(target=self.listen_for_sessions, name='Sessions')
+            thread.daemon = True
+            thread.start()
         logging.info('listening for new players...')
         self.listen_for_new_players()
 
+    def recover_games(self) -> None:
+        # games which were being played when the server went down wait for their players to resume them
+        for game in self._log.active_games.values():
+            params = game.params
+            game_handler = SingleGameHandler(params['name'], params['socket'], None, params['first_player_color'],
+                                             *params['time_control'], on_finished=self.game_finished,
+                                             ratings=self._ratings, log=self._log, tablebase=self._tablebase)
+            self.register_game(game_handler)
+            thread = threading.Thread(target=game_handler.recover, args=(game,))
+            self._games_thread.append(thread)
+            thread.start()
+        if self._log.active_games:
+            logging.info('%d games recovered from the move log', len(self._log.active_games))
+
     def listen_for_new_players(self):
         while self._running:
             player_socket = Socket(*self._server_socket.accept())
             logging.info('new player found!')
+            if self.full():
+                self.refuse_connection(player_socket.connection)
+                continue
             self.inform_new_player(player_socket.connection)
             with self._lock:
                 logging.info('adding new player to the list of players...')
@@ -44,66 +100,189 @@ class ServerLobby:
                 logging.info('player added and started constant checking for his operations')
                 thread.start()
 
+    def full(self) -> bool:
+        with self._lock:
+            return len(self._player_list) >= self._max_players
+
+    def refuse_connection(self, connection) -> None:
+        logging.warning('%d players are connected; new connection refused', self._max_players)
+        try:
+            connection.sendall(send_data(LobbyOperation(OperationType.Rejected, (None, 'the server is full'))))
+        except OSError:
+            pass
+        connection.close()
+
     def inform_new_player(self, player: socket.socket):
-        logging.info('informing player about all available games')
+        logging.debug('informing player about all available games')
         player.sendall(send_data(LobbyOperation(OperationType.AllGames, self._game_list)))
-        logging.info('player informed')
+        logging.debug('player informed')
+
+    def listen_for_sessions(self) -> None:
+        while self._running:
+            try:
+                connection, address = self._session_socket.accept()
+            except OSError:
+                break
+            if self.full():
+                self.refuse_connection(connection)
+                continue
+            # a game message or an operation with the frame header around it is the longest frame a client sends
+            session = Session(connection, on_open=self.open_game_channel,
+                              max_frame=max(MAX_LOBBY_OPERATION, MESSAGE_HEADER.size + MAX_GAME_MESSAGE),
+                              max_buffer=MAX_CHANNEL_BUFFER, max_channels=MAX_CHANNELS)
+            player = Socket(session.lobby, address)
+            limiter = RateLimiter(LOBBY_RATE_LIMITS)
+            # lobby operations are handled right in the session's reader, so a player costs one thread
+            session.lobby.handler = lambda data, player=player: self.handle_lobby_frame(player, limiter, data)
+            logging.info('new player found on a session!')
+            self.inform_new_player(player.connection)
+            with self._lock:
+                self._player_list.append(player)
+            thread = threading.Thread(target=self.serve_session, args=(session,))
+            thread.daemon = True
+            thread.start()
+
+    def serve_session(self, session: Session) -> None:
+        session.run()
+        session.close()
+
+    def handle_lobby_frame(self, player: Socket, limiter: RateLimiter, data: bytes | None) -> None:
+        try:
+            operation = pickle.loads(data) if data is not None else None
+        except (EOFError, pickle.UnpicklingError):
+            operation = None
+        self.handle_operation(player, operation, limiter)
+
+    def open_game_channel(self, channel: Channel, port: int) -> None:
+        with self._lock:
+            game_handler = self._games.get(port, None)
+        if game_handler is None:
+            logging.info('channel to unknown game on port %d refused', port)
+            channel.close()
+            return
+        game_handler.admit(channel, channel.getpeername())
 
     def listen_for_player_operations(self, player: Socket):
         logging.info('constant checking for player operations...')
+        # pickles are self-delimiting - operations sent right after each other are not merged into one read
+        stream = player.connection.makefile('rb')
+        reader = BoundedReader(stream, MAX_LOBBY_OPERATION)
+        limiter = RateLimiter(LOBBY_RATE_LIMITS)
         while self._running:
+            reader.reset()
             try:
-                operation = receive_data(player.connection.recv(1024))
-            except (EOFError, ConnectionResetError):
+                operation = pickle.load(reader)
+            except (EOFError, OSError, ValueError, pickle.UnpicklingError):
                 operation = None
                 logging.info('Disconnect message')
-            logging.info('operation found!')
-            if not operation:
+            if not self.handle_operation(player, operation, limiter):
+                stream.close()
+                break
+
+    def handle_operation(self, player: Socket, operation: LobbyOperation | None, limiter: RateLimiter | None = None) -> bool:
+        # returns False once the player has left the lobby
+        log_context = {'connection': player.info}
+        logging.debug('operation found!')
+        if not operation:
+            operation = LobbyOperation(OperationType.Disconnect, None)
+        if limiter is not None and not limiter.allow(operation.type):
+            if limiter.abusive:
+                logging.warning('player %s floods the lobby; disconnecting', player.info, extra=log_context)
                 operation = LobbyOperation(OperationType.Disconnect, None)
-            match operation.type:
-                case OperationType.StartGame:
-                    logging.info('player wants to start a game')
-                    game_info = self.start_game(player, *operation.data)
-                    logging.info('broadcasting new game to all players')
-                    self.broadcast(LobbyOperation(OperationType.StartGame, game_info), player)
-                case OperationType.JoinGame:
-                    logging.info('player joined game')
-                    if operation.data.players_connected == 2:
-                        logging.info('Both players are ready; removing game from list...')
-                        self.remove_from_game_list(operation.data)
-                        logging.info('informing other players about started game...')
-                        self.broadcast(operation, player)
-                        logging.info('other players informed')
-                case OperationType.Disconnect:
-                    logging.info('player wants to disconnect')
-                    self.disconnect_player(player)
-                    break
-
-    def remove_from_game_list(self, value: GameInfo) -> None:
+            else:
+                self.reject(player, operation.type, 'too many requests')
+                return True
+        match operation.type:
+            case OperationType.StartGame if self.overloaded():
+                self.reject(player, operation.type, 'the server runs too many games')
+            case OperationType.StartGame:
+                logging.info('player wants to start a game', extra=log_context)
+                game_info = self.start_game(player, *operation.data)
+                logging.info('broadcasting new game to all players', extra=log_context)
+                self.broadcast(LobbyOperation(OperationType.StartGame, game_info), player)
+            case OperationType.JoinGame:
+                logging.info('player joined game', extra=log_context)
+                if operation.data.players_connected == 2:
+                    logging.info('Both players are ready; removing game from list...', extra=log_context)
+                    self.remove_from_game_list(operation.data)
+                    logging.info('informing other players about started game...', extra=log_context)
+                    self.broadcast(operation, player)
+                    logging.info('other players informed', extra=log_context)
+            case OperationType.Matchmaking if self.overloaded():
+                self.reject(player, operation.type, 'the server runs too many games')
+            case OperationType.Matchmaking:
+                self.enter_matchmaking(player, operation.data)
+            case OperationType.CancelMatchmaking:
+                self._matchmaking.leave(player)
+            case OperationType.Leaderboard:
+                leaders = [(record.nickname, record.rating) for record in self._ratings.leaderboard(operation.data)]
+                player.connection.sendall(send_data(LobbyOperation(OperationType.Leaderboard, leaders)))
+            case OperationType.Disconnect:
+                logging.info('player wants to disconnect', extra=log_context)
+                self._matchmaking.leave(player)
+                self.disconnect_player(player)
+                return False
+        return True
+
+    def overloaded(self) -> bool:
+        with self._lock:
+            return len(self._games) >= self._max_games
+
+    def reject(self, player: Socket, operation_type: OperationType, reason: str) -> None:
+        logging.warning('%s from %s rejected: %s', operation_type.name, player.info, reason, extra={'connection': player.info})
+        try:
+            player.connection.sendall(send_data(LobbyOperation(OperationType.Rejected, (operation_type, reason))))
+        except OSError:
+            pass
+
+    def remove_from_game_list(self, value: GameInfo) -> bool:
         for i in range(len(self._game_list)):
             game_info = self._game_list[i]
             if (game_info.name, game_info.server_socket) == (value.name, value.server_socket):
                 del self._game_list[i]
-                break
+                return True
+        return False
+
+    def register_game(self, game_handler: SingleGameHandler) -> None:
+        with self._lock:
+            self._games[game_handler.socket[1]] = game_handler
+
+    def game_finished(self, game_handler: SingleGameHandler, game_info: GameInfo | None = None) -> None:
+        with self._lock:
+            if self._games.get(game_handler.socket[1], None) is game_handler:
+                del self._games[game_handler.socket[1]]
+        # game which was still on the list was abandoned before the second player joined
+        if game_info is not None and self.remove_from_game_list(game_info):
+            logging.info('game %s abandoned; informing players...', game_info.name)
+            self.broadcast(LobbyOperation(OperationType.RemoveGame, game_info), None)
 
     def broadcast(self, data, sender: Socket):
-        logging.info('broadcast started...')
+        logging.debug('broadcast started...')
         with self._lock:
             for player in self._player_list:
                 if player != sender:
                     player.connection.sendall(send_data(data))
-        logging.info('broadcast ended')
+        logging.debug('broadcast ended')
 
     def disconnect_server(self):
         self._running = False
+        self._ratings.close()
+        self._log.close()
+        if self._session_socket is not None:
+            self._session_socket.close()
         with self._lock:
             for player in self._player_list:
                 player.connection.close()
 
-    def start_game(self, player: Socket, server_port, game_name: str, nickname: str, color: Color, game_time: float) -> GameInfo:
+    def start_game(self, player: Socket, server_port, game_name: str, nickname: str, color: Color, game_time: float,
+                   increment: float = 0.0, delay: float = 0.0) -> GameInfo:
         logging.info('starting game for player; creating SingleGameHandler...')
-        game_handler = SingleGameHandler(game_name, (SERVER_IP, server_port), player.info[0], color, game_time)
-        game_info = GameInfo(game_name, (SERVER_IP, server_port), 1, f'{game_name}; {opposite_color(color).name}; {game_time}')
+        time_control = f'{game_time}+{increment}' if increment else f'{game_time}'
+        game_info = GameInfo(game_name, (SERVER_IP, server_port), 1, f'{game_name}; {opposite_color(color).name}; {time_control}')
+        game_handler = SingleGameHandler(game_name, (SERVER_IP, server_port), player.info[0], color, game_time, increment, delay,
+                                         on_finished=lambda handler: self.game_finished(handler, game_info),
+                                         ratings=self._ratings, log=self._log, tablebase=self._tablebase)
+        self.register_game(game_handler)
         self._game_list.append(game_info)
         thread = threading.Thread(target=game_handler.start)
         self._games_thread.append(thread)
@@ -114,14 +293,52 @@ class ServerLobby:
         logging.info('player informed about his game handler')
         return game_info
 
+    def enter_matchmaking(self, player: Socket, request: MatchRequest) -> None:
+        # players are paired by the rating the server keeps, not by the one they claim
+        request = replace(request, rating=self._ratings.rating(request.nickname))
+        match = self._matchmaking.enter(player, request)
+        if match is None:
+            logging.info('%s waits for an opponent (%s+%s)', request.nickname, request.game_time, request.increment)
+            return
+        opponent, opponent_request = match
+        game_info = self.start_matched_game(opponent_request, request)
+        operation = LobbyOperation(OperationType.Matchmaking, game_info)
+        with self._lock:
+            for matched_player in (opponent, player):
+                try:
+                    matched_player.connection.sendall(send_data(operation))
+                except OSError:
+                    # the other player is left alone in the game, which is abandoned after the join timeout
+                    logging.info('matched player %s is gone', matched_player.info)
+
+    def start_matched_game(self, first_request: MatchRequest, second_request: MatchRequest) -> GameInfo:
+        game_name = f'{first_request.nickname} vs {second_request.nickname}'
+        color = random.choice([Color.White, Color.Black])
+        # the system chooses a free port; whichever player connects first gets the color
+        game_handler = SingleGameHandler(game_name, (SERVER_IP, 0), None, color, first_request.game_time,
+                                         first_request.increment, on_finished=self.game_finished,
+                                         ratings=self._ratings, log=self._log, tablebase=self._tablebase)
+        self.register_game(game_handler)
+        time_control = f'{first_request.game_time}+{first_request.increment}' if first_request.increment else f'{first_request.game_time}'
+        game_info = GameInfo(game_name, game_handler.socket, 2, f'{game_name}; {time_control}')
+        thread = threading.Thread(target=game_handler.start)
+        self._games_thread.append(thread)
+        thread.start()
+        logging.info('matched game %s started on %s', game_name, game_handler.socket)
+        return game_info
+
     def disconnect_player(self, player):
         with self._lock:
+            if player not in self._player_list:
+                # a session's lobby channel reports its end after the Disconnect operation closed it
+                return
             self._player_list.remove(player)
         player.connection.close()
         logging.info('player disconnected')
 
 
 def main():
+    configure_logging()
     server_lobby = ServerLobby((SERVER_IP, LOBBY_SERVER_PORT))
     server_lobby.start()
 
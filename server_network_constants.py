@@ -2,3 +2,22 @@ SERVER_IP = '127.0.0.1'
 GAME_SERVER_FIRST_PORT = 10000
 GAME_SERVER_LAST_PORT = 10010
 LOBBY_SERVER_PORT = 54321
+SESSION_SERVER_PORT = 54322  # one connection for the lobby and all games of a client
+
+# timeouts of the game server (seconds)
+JOIN_TIMEOUT = 300
+HEARTBEAT_INTERVAL = 5
+IDLE_TIMEOUT = 30
+RECONNECT_GRACE = 20  # a disconnected player can resume the game within this time
+HANDSHAKE_TIMEOUT = 5
+RECONNECT_INTERVAL = 0.5  # between attempts of a client to resume the game
+
+# limits which keep the servers up under abusive or bursty traffic
+MAX_PLAYERS = 1000  # lobby connections, plain and sessions together; more are refused
+MAX_GAMES = 500  # running games; new ones are refused until some finish
+MAX_CHANNELS = 16  # game channels open at once on one session
+MAX_SPECTATORS = 100  # spectators of one game
+MAX_HANDSHAKES = 256  # connections to all games which have not said yet whether they resume or watch
+MAX_LOBBY_OPERATION = 64 * 1024  # bytes of one operation a client sends to the lobby
+MAX_GAME_MESSAGE = 16 * 1024  # bytes of one message a client sends to a game
+MAX_CHANNEL_BUFFER = 256 * 1024  # bytes received on a session channel and not read yet
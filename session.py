@@ -0,0 +1,232 @@
+import io
+import socket
+import struct
+import logging
+import threading
+from enum import IntEnum
+
+# channel id, frame type, payload length
+FRAME_HEADER = struct.Struct('!IBI')
+GAME_PORT = struct.Struct('!H')
+LOBBY_CHANNEL = 0  # open from the start on both ends
+
+
+class FrameType(IntEnum):
+    Open = 1  # the payload is the port of the game the channel leads to
+    Data = 2
+    Close = 3  # the sender will not write to the channel any more
+
+
+class Channel:
+    """
+    One conversation carried by a session - the lobby or a game. It stands in for a socket: game handlers and
+    clients read and write it with the same calls, blocking reads wait for the frames the session routes to it.
+    With a handler, frames are passed to the handler by the session's reader instead, and None at the end.
+    """
+
+    def __init__(self, session: 'Session', channel_id: int, handler=None, max_buffer: int | None = None) -> None:
+        self._session = session
+        self.channel_id = channel_id
+        self.handler = handler
+        self._buffer = bytearray()
+        self._max_buffer = max_buffer
+        self._received = threading.Condition()
+        self._eof = False
+        self._close_sent = False
+        self._timeout: float | None = None
+
+    def feed(self, data: bytes) -> None:
+        if self.handler is not None:
+            self.handler(data)
+            return
+        with self._received:
+            if self._max_buffer is not None and len(self._buffer) + len(data) > self._max_buffer:
+                # the session's reader must not wait for this channel, so the whole connection is dropped
+                raise ValueError(f'channel {self.channel_id} overflows; {len(self._buffer)} bytes are not read yet')
+            self._buffer += data
+            self._received.notify_all()
+
+    def feed_eof(self) -> None:
+        with self._received:
+            if self._eof:
+                return
+            self._eof = True
+            self._received.notify_all()
+        if self.handler is not None:
+            self.handler(None)
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        view = memoryview(buffer).cast('B')
+        nbytes = nbytes or len(view)
+        with self._received:
+            if not self._received.wait_for(lambda: self._buffer or self._eof, self._timeout):
+                raise socket.timeout('timed out')
+            count = min(nbytes, len(self._buffer))
+            view[:count] = self._buffer[:count]
+            del self._buffer[:count]
+            return count
+
+    def recv(self, size: int) -> bytes:
+        buffer = bytearray(size)
+        return bytes(buffer[:self.recv_into(buffer)])
+
+    def poll(self, timeout: float | None = None) -> bool:
+        # the counterpart of select() for a socket: whether a read would not block
+        with self._received:
+            return self._received.wait_for(lambda: self._buffer or self._eof, timeout)
+
+    def sendall(self, data: bytes) -> None:
+        if self._close_sent:
+            raise BrokenPipeError(f'channel {self.channel_id} is closed')
+        self._session.send_frame(FrameType.Data, self.channel_id, data)
+
+    def makefile(self, mode: str = 'rb') -> io.BufferedReader:
+        if mode != 'rb':
+            raise ValueError('channels can only be read as binary files')
+        return io.BufferedReader(ChannelIO(self))
+
+    def settimeout(self, timeout: float | None) -> None:
+        self._timeout = timeout
+
+    def setsockopt(self, *args) -> None:
+        # options like TCP_NODELAY are set on the session's connection
+        pass
+
+    def getpeername(self) -> tuple[str, int]:
+        return self._session.peer
+
+    def shutdown(self, how: int) -> None:
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR) and not self._close_sent:
+            self._close_sent = True
+            try:
+                self._session.send_frame(FrameType.Close, self.channel_id)
+            except OSError:
+                pass
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            self.feed_eof()
+
+    def close(self) -> None:
+        self.shutdown(socket.SHUT_RDWR)
+        self._session.forget(self.channel_id)
+
+
+class ChannelIO(io.RawIOBase):
+    def __init__(self, channel: Channel) -> None:
+        self._channel = channel
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self._channel.recv_into(buffer)
+
+
+class Session:
+    """
+    One TCP connection carrying the lobby and any number of game channels as frames tagged with channel ids.
+    Channels are opened by the client; the server is told about every new one by on_open(channel, port).
+    One reader thread (run) routes the frames of all channels, writes of all channels share a lock.
+    The server bounds what a client may send: frames longer than max_frame and data piling up over max_buffer
+    in a channel end the session, channels opened beyond max_channels are closed right away.
+    """
+
+    def __init__(self, connection: socket.socket, on_open=None, max_frame: int | None = None,
+                 max_buffer: int | None = None, max_channels: int | None = None) -> None:
+        self._connection = connection
+        self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.peer = connection.getpeername()
+        self._on_open = on_open
+        self._max_frame = max_frame
+        self._max_buffer = max_buffer
+        self._max_channels = max_channels
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._next_id = LOBBY_CHANNEL + 1
+        self.lobby = Channel(self, LOBBY_CHANNEL)
+        self._channels: dict[int, Channel] = {LOBBY_CHANNEL: self.lobby}
+
+    @classmethod
+    def connect(cls, address: tuple[str, int]) -> 'Session':
+        # a client session with its reader running
+        session = cls(socket.create_connection(address))
+        thread = threading.Thread(target=session.run, name='Session')
+        thread.daemon = True
+        thread.start()
+        return session
+
+    def send_frame(self, frame_type: FrameType, channel_id: int, payload: bytes = b'') -> None:
+        with self._send_lock:
+            self._connection.sendall(FRAME_HEADER.pack(channel_id, frame_type, len(payload)) + payload)
+
+    def open_channel(self, port: int) -> Channel:
+        with self._lock:
+            channel = Channel(self, self._next_id)
+            self._channels[channel.channel_id] = channel
+            # ids are never reused, so frames of a closed channel cannot reach a new one
+            self._next_id += 1
+        self.send_frame(FrameType.Open, channel.channel_id, GAME_PORT.pack(port))
+        return channel
+
+    def forget(self, channel_id: int) -> None:
+        with self._lock:
+            self._channels.pop(channel_id, None)
+
+    def run(self) -> None:
+        stream = self._connection.makefile('rb')
+        try:
+            while True:
+                header = stream.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                channel_id, frame_type, length = FRAME_HEADER.unpack(header)
+                if self._max_frame is not None and length > self._max_frame:
+                    raise ValueError(f'frame of {length} bytes, at most {self._max_frame} are accepted')
+                payload = stream.read(length)
+                if len(payload) < length:
+                    break
+                self.dispatch(channel_id, frame_type, payload)
+        except (OSError, ValueError) as e:
+            logging.info('session with %s ended: %s', self.peer, e)
+        finally:
+            stream.close()
+            with self._lock:
+                channels, self._channels = list(self._channels.values()), {}
+            for channel in channels:
+                channel.feed_eof()
+
+    def dispatch(self, channel_id: int, frame_type: int, payload: bytes) -> None:
+        match frame_type:
+            case FrameType.Open:
+                if len(payload) != GAME_PORT.size:
+                    raise ValueError(f'channel {channel_id} opened with {len(payload)} bytes instead of a port')
+                with self._lock:
+                    if channel_id <= LOBBY_CHANNEL or channel_id in self._channels:
+                        # a channel replaced without being closed would never see its end
+                        raise ValueError(f'channel {channel_id} opened again')
+                    # the lobby is not a game channel
+                    crowded = self._max_channels is not None and len(self._channels) > self._max_channels
+                    channel = self._channels[channel_id] = Channel(self, channel_id, max_buffer=self._max_buffer)
+                if self._on_open is None or crowded:
+                    channel.close()
+                else:
+                    self._on_open(channel, GAME_PORT.unpack(payload)[0])
+            case FrameType.Data:
+                channel = self._channels.get(channel_id, None)
+                # frames which were on their way when the channel was closed here are dropped
+                if channel is not None:
+                    channel.feed(payload)
+            case FrameType.Close:
+                with self._lock:
+                    channel = self._channels.pop(channel_id, None)
+                if channel is not None:
+                    channel.feed_eof()
+            case _:
+                raise ValueError(f'unknown frame type {frame_type}')
+
+    def close(self) -> None:
+        try:
+            # wakes up the reader
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._connection.close()
@@ -0,0 +1,253 @@
+import socket
+import selectors
+import threading
+import logging
+from collections import deque
+from itertools import islice
+
+
+# spectator with more bytes than this waiting to be sent is too slow and gets disconnected
+MAX_WATCHER_BUFFER = 64 * 1024
+MAX_BUFFERS_PER_SEND = 512
+
+
+class Watcher:
+    __slots__ = ('connection', 'group', 'buffer', 'buffered', 'closing', 'writing')
+
+    def __init__(self, connection: socket.socket, group) -> None:
+        self.connection = connection
+        self.group = group
+        self.buffer: deque[memoryview] = deque()
+        self.buffered = 0
+        self.closing = False  # closed as soon as the buffer is flushed
+        self.writing = False  # registered in the selector for writing
+
+
+class ChannelWatcher:
+    """
+    A spectator watching through a session channel. Sessions are written with blocking calls, so frames are
+    queued and written by a thread of the watcher's own; a session slow to read never blocks the game. Like
+    the hub's watchers, one with more than max_buffer bytes waiting is too slow and gets disconnected.
+    """
+
+    def __init__(self, channel, max_buffer: int = MAX_WATCHER_BUFFER) -> None:
+        self._channel = channel
+        self._max_buffer = max_buffer
+        self._frames: deque[bytes] = deque()
+        self._buffered = 0
+        self._closing = False
+        self._ready = threading.Condition()
+        thread = threading.Thread(target=self.run, name='ChannelWatcher')
+        thread.daemon = True
+        thread.start()
+
+    def send(self, frame: bytes) -> bool:
+        # never blocks; False once the watcher is gone
+        with self._ready:
+            if self._closing:
+                return False
+            if self._buffered + len(frame) > self._max_buffer:
+                logging.info('spectator is too slow; disconnecting')
+                self._frames.clear()
+                self._buffered = 0
+                self._closing = True
+                self._ready.notify()
+                return False
+            self._frames.append(frame)
+            self._buffered += len(frame)
+            self._ready.notify()
+            return True
+
+    def close(self, frame: bytes | None = None) -> None:
+        # the last frame (e.g. the result of the game) is written before the channel is closed
+        if frame is not None:
+            self.send(frame)
+        with self._ready:
+            self._closing = True
+            self._ready.notify()
+
+    def run(self) -> None:
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._frames or self._closing)
+                if not self._frames:
+                    break
+                frame = self._frames.popleft()
+                self._buffered -= len(frame)
+            try:
+                self._channel.sendall(frame)
+            except OSError:
+                with self._ready:
+                    self._frames.clear()
+                    self._buffered = 0
+                    self._closing = True
+                break
+        self._channel.close()
+
+
+class SpectatorHub:
+    """
+    Sends game updates to spectators. Each update is encoded once by the game and the same bytes are queued
+    for every watcher of that game; one selector thread writes them to non-blocking sockets, so a slow
+    spectator never blocks the players. publish() only appends to a queue - the fan-out happens in the hub thread.
+    """
+
+    def __init__(self, max_buffer: int = MAX_WATCHER_BUFFER) -> None:
+        self._max_buffer = max_buffer
+        self._selector = selectors.DefaultSelector()
+        self._groups: dict[object, set[Watcher]] = {}
+        self._commands: deque[tuple] = deque()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._dirty: set[Watcher] = set()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, name='SpectatorHub')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def add_watcher(self, group, connection: socket.socket, snapshot: bytes) -> None:
+        self._command('add', group, connection, snapshot)
+
+    def publish(self, group, frame: bytes) -> None:
+        self._command('publish', group, frame)
+
+    def close_group(self, group, frame: bytes | None = None) -> None:
+        # the last frame (e.g. the result of the game) is flushed before spectators are disconnected
+        self._command('close', group, frame)
+
+    def watchers_count(self, group) -> int:
+        return len(self._groups.get(group, ()))
+
+    def _command(self, *command) -> None:
+        self._commands.append(command)
+        try:
+            self._wake_writer.send(b'\0')
+        except BlockingIOError:
+            # the hub is already woken up
+            pass
+
+    def run(self) -> None:
+        while True:
+            for key, events in self._selector.select():
+                if key.fileobj is self._wake_reader:
+                    self._drain_wake_socket()
+                    self._execute_commands()
+                    continue
+                watcher: Watcher = key.data
+                if watcher.connection.fileno() == -1:
+                    # removed while handling previous events
+                    continue
+                if events & selectors.EVENT_READ and not self._read(watcher):
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._flush(watcher)
+
+    def _drain_wake_socket(self) -> None:
+        try:
+            while self._wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _execute_commands(self) -> None:
+        # frames are only queued here and every watcher is flushed once at the end, so under load several
+        # updates go out in one system call
+        while self._commands:
+            command, group, *args = self._commands.popleft()
+            match command:
+                case 'add':
+                    connection, snapshot = args
+                    self._add(group, connection, snapshot)
+                case 'publish':
+                    for watcher in list(self._groups.get(group, ())):
+                        self._enqueue(watcher, args[0])
+                case 'close':
+                    for watcher in list(self._groups.pop(group, ())):
+                        if args[0] is not None:
+                            self._enqueue(watcher, args[0])
+                        watcher.closing = True
+                        watcher.group = None
+                        self._dirty.add(watcher)
+        for watcher in self._dirty:
+            if watcher.connection.fileno() != -1:
+                self._flush(watcher)
+        self._dirty.clear()
+
+    def _add(self, group, connection: socket.socket, snapshot: bytes) -> None:
+        connection.setblocking(False)
+        watcher = Watcher(connection, group)
+        self._groups.setdefault(group, set()).add(watcher)
+        self._selector.register(connection, selectors.EVENT_READ, watcher)
+        self._enqueue(watcher, snapshot)
+        logging.info('spectator joined; %d watching', len(self._groups[group]))
+
+    def _enqueue(self, watcher: Watcher, frame: bytes) -> None:
+        if watcher.buffered + len(frame) > self._max_buffer:
+            logging.info('spectator is too slow; disconnecting')
+            self._remove(watcher)
+            return
+        watcher.buffer.append(memoryview(frame))
+        watcher.buffered += len(frame)
+        if not watcher.writing:
+            # most of the time the socket is writable - it is written right after the commands are executed
+            self._dirty.add(watcher)
+
+    def _flush(self, watcher: Watcher) -> None:
+        try:
+            while watcher.buffer:
+                # all queued frames are written at once without joining them
+                sent = watcher.connection.sendmsg(list(islice(watcher.buffer, MAX_BUFFERS_PER_SEND)))
+                watcher.buffered -= sent
+                while sent:
+                    data = watcher.buffer[0]
+                    if sent < len(data):
+                        watcher.buffer[0] = data[sent:]
+                        break
+                    sent -= len(data)
+                    watcher.buffer.popleft()
+                if watcher.buffered and sent:
+                    # the socket buffer is full
+                    break
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._remove(watcher)
+            return
+        if bool(watcher.buffered) != watcher.writing:
+            watcher.writing = bool(watcher.buffered)
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if watcher.writing else selectors.EVENT_READ
+            self._selector.modify(watcher.connection, events, watcher)
+        if not watcher.buffered and watcher.closing:
+            self._remove(watcher)
+
+    def _read(self, watcher: Watcher) -> bool:
+        # spectators do not send anything - reading only detects that the connection was closed
+        try:
+            if watcher.connection.recv(4096):
+                return True
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        self._remove(watcher)
+        return False
+
+    def _remove(self, watcher: Watcher) -> None:
+        if watcher.group is not None:
+            self._groups.get(watcher.group, set()).discard(watcher)
+            watcher.group = None
+        watcher.buffer.clear()
+        watcher.buffered = 0
+        try:
+            self._selector.unregister(watcher.connection)
+        except (KeyError, ValueError):
+            pass
+        watcher.connection.close()
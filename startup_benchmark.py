@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import subprocess
+
+# modules started as programs; each one is imported in a fresh interpreter
+ENTRY_POINTS = ('server_lobby', 'game_server', 'game_client', 'client_lobby', 'engine', 'load_generator', 'pgn',
+                'move_archive', 'rating_batch', 'board_planes', 'tablebase')
+HEAVY_MODULES = ('pygame', 'PyQt5', 'numpy')
+BASELINE = 'python'  # the interpreter with nothing imported
+
+
+def peak_rss() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure_import(module: str) -> dict:
+    started = time.perf_counter()
+    if module != BASELINE:
+        importlib.import_module(module)
+    return {
+        'module': module,
+        'import_time': time.perf_counter() - started,
+        'rss': peak_rss(),
+        'heavy': [name for name in HEAVY_MODULES if name in sys.modules]
+    }
+
+
+def run_child(module: str) -> dict:
+    environment = dict(os.environ, SDL_VIDEODRIVER='dummy', PYGAME_HIDE_SUPPORT_PROMPT='1', QT_QPA_PLATFORM='offscreen')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', module], cwd=directory,
+                            env=environment, capture_output=True, text=True, check=True).stdout
+    # modules may log while they are imported; the measurement is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark(modules, repeat: int) -> list[dict]:
+    # the fastest of the runs; the interpreter's own import time and memory are given by the baseline
+    results = []
+    for module in (BASELINE, *modules):
+        runs = [run_child(module) for _ in range(repeat)]
+        results.append(min(runs, key=lambda run: run['import_time']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time and memory of every entry point, each in a new interpreter')
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='modules to import')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per module; the fastest one is reported')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_import(args.child)))
+        return
+    results = benchmark(args.modules, args.repeat)
+    baseline_rss = results[0]['rss']
+    print(f'{"entry point":<16} {"import":>10} {"RSS":>10} {"+RSS":>10}  heavy modules')
+    for result in results:
+        rss = result['rss']
+        rss_text = f'{rss / 2 ** 20:8.1f}MB' if rss is not None else f'{"n/a":>10}'
+        added_text = f'{(rss - baseline_rss) / 2 ** 20:8.1f}MB' if rss is not None else f'{"n/a":>10}'
+        print(f'{result["module"]:<16} {1000 * result["import_time"]:8.1f}ms {rss_text} {added_text}  '
+              f'{", ".join(result["heavy"]) or "-"}')
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
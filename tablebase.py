@@ -0,0 +1,544 @@
+import os
+import mmap
+import time
+import struct
+import logging
+import argparse
+import itertools
+from dataclasses import dataclass
+from typing import Iterator
+
+from board import *
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+
+# magic, version, number of tables; a directory entry follows for every table, then the tables themselves
+TABLEBASE_HEADER = struct.Struct('<4sHxxI')
+TABLEBASE_MAGIC = b'CHTB'
+TABLEBASE_VERSION = 1
+TABLEBASE_PATH = 'tablebases.chtb'
+# material (white pieces, then black ones, e.g. KQK) and offset of the table
+TABLE_ENTRY = struct.Struct('<8sQ')
+DEFAULT_MATERIALS = ('KQK', 'KRK', 'KPK')
+PIECE_ORDER = 'KQRBNP'
+# one byte per position: a position won or lost after n plies of best play is stored as n + 1 - the player to
+# move wins when n is odd - so 0 is left for draws
+DRAW_VALUE = 0
+INVALID_VALUE = 255  # positions which cannot occur, e.g. with the player who has just moved in check
+MAX_PLIES = INVALID_VALUE - 2
+
+
+def build_targets(steps) -> list[frozenset[int]]:
+    # squares one step away from every square; squares are numbered i * 8 + j, like in ChessBoard.position()
+    targets = []
+    for square in range(64):
+        i, j = divmod(square, 8)
+        targets.append(frozenset((i + di) * 8 + j + dj for di, dj in steps if is_inside_board((i + di, j + dj))))
+    return targets
+
+
+def build_rays() -> list[list[tuple[tuple[int, int], tuple[int, ...]]]]:
+    rays = []
+    for square in range(64):
+        i, j = divmod(square, 8)
+        square_rays = []
+        for di, dj in ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS:
+            ray = []
+            ni, nj = i + di, j + dj
+            while is_inside_board((ni, nj)):
+                ray.append(ni * 8 + nj)
+                ni, nj = ni + di, nj + dj
+            square_rays.append(((di, dj), tuple(ray)))
+        rays.append(square_rays)
+    return rays
+
+
+KING_TARGETS = build_targets(King(Color.White).moves)
+KNIGHT_TARGETS = build_targets(Knight(Color.White).moves)
+# squares taken by a pawn of the color (0 or BLACK_PIECE); white pawns move towards row 0
+PAWN_ATTACKS = {0: build_targets(((-1, -1), (-1, 1))), BLACK_PIECE: build_targets(((1, -1), (1, 1)))}
+SLIDER_RAYS = build_rays()
+# squares strictly between two squares on a line, and the sliders which move along that line
+BETWEEN = [[()] * 64 for _ in range(64)]
+LINE_SLIDERS = [[frozenset()] * 64 for _ in range(64)]
+for _origin in range(64):
+    for _direction, _ray in SLIDER_RAYS[_origin]:
+        _sliders = frozenset(piece_type for piece_type, directions in SLIDER_DIRECTIONS.items() if _direction in directions)
+        for _distance, _target in enumerate(_ray):
+            BETWEEN[_origin][_target] = _ray[:_distance]
+            LINE_SLIDERS[_origin][_target] = _sliders
+
+
+@dataclass
+class TablebaseResult:
+    wdl: int  # 1 when the player to move wins, -1 when they lose, 0 for a draw
+    plies: int  # to mate with best play; 0 for a draw and for a position which is already mate
+
+    @property
+    def mate(self) -> int | None:
+        # moves to mate like SearchResult.mate, negative when the player to move is mated
+        if not self.wdl:
+            return None
+        moves = (self.plies + 1) // 2
+        return moves if self.wdl > 0 else -moves
+
+
+def parse_material(material: str) -> list[int]:
+    """
+    Piece codes of a material like KQK or KRKN: the white pieces, then the black ones, each side led by its king.
+    """
+    black_king = material.find('K', 1)
+    sides = (material[:black_king], material[black_king:]) if black_king > 0 else ()
+    if not sides or any(side.count('K') != 1 or not side.startswith('K') or
+                        any(letter not in PIECE_ORDER for letter in side) for side in sides):
+        raise ValueError(f'Invalid material: {material}')
+    return [PIECE_CODES[LETTER_PIECES[letter]] | color for side, color in zip(sides, (0, BLACK_PIECE)) for letter in side]
+
+
+def material_name(codes) -> str:
+    return ''.join(PIECE_LETTERS[PIECE_TYPES[code & ~BLACK_PIECE]] for code in codes)
+
+
+def piece_order(code: int) -> tuple[int, int]:
+    return code & BLACK_PIECE, PIECE_ORDER.index(PIECE_LETTERS[PIECE_TYPES[code & ~BLACK_PIECE]])
+
+
+def canonical_material(material: str) -> str:
+    return material_name(sorted(parse_material(material), key=piece_order))
+
+
+def is_insufficient(codes) -> bool:
+    # only the kings, or the kings and a single minor piece, cannot mate
+    others = [PIECE_TYPES[code & ~BLACK_PIECE] for code in codes if PIECE_TYPES[code & ~BLACK_PIECE] is not King]
+    return not others or len(others) == 1 and others[0] in (Bishop, Knight)
+
+
+def table_size(piece_count: int) -> int:
+    return 2 * 64 ** piece_count
+
+
+def table_index(squares, black_to_move: bool) -> int:
+    index = int(black_to_move)
+    for square in squares:
+        index = index * 64 + square
+    return index
+
+
+def mirror_square(square: int) -> int:
+    # the board seen from the other side: rows swap, so pawns keep their direction when colors swap too
+    return (7 - square // 8) * 8 + square % 8
+
+
+def lookup(tables: dict, pieces: list[tuple[int, int]], black_to_move: bool) -> int | None:
+    """
+    The stored value of a position given by (piece code, square) pairs, from the table of its material or,
+    with the colors swapped, of the mirrored material. None when neither table is there.
+    """
+    pieces = sorted(pieces, key=lambda piece: piece_order(piece[0]))
+    table = tables.get(material_name(code for code, _ in pieces))
+    if table is None:
+        pieces = sorted(((code ^ BLACK_PIECE, mirror_square(square)) for code, square in pieces),
+                        key=lambda piece: piece_order(piece[0]))
+        table = tables.get(material_name(code for code, _ in pieces))
+        black_to_move = not black_to_move
+    if table is None:
+        return DRAW_VALUE if is_insufficient(code for code, _ in pieces) else None
+    return table[table_index((square for _, square in pieces), black_to_move)]
+
+
+def result_from_value(value: int | None) -> TablebaseResult | None:
+    if value is None or value == INVALID_VALUE:
+        return None
+    if value == DRAW_VALUE:
+        return TablebaseResult(0, 0)
+    plies = value - 1
+    return TablebaseResult(1 if plies % 2 else -1, plies)
+
+
+def attacks(code: int, origin: int, target: int, occupied) -> bool:
+    piece_type = PIECE_TYPES[code & ~BLACK_PIECE]
+    if piece_type is Pawn:
+        return target in PAWN_ATTACKS[code & BLACK_PIECE][origin]
+    if piece_type is Knight:
+        return target in KNIGHT_TARGETS[origin]
+    if piece_type is King:
+        return target in KING_TARGETS[origin]
+    return piece_type in LINE_SLIDERS[origin][target] and not any(square in occupied for square in BETWEEN[origin][target])
+
+
+def piece_targets(code: int, origin: int, occupied) -> Iterator[int]:
+    # squares a piece other than a pawn moves to, whether empty or occupied; its moves are their own reverse
+    piece_type = PIECE_TYPES[code & ~BLACK_PIECE]
+    if piece_type is King:
+        yield from KING_TARGETS[origin]
+    elif piece_type is Knight:
+        yield from KNIGHT_TARGETS[origin]
+    else:
+        for direction, ray in SLIDER_RAYS[origin]:
+            if direction not in SLIDER_DIRECTIONS[piece_type]:
+                continue
+            for square in ray:
+                yield square
+                if square in occupied:
+                    break
+
+
+class TableGenerator:
+    """
+    Builds the table of one material by retrograde analysis. Every position is indexed by the side to move and
+    the squares of its pieces in material order. Mates are found first; from every position decided after n plies
+    the analysis goes one move back: a position from which a move reaches a lost one is won, and one whose every
+    move reaches a won one is lost. Captures and promotions leave the material and are looked up in the tables it
+    leads to, which have to be built before. Castling and en passant are not part of the tables.
+    """
+
+    def __init__(self, material: str, tables: dict) -> None:
+        self.codes = parse_material(material)
+        self.material = material_name(self.codes)
+        self._tables = tables
+        size = table_size(len(self.codes))
+        self.values = bytearray(size)
+        # legal moves which stay in the table and have not been found to lose yet
+        self._remaining = bytearray(size)
+        # the best result of the moves which leave the table: a draw or a win, or the longest loss
+        self._escapes = bytearray(size)
+        self._exit_losses = bytearray(size)
+        self._plies: list[list[int]] = [[] for _ in range(MAX_PLIES + 1)]
+        kings = [piece for piece, code in enumerate(self.codes) if PIECE_TYPES[code & ~BLACK_PIECE] is King]
+        self._kings = {self.codes[king] & BLACK_PIECE: king for king in kings}
+
+    def generate(self) -> bytearray:
+        for index, (black_to_move, *squares) in enumerate(itertools.product(range(2), *[range(64)] * len(self.codes))):
+            self.classify(index, squares, BLACK_PIECE if black_to_move else 0)
+        for plies, indexes in enumerate(self._plies):
+            # positions decided after n plies only make others decided after more plies, so the lists are complete
+            for index in indexes:
+                if self.values[index]:
+                    continue
+                self.values[index] = plies + 1
+                self.propagate(index, plies)
+        return self.values
+
+    def decide(self, index: int, plies: int) -> None:
+        if plies > MAX_PLIES:
+            raise ValueError(f'{self.material}: a mate after {plies} plies does not fit the table')
+        self._plies[plies].append(index)
+
+    def in_check(self, squares, side: int, captured: int = -1) -> bool:
+        # whether the king of side is attacked by the other pieces, apart from the captured one
+        king_square = squares[self._kings[side]]
+        occupied = {square for piece, square in enumerate(squares) if piece != captured}
+        return any(attacks(code, squares[piece], king_square, occupied) for piece, code in enumerate(self.codes)
+                   if code & BLACK_PIECE != side and piece != captured)
+
+    def moves(self, squares, side: int) -> Iterator[tuple[int, int, int]]:
+        # (piece, target, captured piece or -1) of the pseudo-legal moves of side; promotions are made by the caller
+        occupants = {square: piece for piece, square in enumerate(squares)}
+        for piece, code in enumerate(self.codes):
+            if code & BLACK_PIECE != side:
+                continue
+            origin = squares[piece]
+            if PIECE_TYPES[code & ~BLACK_PIECE] is Pawn:
+                forward = 8 if side else -8
+                if origin + forward not in occupants:
+                    yield piece, origin + forward, -1
+                    start_row = 1 if side else 6
+                    if origin // 8 == start_row and origin + 2 * forward not in occupants:
+                        yield piece, origin + 2 * forward, -1
+                targets = (square for square in PAWN_ATTACKS[side][origin] if square in occupants)
+            else:
+                targets = piece_targets(code, origin, occupants)
+            for target in targets:
+                captured = occupants.get(target, -1)
+                if captured < 0 or self.codes[captured] & BLACK_PIECE != side:
+                    yield piece, target, captured
+
+    def classify(self, index: int, squares: list[int], side: int) -> None:
+        codes = self.codes
+        if len(set(squares)) < len(squares) or any(
+                PIECE_TYPES[code & ~BLACK_PIECE] is Pawn and squares[piece] // 8 in (0, 7) for piece, code in enumerate(codes)):
+            self.values[index] = INVALID_VALUE
+            return
+        if self.in_check(squares, side ^ BLACK_PIECE):
+            self.values[index] = INVALID_VALUE
+            return
+        remaining = 0
+        escapes = False
+        win = None
+        exit_loss = 0
+        for piece, target, captured in self.moves(squares, side):
+            after = list(squares)
+            after[piece] = target
+            if self.in_check(after, side, captured):
+                continue
+            promoted = PIECE_TYPES[codes[piece] & ~BLACK_PIECE] is Pawn and target // 8 in (0, 7)
+            if captured < 0 and not promoted:
+                remaining += 1
+                continue
+            for promotion in PROMOTIONS if promoted else (None,):
+                pieces = [(PIECE_CODES[promotion] | side if other == piece and promotion else code, after[other])
+                          for other, code in enumerate(codes) if other != captured]
+                value = lookup(self._tables, pieces, not side)
+                if value is None:
+                    raise ValueError(f'{self.material}: the table of {material_name(code for code, _ in pieces)} is missing')
+                if value == DRAW_VALUE:
+                    escapes = True
+                elif value % 2:
+                    # the opponent is lost after value - 1 plies
+                    escapes = True
+                    win = value if win is None else min(win, value)
+                else:
+                    exit_loss = max(exit_loss, value)
+        self._remaining[index] = remaining
+        self._escapes[index] = escapes
+        self._exit_losses[index] = exit_loss
+        if win is not None:
+            self.decide(index, win)
+        elif not remaining:
+            if exit_loss:
+                self.decide(index, exit_loss)
+            elif not escapes and self.in_check(squares, side):
+                self.decide(index, 0)
+            # otherwise stalemate, which stays a draw
+
+    def predecessors(self, index: int) -> Iterator[int]:
+        # positions one move before, without captures and promotions, which are not a part of this table
+        squares = []
+        for _ in self.codes:
+            index, square = divmod(index, 64)
+            squares.append(square)
+        squares.reverse()
+        mover = 0 if index else BLACK_PIECE
+        occupied = set(squares)
+        for piece, code in enumerate(self.codes):
+            if code & BLACK_PIECE != mover:
+                continue
+            target = squares[piece]
+            if PIECE_TYPES[code & ~BLACK_PIECE] is Pawn:
+                backward = -8 if mover else 8
+                origins = []
+                if target + backward not in occupied:
+                    origins.append(target + backward)
+                    double_row = 3 if mover else 4
+                    if target // 8 == double_row and target + 2 * backward not in occupied:
+                        origins.append(target + 2 * backward)
+                origins = [origin for origin in origins if origin // 8 not in (0, 7)]
+            else:
+                origins = [origin for origin in piece_targets(code, target, occupied) if origin not in occupied]
+            for origin in origins:
+                before = list(squares)
+                before[piece] = origin
+                yield table_index(before, bool(mover))
+
+    def propagate(self, index: int, plies: int) -> None:
+        values = self.values
+        for predecessor in self.predecessors(index):
+            if values[predecessor]:
+                continue
+            if plies % 2 == 0:
+                # a move to a lost position wins
+                self.decide(predecessor, plies + 1)
+                continue
+            self._remaining[predecessor] -= 1
+            if not self._remaining[predecessor] and not self._escapes[predecessor]:
+                self.decide(predecessor, max(plies + 1, self._exit_losses[predecessor]))
+
+
+def dependencies(material: str) -> list[str]:
+    # materials a capture or a promotion leads to, which can still be won
+    codes = parse_material(material)
+    reached = set()
+    for piece, code in enumerate(codes):
+        piece_type = PIECE_TYPES[code & ~BLACK_PIECE]
+        if piece_type is King:
+            continue
+        reached.add(tuple(codes[:piece] + codes[piece + 1:]))
+        if piece_type is Pawn:
+            for promotion in PROMOTIONS:
+                reached.add(tuple(codes[:piece] + [PIECE_CODES[promotion] | code & BLACK_PIECE] + codes[piece + 1:]))
+    return sorted({canonical_material(material_name(codes)) for codes in reached if not is_insufficient(codes)})
+
+
+def generate_tables(materials) -> dict[str, bytearray]:
+    """
+    Tables of the materials and of everything they lead to, built in the order they depend on each other.
+    """
+    tables: dict[str, bytearray] = {}
+
+    def build(material: str) -> None:
+        material = canonical_material(material)
+        mirrored = material_name(sorted((code ^ BLACK_PIECE for code in parse_material(material)), key=piece_order))
+        if material in tables or mirrored in tables:
+            return
+        for dependency in dependencies(material):
+            build(dependency)
+        started = time.perf_counter()
+        tables[material] = TableGenerator(material, tables).generate()
+        logging.info('%s: %s in %.1f s', material, describe(tables[material]), time.perf_counter() - started)
+
+    for material in materials:
+        build(material)
+    return tables
+
+
+def describe(values: bytes) -> str:
+    counts = [0] * 256
+    for value in values:
+        counts[value] += 1
+    won = sum(counts[value] for value in range(2, INVALID_VALUE, 2))
+    lost = sum(counts[value] for value in range(1, INVALID_VALUE, 2))
+    longest = max((value - 1 for value in range(1, INVALID_VALUE) if counts[value]), default=0)
+    return f'{won} won, {lost} lost, {counts[DRAW_VALUE]} drawn positions, longest mate {(longest + 1) // 2} moves'
+
+
+def write_tablebase(path: str, tables: dict[str, bytes]) -> None:
+    with open(path, 'wb') as file:
+        file.write(TABLEBASE_HEADER.pack(TABLEBASE_MAGIC, TABLEBASE_VERSION, len(tables)))
+        offset = TABLEBASE_HEADER.size + TABLE_ENTRY.size * len(tables)
+        for material, values in tables.items():
+            file.write(TABLE_ENTRY.pack(material.encode(), offset))
+            offset += len(values)
+        for values in tables.values():
+            file.write(values)
+
+
+class Tablebase:
+    """
+    Tables of a tablebase file, probed through mmap: a probe reads the one byte of its position.
+    """
+
+    def __init__(self, path: str = TABLEBASE_PATH) -> None:
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = TABLEBASE_HEADER.unpack_from(self._map, 0)
+        if magic != TABLEBASE_MAGIC or version != TABLEBASE_VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a tablebase')
+        view = memoryview(self._map)
+        self._tables: dict[str, memoryview] = {}
+        for number in range(count):
+            material, offset = TABLE_ENTRY.unpack_from(self._map, TABLEBASE_HEADER.size + TABLE_ENTRY.size * number)
+            material = material.rstrip(b'\0').decode()
+            self._tables[material] = view[offset:offset + table_size(len(material))]
+        self.max_pieces = max((len(material) for material in self._tables), default=0)
+
+    def __enter__(self) -> 'Tablebase':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def materials(self) -> list[str]:
+        return list(self._tables)
+
+    def probe(self, chess_board: ChessBoard) -> TablebaseResult | None:
+        return self.probe_position(chess_board.position())
+
+    def probe_position(self, position: bytes) -> TablebaseResult | None:
+        # positions with castling rights or an en passant capture are not in the tables
+        if position[FLAGS_INDEX] & ~BLACK_TO_MOVE or position[EN_PASSANT_INDEX]:
+            return None
+        pieces = [(code, square) for square, code in enumerate(position[:FLAGS_INDEX]) if code]
+        return self.probe_pieces(pieces, bool(position[FLAGS_INDEX] & BLACK_TO_MOVE))
+
+    def probe_pieces(self, pieces: list[tuple[int, int]], black_to_move: bool) -> TablebaseResult | None:
+        if len(pieces) > self.max_pieces:
+            return None
+        return result_from_value(lookup(self._tables, pieces, black_to_move))
+
+    def best_move(self, chess_board: ChessBoard) -> tuple[tuple[tuple[int, int], tuple[int, int]], type[Piece] | None, TablebaseResult] | None:
+        """
+        The move which mates soonest, or holds the draw, or is mated latest, with the result of the position.
+        """
+        result = self.probe(chess_board)
+        if result is None:
+            return None
+        position = chess_board.position()
+        scratch = ChessBoard()
+        best = None
+        for old, new in chess_board.legal_moves():
+            promoted = isinstance(chess_board.board[old[0]][old[1]], Pawn) and new[0] in (0, ChessBoard.SIZE - 1)
+            for promotion in PROMOTIONS if promoted else (None,):
+                scratch.set_position(position)
+                scratch.move(old, new, promotion, legal=True)
+                reply = self.probe(scratch)
+                if reply is None:
+                    continue
+                # the opponent's result, from the best for the player to move
+                rank = (0, reply.plies) if reply.wdl < 0 else (1, 0) if not reply.wdl else (2, -reply.plies)
+                if best is None or rank < best[0]:
+                    best = rank, (old, new), promotion
+        if best is None:
+            return None
+        return best[1], best[2], result
+
+    def principal_variation(self, chess_board: ChessBoard, limit: int = MAX_PLIES) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+        # best moves of both players until the mate
+        chess_board = ChessBoard.from_position(chess_board.position())
+        pv = []
+        while len(pv) < limit:
+            probe = self.best_move(chess_board)
+            if probe is None or not probe[2].wdl:
+                break
+            (old, new), promotion, _ = probe
+            chess_board.move(old, new, promotion, legal=True)
+            pv.append((old, new))
+        return pv
+
+    def close(self) -> None:
+        self._tables.clear()
+        self._map.close()
+
+
+def open_tablebase(path: str = TABLEBASE_PATH) -> Tablebase | None:
+    # the tablebase is optional: without the file, endgames are searched and played out
+    if not os.path.exists(path):
+        return None
+    try:
+        tablebase = Tablebase(path)
+    except (OSError, ValueError) as e:
+        logging.warning('tablebase %s not loaded: %s', path, e)
+        return None
+    logging.info('tablebase %s loaded: %s', path, ', '.join(tablebase.materials))
+    return tablebase
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build endgame tablebases by retrograde analysis and probe them')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate_parser = subparsers.add_parser('generate', help='build the tables of materials and of those they lead to')
+    generate_parser.add_argument('materials', nargs='*', default=DEFAULT_MATERIALS,
+                                 help='white pieces then black ones, e.g. KQK or KRKN; every piece adds a factor of 64')
+    generate_parser.add_argument('--output', default=TABLEBASE_PATH)
+    probe_parser = subparsers.add_parser('probe', help='result and best line of a position')
+    probe_parser.add_argument('fen')
+    probe_parser.add_argument('--path', default=TABLEBASE_PATH)
+    args = parser.parse_args()
+
+    match args.command:
+        case 'generate':
+            try:
+                tables = generate_tables(args.materials)
+            except ValueError as e:
+                parser.error(str(e))
+            write_tablebase(args.output, tables)
+            logging.info('%d tables written to %s (%d bytes)', len(tables), args.output, os.path.getsize(args.output))
+        case 'probe':
+            chess_board = ChessBoard.from_fen(args.fen)
+            with Tablebase(args.path) as tablebase:
+                result = tablebase.probe(chess_board)
+                if result is None:
+                    print('not in the tablebase')
+                    return
+                outcome = {1: f'mate in {result.mate}', 0: 'draw', -1: f'mated in {-result.mate}' if result.mate else 'mated'}
+                print(outcome[result.wdl])
+                line = ChessBoard.from_fen(args.fen)
+                for old, new in tablebase.principal_variation(chess_board):
+                    line.move(old, new, legal=True)
+                if line.moves:
+                    print(' '.join(line.moves))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import unittest
+
+from game_snapshot import *
+
+
+def play(moves: str) -> tuple[GameSnapshot, ChessBoard]:
+    # the same moves, given as square names, on a snapshot and on a board which checks them
+    snapshot = GameSnapshot()
+    chess_board = ChessBoard()
+    for move in moves.split():
+        old, new = square_from_name(move[:2]), square_from_name(move[2:])
+        move_type, _ = chess_board.move(old, new)
+        assert move_type != MoveType.InvalidMove, move
+        snapshot.apply_move((old, new))
+    return snapshot, chess_board
+
+
+def square_index(name: str) -> int:
+    i, j = square_from_name(name)
+    return i * ChessBoard.SIZE + j
+
+
+class GameSnapshotTest(unittest.TestCase):
+    def assertSamePosition(self, moves: str) -> GameSnapshot:
+        snapshot, chess_board = play(moves)
+        self.assertEqual(snapshot.position, chess_board.position(), moves)
+        self.assertEqual(snapshot.turn, chess_board.turn)
+        return snapshot
+
+    def test_start_position(self):
+        snapshot = GameSnapshot()
+        self.assertEqual(snapshot.position, ChessBoard().position())
+        self.assertEqual(snapshot.turn, Color.White)
+
+    def test_opening(self):
+        snapshot = self.assertSamePosition('e2e4 e7e5 g1f3 b8c6 f1b5 a7a6')
+        self.assertEqual(len(snapshot.moves), 6)
+
+    def test_castling_on_both_sides(self):
+        self.assertSamePosition('e2e4 e7e5 g1f3 b8c6 f1c4 d7d6 e1g1 c8g4 d2d3 d8d7 b1c3 e8c8')
+        snapshot = self.assertSamePosition('e2e4 e7e5 g1f3 b8c6 f1c4 d7d6 e1g1')
+        self.assertEqual(ChessBoard.from_position(snapshot.position).fen().split()[2], 'kq')
+
+    def test_castling_rights_are_lost(self):
+        # a king move, a rook move and a rook taken on its square
+        self.assertSamePosition('e2e4 e7e5 e1e2 e8e7')
+        self.assertSamePosition('h2h4 a7a5 h1h3 a8a6')
+        snapshot = self.assertSamePosition('g2g3 b7b6 f1g2 e7e6 g2a8')
+        self.assertEqual(ChessBoard.from_position(snapshot.position).fen().split()[2], 'KQk')
+
+    def test_en_passant(self):
+        snapshot = self.assertSamePosition('e2e4 a7a6 e4e5 d7d5')
+        self.assertEqual(ChessBoard.from_position(snapshot.position).en_passant, square_from_name('d6'))
+        snapshot = self.assertSamePosition('e2e4 a7a6 e4e5 d7d5 e5d6')
+        self.assertEqual(snapshot.position[square_index('d5')], 0)
+        self.assertEqual(snapshot.position[EN_PASSANT_INDEX], 0)
+
+    def test_promotion_to_a_queen(self):
+        snapshot = self.assertSamePosition('h2h4 g7g5 h4g5 h7h6 g5h6 f8g7 h6g7 a7a6 g7h8')
+        self.assertEqual(snapshot.position[square_index('h8')], PIECE_CODES[Queen])
+        snapshot = self.assertSamePosition('a2a3 h7h5 a3a4 h5h4 a4a5 h4h3 a5a6 h3g2 a6b7 g2h1')
+        self.assertEqual(snapshot.position[square_index('h1')], PIECE_CODES[Queen] | BLACK_PIECE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import random
+import tempfile
+import unittest
+
+from move_archive import *
+
+
+def random_game(generator: random.Random, length: int) -> list[Move]:
+    squares = [(generator.randrange(8), generator.randrange(8)) for _ in range(2 * length)]
+    return list(zip(squares[::2], squares[1::2]))
+
+
+class MoveCodeTest(unittest.TestCase):
+    def test_every_move_round_trips(self):
+        for old in range(64):
+            for new in range(64):
+                move = (divmod(old, 8), divmod(new, 8))
+                self.assertEqual(decode_move(encode_move(move)), move)
+                self.assertLess(encode_move(move), 1 << 12)
+
+    def test_move_off_the_board(self):
+        for move in (((8, 0), (0, 0)), ((0, 0), (0, -1))):
+            with self.assertRaises(ValueError):
+                encode_move(move)
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'games' + ARCHIVE_SUFFIX)
+        generator = random.Random(7)
+        # an empty game and odd lengths, so the index alignment is exercised
+        self.games = [(f'game {number} ♞', random_game(generator, length))
+                      for number, length in enumerate((0, 1, 57, 3, 200, 0, 41))]
+        with ArchiveWriter(self.path) as writer:
+            for name, moves in self.games:
+                writer.add(name, moves)
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def test_round_trip(self):
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), len(self.games))
+            self.assertEqual(list(reader.games()), self.games)
+
+    def test_random_access(self):
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(reader.name(4), self.games[4][0])
+            self.assertEqual(reader.move_count(4), 200)
+            self.assertEqual(reader.moves(4, 10, 20), self.games[4][1][10:20])
+            self.assertEqual(reader.moves(2, -5), self.games[2][1][-5:])
+            self.assertEqual(reader.moves(1, 5, 9), [])
+            raw = reader.raw_moves(6)
+            self.assertEqual(len(raw), 41 * MOVE.size)
+            raw.release()
+            for game in (-1, len(self.games)):
+                with self.assertRaises(IndexError):
+                    reader.moves(game)
+
+    def test_not_an_archive(self):
+        with open(self.path, 'r+b') as file:
+            file.write(b'JUNK')
+        with self.assertRaises(ValueError):
+            ArchiveReader(self.path)
+
+    def test_pack_and_unpack_a_directory(self):
+        directory = os.path.join(self._directory.name, 'archive')
+        unpack_archive(self.path, directory)
+        write_data_to_file('not a move list', os.path.join(directory, 'broken'))
+        repacked = os.path.join(self._directory.name, 'repacked' + ARCHIVE_SUFFIX)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(pack_directory(directory, repacked), len(self.games))
+        self.assertEqual(sorted(read_games(repacked)), sorted(self.games))
+
+
+if __name__ == '__main__':
+    unittest.main()
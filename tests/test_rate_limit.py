@@ -0,0 +1,46 @@
+import unittest
+
+from rate_limit import *
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=5)
+        now = bucket._updated
+        self.assertEqual([bucket.take(now) for _ in range(6)], [True] * 5 + [False])
+        # a token every tenth of a second
+        self.assertFalse(bucket.take(now + 0.05))
+        self.assertTrue(bucket.take(now + 0.15))
+        self.assertFalse(bucket.take(now + 0.15))
+
+    def test_idle_bucket_refills_only_to_the_burst(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        now = bucket._updated + 60
+        self.assertEqual(sum(bucket.take(now) for _ in range(10)), 3)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_kinds_without_a_limit_pass(self):
+        limiter = RateLimiter({'move': (1, 1)})
+        self.assertTrue(all(limiter.allow('chat', 0.0) for _ in range(100)))
+        self.assertFalse(limiter.abusive)
+
+    def test_refused_messages_are_strikes(self):
+        limiter = RateLimiter({'move': (1, 2)}, strikes=(1, 3))
+        now = limiter._strikes._updated
+        self.assertEqual([limiter.allow('move', now) for _ in range(5)], [True, True, False, False, False])
+        self.assertFalse(limiter.abusive)
+        self.assertFalse(limiter.allow('move', now))
+        self.assertTrue(limiter.abusive)
+
+    def test_bursty_client_is_not_abusive(self):
+        limiter = RateLimiter({'move': (10, 5)}, strikes=(1, 3))
+        now = limiter._strikes._updated
+        for second in range(20):
+            allowed = [limiter.allow('move', now + second) for _ in range(6)]
+            self.assertEqual(allowed.count(True), 5)
+        self.assertFalse(limiter.abusive)
+
+
+if __name__ == '__main__':
+    unittest.main()
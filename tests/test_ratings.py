@@ -0,0 +1,45 @@
+import os
+import math
+import tempfile
+import unittest
+
+from ratings import *
+
+
+class Glicko2Test(unittest.TestCase):
+    def test_example_from_the_paper(self):
+        # Glickman's worked example: a 1500 player wins against 1400 and loses against 1550 and 1700; the paper
+        # rounds its intermediate values
+        player = PlayerRecord('player', rating=1500, deviation=200)
+        rating, deviation, volatility = glicko2_update(player, [(1400, 30, 1.0), (1550, 100, 0.0), (1700, 300, 0.0)])
+        self.assertAlmostEqual(rating, 1464.06, delta=0.01)
+        self.assertAlmostEqual(deviation, 151.52, delta=0.01)
+        self.assertAlmostEqual(volatility, 0.05999, delta=1e-5)
+
+    def test_idle_periods_only_widen_the_deviation(self):
+        player = PlayerRecord('player', rating=1700, deviation=50)
+        rating, deviation, volatility = glicko2_update(player, [], periods=10)
+        self.assertEqual((rating, volatility), (1700, player.volatility))
+        self.assertAlmostEqual(deviation, math.hypot(50, SCALE * player.volatility * math.sqrt(10)))
+        self.assertEqual(glicko2_update(player, [], periods=1e6)[1], DEFAULT_DEVIATION)
+
+
+class RatingTableTest(unittest.TestCase):
+    def test_results_are_replayed_after_the_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path, results_path = os.path.join(directory, 'ratings.json'), os.path.join(directory, 'results.jsonl')
+            table = RatingTable(path, results_path)
+            table.record_result('alice', 'bob', 1.0, played_at=0.0)
+            table.save()
+            table.record_result('alice', 'carol', 0.5, played_at=60.0)
+            expected = [table.get(nickname) for nickname in ('alice', 'bob', 'carol')]
+            table._results_file.close()
+
+            reloaded = RatingTable(path, results_path)
+            self.assertEqual([reloaded.get(nickname) for nickname in ('alice', 'bob', 'carol')], expected)
+            self.assertEqual([player.nickname for player in reloaded.leaderboard()], ['alice', 'carol', 'bob'])
+            reloaded.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
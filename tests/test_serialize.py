@@ -0,0 +1,111 @@
+import io
+import pickle
+import socket
+import unittest
+
+from serialize import *
+
+
+class SocketStub:
+    # a connection whose recv_into returns the data in chunks of at most chunk bytes
+    def __init__(self, data: bytes, chunk: int = 3) -> None:
+        self._data = io.BytesIO(data)
+        self._chunk = chunk
+
+    def recv_into(self, view) -> int:
+        return self._data.readinto(view[:self._chunk])
+
+
+class DecodeMessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        for message in ({'move': ((6, 4), (4, 4))}, {'ping': 7}, {'pong': 2 ** 32 - 1}, {'winner': 'alice'}):
+            with self.subTest(message=message):
+                message_type, frame = receive_frame(SocketStub(pack_message(message)))
+                self.assertEqual(decode_message(message_type, frame[MESSAGE_HEADER.size:]), message)
+
+    def test_fixed_payloads_are_not_pickled(self):
+        self.assertEqual(pack_message({'move': ((6, 4), (4, 4))}), MESSAGE_HEADER.pack(MessageType.Move, 4) + bytes([6, 4, 4, 4]))
+        self.assertEqual(pack_message({'pong': 1})[0], MessageType.Pong)
+
+    def test_malformed_messages_are_invalid(self):
+        malformed = [
+            (MessageType.Move, bytes([8, 0, 7, 0])),
+            (MessageType.Move, bytes([0, 0, 0, 255])),
+            (MessageType.Move, bytes([6, 4, 4])),
+            (MessageType.Ping, b''),
+            (MessageType.Pong, b'12345'),
+            (MessageType.Pickle, b'garbage'),
+            (MessageType.Pickle, pickle.dumps([1, 2])[:-2]),
+            (MessageType.Pickle, pickle.dumps([1, 2])),
+            (9, b''),
+        ]
+        for message_type, payload in malformed:
+            with self.subTest(message_type=message_type, payload=payload):
+                with self.assertRaises(InvalidMessage):
+                    decode_message(message_type, payload)
+
+
+class ReceiveFrameTest(unittest.TestCase):
+    def test_frames_in_a_row(self):
+        data = b''.join(map(pack_message, ({'move': ((1, 2), (3, 4))}, {'pong': 5}, {'resume': 'token'})))
+        connection = SocketStub(data, chunk=2)
+        self.assertEqual(receive_message(connection), {'move': ((1, 2), (3, 4))})
+        self.assertEqual(receive_message(connection), {'pong': 5})
+        self.assertEqual(receive_message(connection), {'resume': 'token'})
+        with self.assertRaises(EOFError):
+            receive_frame(connection)
+
+    def test_frame_is_forwarded_as_received(self):
+        data = pack_message({'move': ((6, 4), (4, 4))})
+        _, frame = receive_frame(SocketStub(data))
+        self.assertEqual(bytes(frame), data)
+
+    def test_length_over_the_limit_is_refused_before_the_payload(self):
+        # the header promises 4 GiB; nothing of it is allocated or read
+        connection = SocketStub(MESSAGE_HEADER.pack(MessageType.Pickle, 2 ** 32 - 1))
+        with self.assertRaises(MessageTooLarge):
+            receive_frame(connection, max_size=1024)
+
+    def test_truncated_frame(self):
+        data = pack_message({'winner': 'alice'})
+        with self.assertRaises(EOFError):
+            receive_frame(SocketStub(data[:-1]))
+
+    def test_send_frames_over_a_socket(self):
+        frames = [pack_message({'pong': number}) for number in range(100)]
+        left, right = socket.socketpair()
+        with left, right:
+            send_frames(left, frames)
+            for number in range(100):
+                self.assertEqual(receive_message(right), {'pong': number})
+
+
+class BoundedReaderTest(unittest.TestCase):
+    def test_pickles_within_the_limit(self):
+        stream = io.BufferedReader(io.BytesIO(pickle.dumps({'a': 1}) + pickle.dumps('b' * 100)))
+        reader = BoundedReader(stream, 256)
+        self.assertEqual(pickle.load(reader), {'a': 1})
+        reader.reset()
+        self.assertEqual(pickle.load(reader), 'b' * 100)
+
+    def test_endless_pickle_is_too_large(self):
+        for data in (pickle.dumps('x' * 10000), pickle.dumps(b'y' * 10000), pickle.dumps(list(range(5000)), protocol=0)):
+            with self.subTest(size=len(data)):
+                reader = BoundedReader(io.BufferedReader(io.BytesIO(data)), 1024)
+                with self.assertRaises(MessageTooLarge):
+                    pickle.load(reader)
+
+    def test_limit_applies_to_each_pickle(self):
+        data = pickle.dumps('x' * 600)
+        reader = BoundedReader(io.BufferedReader(io.BytesIO(data * 2)), 1024)
+        pickle.load(reader)
+        with self.assertRaises(MessageTooLarge):
+            pickle.load(reader)
+        reader = BoundedReader(io.BufferedReader(io.BytesIO(data * 2)), 1024)
+        pickle.load(reader)
+        reader.reset()
+        self.assertEqual(pickle.load(reader), 'x' * 600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import socket
+import threading
+import unittest
+
+from session import *
+
+TIMEOUT = 5.0
+
+
+class SessionTest(unittest.TestCase):
+    def connect(self, **limits) -> Session:
+        # a server session with its reader running, on a real TCP connection; returns the client session
+        listener = socket.create_server(('127.0.0.1', 0))
+        client_connection = socket.create_connection(listener.getsockname())
+        server_connection, _ = listener.accept()
+        listener.close()
+        self.opened: list[tuple[Channel, int]] = []
+        self.server = Session(server_connection, on_open=lambda channel, port: self.opened.append((channel, port)), **limits)
+        self.server_reader = threading.Thread(target=self.server.run)
+        self.server_reader.start()
+        client = Session(client_connection)
+        threading.Thread(target=client.run, daemon=True).start()
+        self.addCleanup(self.close, client)
+        return client
+
+    def close(self, client: Session) -> None:
+        client.close()
+        self.server.close()
+        self.server_reader.join(TIMEOUT)
+
+    def test_channels_carry_their_own_data(self):
+        client = self.connect()
+        first = client.open_channel(5000)
+        second = client.open_channel(5001)
+        first.sendall(b'first')
+        second.sendall(b'second')
+        client.lobby.sendall(b'lobby')
+
+        self.assertEqual(self.server.lobby.recv(5), b'lobby')
+        self.server_reader.join(0.2)
+        (server_first, port_first), (server_second, port_second) = self.opened
+        self.assertEqual((port_first, port_second), (5000, 5001))
+        server_first.settimeout(TIMEOUT)
+        server_second.settimeout(TIMEOUT)
+        self.assertEqual(server_second.recv(6), b'second')
+        self.assertEqual(server_first.recv(5), b'first')
+
+        server_first.sendall(b'reply')
+        first.settimeout(TIMEOUT)
+        self.assertEqual(first.recv(5), b'reply')
+
+    def test_close_ends_the_channel_on_the_other_side(self):
+        client = self.connect()
+        channel = client.open_channel(5000)
+        channel.sendall(b'data')
+        channel.close()
+        self.server.lobby.settimeout(TIMEOUT)
+        client.lobby.sendall(b'sync')
+        self.assertEqual(self.server.lobby.recv(4), b'sync')
+        server_channel, _ = self.opened[0]
+        self.assertEqual(server_channel.recv(4), b'data')
+        self.assertEqual(server_channel.recv(4), b'')
+
+    def test_frame_over_the_limit_ends_the_session(self):
+        client = self.connect(max_frame=1024)
+        with self.assertLogs(level='INFO'):
+            client.lobby.sendall(b'x' * 4096)
+            self.server_reader.join(TIMEOUT)
+        self.assertFalse(self.server_reader.is_alive())
+        self.assertEqual(self.server.lobby.recv(1), b'')
+
+    def test_unread_data_over_the_limit_ends_the_session(self):
+        client = self.connect(max_buffer=2048)
+        channel = client.open_channel(5000)
+        with self.assertLogs(level='INFO'):
+            for _ in range(8):
+                channel.sendall(b'y' * 512)
+            self.server_reader.join(TIMEOUT)
+        self.assertFalse(self.server_reader.is_alive())
+
+    def test_channels_over_the_limit_are_closed(self):
+        client = self.connect(max_channels=2)
+        channels = [client.open_channel(5000) for _ in range(4)]
+        client.lobby.sendall(b'sync')
+        self.server.lobby.settimeout(TIMEOUT)
+        self.assertEqual(self.server.lobby.recv(4), b'sync')
+        self.assertEqual(len(self.opened), 2)
+        for channel in channels[2:]:
+            self.assertTrue(channel.poll(TIMEOUT))
+            self.assertEqual(channel.recv(1), b'')
+        self.assertFalse(channels[0].poll(0.1))
+
+    def test_channel_opened_again_ends_the_session(self):
+        for channel_id in (LOBBY_CHANNEL, 1):
+            with self.subTest(channel_id=channel_id):
+                client = self.connect()
+                client.open_channel(5000)
+                with self.assertLogs(level='INFO'):
+                    client.send_frame(FrameType.Open, channel_id, GAME_PORT.pack(5000))
+                    self.server_reader.join(TIMEOUT)
+                self.assertFalse(self.server_reader.is_alive())
+                self.assertLessEqual(len(self.opened), 1)
+
+    def test_open_without_a_port_ends_the_session(self):
+        client = self.connect()
+        with self.assertLogs(level='INFO'):
+            client.send_frame(FrameType.Open, 1, b'port')
+            self.server_reader.join(TIMEOUT)
+        self.assertFalse(self.server_reader.is_alive())
+        self.assertEqual(self.opened, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
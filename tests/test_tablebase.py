@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from tablebase import *
+
+
+class TablebaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        # generating KQK takes a while, so the table is shared by the tests
+        cls._directory = tempfile.TemporaryDirectory()
+        path = os.path.join(cls._directory.name, 'tablebases.chtb')
+        cls.tables = generate_tables(['KQK'])
+        write_tablebase(path, cls.tables)
+        cls.tablebase = Tablebase(path)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tablebase.close()
+        cls._directory.cleanup()
+
+    def probe(self, fen: str) -> TablebaseResult | None:
+        return self.tablebase.probe(ChessBoard.from_fen(fen))
+
+    def test_longest_mate(self):
+        self.assertTrue(describe(self.tables['KQK']).endswith('longest mate 10 moves'))
+
+    def test_distance_to_mate(self):
+        self.assertEqual(self.probe('k7/8/1K6/8/8/8/7Q/8 w - - 0 1').mate, 1)
+        self.assertEqual(self.probe('k6Q/8/1K6/8/8/8/8/8 b - - 0 1'), TablebaseResult(-1, 0))
+        self.assertEqual(self.probe('8/8/8/3k4/8/8/8/KQ6 b - - 0 1').wdl, -1)
+
+    def test_stalemate_and_hanging_queen_are_draws(self):
+        self.assertEqual(self.probe('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1').wdl, 0)
+        self.assertEqual(self.probe('8/8/8/8/8/8/1k6/1Q5K b - - 0 1').wdl, 0)
+
+    def test_best_move_keeps_the_distance(self):
+        chess_board = ChessBoard.from_fen('8/8/8/3k4/8/8/8/KQ6 w - - 0 1')
+        mate = self.tablebase.probe(chess_board).mate
+        line = self.tablebase.principal_variation(chess_board)
+        self.assertEqual(len(line), 2 * mate - 1)
+
+    def test_positions_outside_the_tables(self):
+        self.assertIsNone(self.probe('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'))
+        self.assertIsNone(self.probe('k7/8/1K6/8/8/8/8/7R w - - 0 1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
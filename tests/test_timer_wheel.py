@@ -0,0 +1,123 @@
+import threading
+import unittest
+from time import monotonic
+
+from timer_wheel import *
+
+TIMEOUT = 5.0
+
+
+class TimerWheelTicksTest(unittest.TestCase):
+    """
+    The wheel is advanced by hand, with ticks so long that no time passes during the test.
+    """
+
+    def setUp(self) -> None:
+        self.wheel = TimerWheel(tick=1000.0)
+        self.fired: list[tuple[str, int]] = []
+
+    def fire(self, name: str) -> None:
+        self.fired.append((name, self.wheel._current_tick))
+
+    def advance(self, ticks: int) -> None:
+        # one tick at a time, like the wheel's thread running late by less than a tick
+        for _ in range(ticks):
+            for timer in self.wheel._advance(self.wheel._current_tick + 1):
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+    def test_timers_of_every_level_fire_on_time(self):
+        # the first level covers 256 ticks, every next one 64 times more; the far ones are cascaded down
+        delays = (1, 255, 256, 300, 1 << 14, (1 << 14) + 5, 70000)
+        timers = [self.wheel.schedule(delay * 1000.0, self.fire, str(delay)) for delay in delays]
+        self.advance(max(timer.expires for timer in timers))
+        self.assertEqual(self.fired, [(str(delay), timer.expires) for delay, timer in zip(delays, timers)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancelled_timer_does_not_fire(self):
+        kept = self.wheel.schedule(300 * 1000.0, self.fire, 'kept')
+        cancelled = self.wheel.schedule(300 * 1000.0, self.fire, 'cancelled')
+        far = self.wheel.schedule(20000 * 1000.0, self.fire, 'far')
+        cancelled.cancel()
+        far.cancel()
+        self.assertEqual(len(self.wheel), 1)
+        self.advance(20001)
+        self.assertEqual(self.fired, [('kept', kept.expires)])
+
+    def test_periodic_timer(self):
+        timer = self.wheel.schedule_periodic(100 * 1000.0, self.fire, 'periodic')
+        first = timer.expires
+        self.advance(first + 1000)
+        self.assertEqual([tick for _, tick in self.fired], list(range(first, first + 1001, timer.interval)))
+        timer.cancel()
+        self.advance(1000)
+        self.assertEqual(len(self.fired), 1000 // timer.interval + 1)
+
+    def test_timer_beyond_the_wheel_is_kept(self):
+        timer = self.wheel.schedule(float(1 << 33) * 1000.0, self.fire, 'far')
+        self.assertEqual(len(self.wheel), 1)
+        self.assertIsNotNone(timer.slot)
+
+
+class TimerWheelThreadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.wheel = TimerWheel(tick=0.005)
+        self.wheel.start()
+        self.addCleanup(self.wheel.stop)
+
+    def test_timer_never_fires_early(self):
+        fired = threading.Event()
+        started = monotonic()
+        fired_at = []
+        self.wheel.schedule(0.05, lambda: (fired_at.append(monotonic()), fired.set()))
+        self.assertTrue(fired.wait(TIMEOUT))
+        self.assertGreaterEqual(fired_at[0] - started, 0.05)
+
+    def test_deferred_timer_fires_again(self):
+        calls = []
+        done = threading.Event()
+
+        def busy() -> None:
+            calls.append(monotonic())
+            if len(calls) < 3:
+                self.wheel.defer(0.02)
+            else:
+                done.set()
+
+        self.wheel.schedule(0.01, busy)
+        self.assertTrue(done.wait(TIMEOUT))
+        self.assertEqual(len(calls), 3)
+        self.assertGreaterEqual(calls[2] - calls[1], 0.02)
+
+    def test_cancelled_deferred_timer_does_not_fire_again(self):
+        calls = []
+        deferred = threading.Event()
+
+        def busy() -> None:
+            calls.append(monotonic())
+            self.wheel.defer(0.05)
+            deferred.set()
+
+        timer = self.wheel.schedule(0.01, busy)
+        self.assertTrue(deferred.wait(TIMEOUT))
+        timer.cancel()
+        # another timer fires meanwhile, so the wheel has gone past the deferred one
+        later = threading.Event()
+        self.wheel.schedule(0.1, later.set)
+        self.assertTrue(later.wait(TIMEOUT))
+        self.assertEqual(len(calls), 1)
+
+    def test_defer_outside_a_callback_is_ignored(self):
+        self.wheel.defer(0.01)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_failing_callback_does_not_stop_the_wheel(self):
+        fired = threading.Event()
+        with self.assertLogs(level='ERROR'):
+            self.wheel.schedule(0.01, lambda: 1 / 0)
+            self.wheel.schedule(0.03, fired.set)
+            self.assertTrue(fired.wait(TIMEOUT))
+
+
+if __name__ == '__main__':
+    unittest.main()
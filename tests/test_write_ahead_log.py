@@ -0,0 +1,118 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from write_ahead_log import *
+
+
+class BrokenFile:
+    def write(self, data: bytes) -> None:
+        raise OSError(28, 'No space left on device')
+
+    def flush(self) -> None:
+        pass
+
+    def fileno(self) -> int:
+        return -1
+
+    def close(self) -> None:
+        pass
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, 'moves.log')
+
+    def tearDown(self) -> None:
+        self._directory.cleanup()
+
+    def test_recovers_games_which_have_not_ended(self):
+        log = WriteAheadLog(self.path, sync=False)
+        log.commit('create', 'running', {'time': 300})
+        log.commit('create', 'ended', {'time': 60})
+        log.commit('move', 'running', ((6, 4), (4, 4)), {'white': 299.0})
+        log.commit('move', 'ended', ((6, 3), (4, 3)), {'white': 59.0})
+        log.commit('result', 'ended', {'winner': 'black'})
+        log.close()
+
+        games = WriteAheadLog(self.path, sync=False).active_games
+        self.assertEqual(list(games), ['running'])
+        self.assertEqual(games['running'].params, {'time': 300})
+        self.assertEqual(games['running'].moves, [(((6, 4), (4, 4)), {'white': 299.0})])
+        self.assertEqual(games['running'].clocks, {'white': 299.0})
+
+    def test_torn_record_is_dropped(self):
+        log = WriteAheadLog(self.path, sync=False)
+        log.commit('create', 'game', {})
+        log.commit('move', 'game', ((6, 4), (4, 4)), {})
+        log.close()
+        intact = os.path.getsize(self.path)
+        with open(self.path, 'ab') as file:
+            file.write(frame_record(('move', 'game', ((1, 4), (3, 4)), {}))[:-3])
+
+        with self.assertLogs(level='WARNING'):
+            log = WriteAheadLog(self.path, sync=False)
+        self.assertEqual(len(log.active_games['game'].moves), 1)
+        # the torn bytes are compacted away, so records appended later can be read again
+        self.assertEqual(os.path.getsize(self.path), intact)
+        log.commit('move', 'game', ((1, 4), (3, 4)), {})
+        log.close()
+        self.assertEqual(len(read_log(self.path)['game'].moves), 2)
+
+    def test_group_commit_shares_syncs(self):
+        log = WriteAheadLog(self.path)
+        syncs = []
+
+        def slow_fsync(descriptor: int) -> None:
+            syncs.append(descriptor)
+            time.sleep(0.01)
+
+        def play(game_id: str) -> None:
+            log.commit('create', game_id, {})
+            for column in range(8):
+                log.commit('move', game_id, ((6, column), (5, column)), {})
+
+        with mock.patch('write_ahead_log.os.fsync', side_effect=slow_fsync):
+            threads = [threading.Thread(target=play, args=(f'game{number}',)) for number in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            log.close()
+
+        self.assertLess(len(syncs), 8 * 9)
+        games = read_log(self.path)
+        self.assertEqual(len(games), 8)
+        self.assertTrue(all(len(game.moves) == 8 for game in games.values()))
+
+    def test_failed_write_fails_every_later_commit(self):
+        log = WriteAheadLog(self.path, sync=False)
+        log.commit('create', 'game', {})
+        log._file = BrokenFile()
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(LogWriteFailed):
+                log.commit('move', 'game', ((6, 4), (4, 4)), {})
+        with self.assertRaises(LogWriteFailed):
+            log.commit('move', 'game', ((1, 4), (3, 4)), {})
+
+    def test_compacts_while_running(self):
+        log = WriteAheadLog(self.path, sync=False, compaction_size=4096)
+        for number in range(20):
+            log.commit('create', f'game{number}', {})
+            for column in range(8):
+                log.commit('move', f'game{number}', ((6, column), (5, column)), {})
+            if number != 19:
+                log.commit('result', f'game{number}', {})
+        self.assertLess(os.path.getsize(self.path), 2 * 4096)
+        log.close()
+        games = read_log(self.path)
+        self.assertEqual(list(games), ['game19'])
+        self.assertEqual(len(games['game19'].moves), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import threading
+import logging
+from math import ceil
+from time import monotonic
+
+
+FIRST_LEVEL_BITS = 8
+LEVEL_BITS = 6
+LEVELS = 5
+
+
+class Timer:
+    __slots__ = ('expires', 'interval', 'callback', 'args', 'slot', 'cancelled', '_wheel')
+
+    def __init__(self, wheel: 'TimerWheel', expires: int, interval: int | None, callback, args: tuple) -> None:
+        self.expires: int = expires  # in ticks of the wheel
+        self.interval: int | None = interval  # periodic timers are inserted again after firing
+        self.callback = callback
+        self.args = args
+        self.slot: set | None = None
+        self.cancelled = False
+        self._wheel = wheel
+
+    def cancel(self) -> None:
+        self._wheel.cancel(self)
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel (the scheme used by the Linux kernel timers). The first level has 256 slots of
+    one tick each, every next level has 64 slots, each covering the whole previous level. Timers further in the
+    future are cascaded one level down when the lower level wraps around, so inserting and cancelling a timer
+    are O(1). All timers are run by one thread; callbacks must be short and must not block - one which cannot
+    run now (e.g. its lock is busy) calls defer() to be run again a little later.
+    """
+
+    def __init__(self, tick: float = 0.01) -> None:
+        self._tick = tick
+        self._levels: list[list[set[Timer]]] = [[set() for _ in range(1 << FIRST_LEVEL_BITS)]]
+        self._levels.extend([set() for _ in range(1 << LEVEL_BITS)] for _ in range(LEVELS - 1))
+        self._start_time = monotonic()
+        self._current_tick = 0
+        self._timers_count = 0
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._running = False
+        self._firing: Timer | None = None
+
+    def __len__(self):
+        return self._timers_count
+
+    def start(self) -> None:
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self.run, name='TimerWheel')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        with self._condition:
+            self._skip_idle_ticks()
+            timer = Timer(self, self._current_tick + self.delay_to_ticks(delay), None, callback, args)
+            self._add(timer)
+            self._condition.notify()
+        return timer
+
+    def schedule_periodic(self, interval: float, callback, *args) -> Timer:
+        with self._condition:
+            self._skip_idle_ticks()
+            ticks = self.delay_to_ticks(interval)
+            timer = Timer(self, self._current_tick + ticks, ticks, callback, args)
+            self._add(timer)
+            self._condition.notify()
+        return timer
+
+    def defer(self, delay: float) -> None:
+        """
+        Called by a callback: its timer fires again after delay. It is the same timer, so cancelling it still
+        works; periodic timers are not deferred, they fire again anyway.
+        """
+        timer = self._firing
+        if timer is None or threading.current_thread() is not self._thread or timer.interval:
+            return
+        with self._condition:
+            if timer.cancelled or timer.slot is not None:
+                return
+            timer.expires = self._current_tick + self.delay_to_ticks(delay)
+            self._add(timer)
+            self._condition.notify()
+
+    def cancel(self, timer: Timer) -> None:
+        with self._condition:
+            timer.cancelled = True
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self._timers_count -= 1
+
+    def _skip_idle_ticks(self) -> None:
+        # an empty wheel is not advanced, so it is moved to the present before the first timer is inserted
+        if not self._timers_count:
+            self._current_tick = max(self._current_tick, self._now_tick())
+
+    def _now_tick(self) -> int:
+        return int((monotonic() - self._start_time) / self._tick)
+
+    def delay_to_ticks(self, delay: float) -> int:
+        # the time already passed in the current tick is added, so a timer never fires too early
+        passed = (monotonic() - self._start_time) / self._tick - self._current_tick
+        return max(1, ceil(delay / self._tick + max(passed, 0.0)))
+
+    def _add(self, timer: Timer) -> None:
+        expires = timer.expires
+        delta = expires - self._current_tick
+        if delta < 0:
+            slot = self._levels[0][self._current_tick & ((1 << FIRST_LEVEL_BITS) - 1)]
+        else:
+            level = 0
+            bits = FIRST_LEVEL_BITS
+            while level < LEVELS - 1 and delta >= (1 << bits):
+                level += 1
+                bits += LEVEL_BITS
+            if level == LEVELS - 1 and delta >= (1 << bits):
+                # further than the wheel reaches - put it as far as possible, it will be cascaded again
+                expires = self._current_tick + (1 << bits) - 1
+            shift = 0 if level == 0 else FIRST_LEVEL_BITS + (level - 1) * LEVEL_BITS
+            size = len(self._levels[level])
+            slot = self._levels[level][(expires >> shift) & (size - 1)]
+        slot.add(timer)
+        timer.slot = slot
+        self._timers_count += 1
+
+    def _cascade(self, level: int) -> int:
+        shift = FIRST_LEVEL_BITS + (level - 1) * LEVEL_BITS
+        index = (self._current_tick >> shift) & ((1 << LEVEL_BITS) - 1)
+        slot = self._levels[level][index]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._timers_count -= 1
+            self._add(timer)
+        return index
+
+    def _advance(self, target_tick: int) -> list[Timer]:
+        expired = []
+        first_level_mask = (1 << FIRST_LEVEL_BITS) - 1
+        while self._current_tick < target_tick:
+            self._current_tick += 1
+            if not self._timers_count:
+                continue
+            index = self._current_tick & first_level_mask
+            if index == 0:
+                level = 1
+                while level < LEVELS and self._cascade(level) == 0:
+                    level += 1
+            slot = self._levels[0][index]
+            for timer in list(slot):
+                if timer.expires <= self._current_tick:
+                    slot.discard(timer)
+                    timer.slot = None
+                    self._timers_count -= 1
+                    expired.append(timer)
+                    if timer.interval:
+                        timer.expires = self._current_tick + timer.interval
+                        self._add(timer)
+        return expired
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                if not self._timers_count:
+                    self._condition.wait()
+                    continue
+                expired = self._advance(self._now_tick())
+                if not expired:
+                    next_tick_time = self._start_time + (self._current_tick + 1) * self._tick
+                    self._condition.wait(max(0.0, next_tick_time - monotonic()))
+                    continue
+            for timer in expired:
+                if timer.cancelled:
+                    continue
+                self._firing = timer
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logging.exception('timer callback failed')
+                finally:
+                    self._firing = None
@@ -0,0 +1,185 @@
+import os
+import zlib
+import struct
+import pickle
+import logging
+import threading
+from dataclasses import dataclass, field
+
+MOVE_LOG_PATH = 'moves.log'
+COMPACTION_SIZE = 16 * 1024 * 1024  # the log is compacted when it grows past this and twice its last compacted size
+
+# every record is framed with its length and checksum, so a record torn by a crash is detected and dropped
+RECORD_HEADER = struct.Struct('!II')
+
+
+@dataclass
+class LoggedGame:
+    game_id: str
+    params: dict
+    moves: list = field(default_factory=list)
+    clocks: dict | None = None  # after the last move
+
+    def records(self):
+        yield 'create', self.game_id, self.params
+        for move, clocks in self.moves:
+            yield 'move', self.game_id, move, clocks
+
+
+class LogWriteFailed(OSError):
+    pass
+
+
+class WriteAheadLog:
+    """
+    Append-only log of game creations, relayed moves and results. A thread committing a record writes and syncs
+    every record appended so far; threads committing meanwhile wait for the next batch, which one of them writes
+    in turn (group commit), so one fsync makes the moves of many games durable. Opening the log reads the games
+    which had not ended and compacts the file to just their records; the records of running games are kept in
+    memory as well, so the file is compacted again whenever it has grown too much.
+    A batch which could not be written fails its commit and every later one - the end of the file is unknown.
+    """
+
+    def __init__(self, path: str = MOVE_LOG_PATH, sync: bool = True, compaction_size: int = COMPACTION_SIZE) -> None:
+        self._path = path
+        self._sync = sync
+        self.active_games = read_log(path)
+
+        self._pending: list[bytes] = []
+        self._appended = 0
+        self._durable = 0
+        self._writing = False
+        self._failure: OSError | None = None
+        self._lock = threading.Lock()
+        self._batch_written = threading.Condition(self._lock)
+        # frames of the games which have not ended, with their sequence numbers; a game's result is in _ended
+        self._games: dict[str, list[tuple[int, bytes]]] = {
+            game.game_id: [(0, frame_record(record)) for record in game.records()] for game in self.active_games.values()}
+        self._ended: dict[str, int] = {}
+        self._compaction_size = compaction_size
+        self._size = self.compact_frames([frame for game in self._games.values() for _, frame in game])
+        self._file = open(path, 'ab')
+
+    def append(self, *record) -> int:
+        # returns the sequence number to wait for; the record is written by the next commit
+        frame = frame_record(record)
+        kind, game_id = record[0], record[1]
+        with self._lock:
+            self._pending.append(frame)
+            self._appended += 1
+            if kind == 'result':
+                self._ended[game_id] = self._appended
+            else:
+                self._games.setdefault(game_id, []).append((self._appended, frame))
+            return self._appended
+
+    def wait(self, sequence: int) -> None:
+        with self._lock:
+            while self._durable < sequence:
+                if self._failure is not None:
+                    raise LogWriteFailed(f'{self._path} cannot be written: {self._failure}') from self._failure
+                if self._writing:
+                    self._batch_written.wait()
+                else:
+                    self.write_pending()
+
+    def commit(self, *record) -> None:
+        self.wait(self.append(*record))
+
+    def write_pending(self) -> None:
+        # called with self._lock held, which is released while the batch is written
+        batch, self._pending = self._pending, []
+        sequence = self._appended
+        data = b''.join(batch)
+        self._writing = True
+        self._lock.release()
+        try:
+            self._file.write(data)
+            self._file.flush()
+            if self._sync:
+                os.fsync(self._file.fileno())
+            self._size += len(data)
+            if self._size > max(self._compaction_size, 2 * self._compacted_size):
+                self.compact_running(sequence)
+        except OSError as e:
+            failure = e
+        else:
+            failure = None
+        finally:
+            self._lock.acquire()
+            self._writing = False
+            if failure is None:
+                self._durable = sequence
+            else:
+                logging.error('the move log %s cannot be written: %s', self._path, failure)
+                self._failure = failure
+            self._batch_written.notify_all()
+
+    def compact_running(self, sequence: int) -> None:
+        # called by the writer of the batch up to sequence; records appended after it are written by later batches
+        with self._lock:
+            for game_id, result in list(self._ended.items()):
+                if result <= sequence:
+                    del self._ended[game_id]
+                    self._games.pop(game_id, None)
+            frames = [frame for game in self._games.values() for number, frame in game if number <= sequence]
+        self._file.close()
+        self._size = self.compact_frames(frames)
+        self._file = open(self._path, 'ab')
+        logging.info('move log %s compacted to %d games', self._path, len(self._games))
+
+    def compact_frames(self, frames: list[bytes]) -> int:
+        # returns the size of the compacted file
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(b''.join(frames))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self._path)
+        self._compacted_size = sum(map(len, frames))
+        return self._compacted_size
+
+    def close(self) -> None:
+        try:
+            self.wait(self._appended)
+        finally:
+            self._file.close()
+
+
+def frame_record(record: tuple) -> bytes:
+    payload = pickle.dumps(record)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        yield pickle.loads(payload)
+        offset += RECORD_HEADER.size + length
+    if offset < len(data):
+        logging.warning('%d bytes of a torn record dropped from %s', len(data) - offset, path)
+
+
+def read_log(path: str) -> dict[str, LoggedGame]:
+    """
+    Replays the log; returns the games which were created and have not ended, by game id.
+    """
+    games: dict[str, LoggedGame] = {}
+    for record in read_records(path):
+        match record:
+            case ('create', game_id, params):
+                games[game_id] = LoggedGame(game_id, params)
+            case ('move', game_id, move, clocks) if game_id in games:
+                games[game_id].moves.append((move, clocks))
+                games[game_id].clocks = clocks
+            case ('result', game_id, _):
+                games.pop(game_id, None)
+    return games